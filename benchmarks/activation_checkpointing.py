@@ -0,0 +1,97 @@
+import time
+import argparse
+import torch
+from tinysam import sam_model_registry
+from segment_model.mask_decoder_v5 import PromptedMaskDecoder
+from loss import structure_loss
+
+# Activation memory and step time of the TinyViT image encoder + decoder
+# training step for each activation checkpointing setting. The LLM is the
+# same in every setting and is replaced by random prompt features.
+#
+#   python -m benchmarks.activation_checkpointing --batch-size 4
+#
+# "stored MiB" sums the tensors autograd keeps for backward (weights not
+# counted), "peak MiB" is the CUDA peak of the step.
+
+SETTINGS = {
+    "none": ([False] * 4, False),
+    "decoder": ([False] * 4, True),
+    "encoder layer 0": ([True, False, False, False], False),
+    "encoder layer 1": ([False, True, False, False], False),
+    "encoder layer 2": ([False, False, True, False], False),
+    "encoder layer 3": ([False, False, False, True], False),
+    "encoder": ([True] * 4, False),
+    "encoder + decoder": ([True] * 4, True),
+}
+
+
+def stored_activation_bytes(step, parameters):
+    # Bytes of the distinct tensors saved for backward during step()
+    weights = {parameter.data_ptr() for parameter in parameters}
+    seen = {}
+
+    def pack(tensor):
+        ptr = tensor.untyped_storage().data_ptr()
+        if ptr not in weights:
+            seen[ptr] = max(seen.get(ptr, 0), tensor.untyped_storage().nbytes())
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        step()
+    return sum(seen.values())
+
+
+def run(encoder_layers, decoder_checkpoint, batch_size, prompt_length, steps, device):
+    torch.manual_seed(0)
+    encoder = sam_model_registry["vit_t"]().image_encoder.to(device)
+    decoder = PromptedMaskDecoder().to(device)
+    encoder.set_use_checkpoint(encoder_layers)
+    decoder.use_checkpoint = decoder_checkpoint
+    parameters = list(encoder.parameters()) + list(decoder.parameters())
+    optimizer = torch.optim.AdamW(parameters, lr=1e-4)
+    image = torch.randn(batch_size, 3, 1024, 1024, device=device)
+    prompt_feat = torch.randn(batch_size, prompt_length, 4096, device=device)
+    mask = (torch.rand(batch_size, 1, 1024, 1024, device=device) > 0.5).float()
+
+    def step():
+        optimizer.zero_grad()
+        pred = decoder(encoder(image), prompt_feat)
+        loss = structure_loss(pred, mask)
+        loss.backward()
+        optimizer.step()
+
+    stored = stored_activation_bytes(step, parameters) / 2 ** 20
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    step_time = (time.perf_counter() - start) / steps
+    peak_memory = torch.cuda.max_memory_allocated() / 2 ** 20 if device.startswith("cuda") else float("nan")
+    return step_time, stored, peak_memory
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--prompt-length", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--settings", type=str, nargs="+", default=list(SETTINGS))
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    print(f"{'setting':<20} {'step ms':>10} {'recompute':>10} {'stored MiB':>11} {'saved MiB':>10} {'peak MiB':>10}")
+    baseline = None
+    for name in args.settings:
+        encoder_layers, decoder_checkpoint = SETTINGS[name]
+        step_time, stored, peak_memory = run(
+            encoder_layers, decoder_checkpoint, args.batch_size, args.prompt_length, args.steps, args.device)
+        if baseline is None:
+            # Savings and recompute cost relative to the first setting
+            baseline = (step_time, stored)
+        print(f"{name:<20} {step_time * 1000:>10.1f} {step_time / baseline[0] - 1:>+10.1%} "
+              f"{stored:>11.1f} {baseline[1] - stored:>10.1f} {peak_memory:>10.1f}")
@@ -0,0 +1,58 @@
+import time
+import argparse
+import torch
+from segment_model.mask_decoder_v5 import PromptedMaskDecoder
+from loss import structure_loss
+
+# Step time and peak memory of the decoder + structure_loss step at full
+# resolution (1024) against low resolution supervision. The LLM and the image
+# encoder are the same in both modes and are replaced by random features.
+#
+#   python -m benchmarks.low_res_supervision --batch-size 8 --mask-sizes 1024 256
+
+
+def run(mask_size, batch_size, prompt_length, steps, device):
+    torch.manual_seed(0)
+    decoder = PromptedMaskDecoder().to(device)
+    optimizer = torch.optim.AdamW(decoder.parameters(), lr=1e-4)
+    image_feat = torch.randn(batch_size, 256, 64, 64, device=device)
+    prompt_feat = torch.randn(batch_size, prompt_length, 4096, device=device)
+    mask = (torch.rand(batch_size, 1, mask_size, mask_size, device=device) > 0.5).float()
+
+    def step():
+        optimizer.zero_grad()
+        pred = decoder(image_feat, prompt_feat, output_size=mask_size)
+        loss = structure_loss(pred, mask)
+        loss.backward()
+        optimizer.step()
+
+    step()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    step_time = (time.perf_counter() - start) / steps
+    peak_memory = torch.cuda.max_memory_allocated() / 2 ** 20 if device.startswith("cuda") else float("nan")
+    return step_time, peak_memory
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--prompt-length", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--mask-sizes", type=int, nargs="+", default=[1024, 256])
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    # Target mask bytes copied to the device per batch: float32 in the default
+    # pipeline, uint8 with uint8_output
+    print(f"{'mask size':>10} {'step ms':>10} {'peak MiB':>10} {'mask MiB/batch':>15}")
+    for mask_size in args.mask_sizes:
+        step_time, peak_memory = run(mask_size, args.batch_size, args.prompt_length, args.steps, args.device)
+        mask_bytes = args.batch_size * mask_size * mask_size * 4 / 2 ** 20
+        print(f"{mask_size:>10} {step_time * 1000:>10.1f} {peak_memory:>10.1f} {mask_bytes:>15.1f}")
@@ -0,0 +1,84 @@
+import time
+import argparse
+import torch
+from segment_model.model import build_llm_seg
+from infer_full import load_image_for_vlm, transform_for_sam, process_prompt_seg
+
+# Time per mask of segmenting N prompts on one image with N LLMSeg.segment
+# calls, the same with the embedding cache (every image encoding after the
+# warm-up is a hit, keyed by the image path) and one LLMSeg.segment_prompts
+# call.
+#
+#   python -m benchmarks.multi_prompt_segmentation --model-path <llava-med-v1.5-mistral-7b> \
+#       --checkpoint <llm_seg checkpoint> --image <image> --num-prompts 8
+#
+# Without --checkpoint the LoRA adapter and the segmentation heads are
+# randomly initialised, which does not change the timings.
+
+PROMPTS = [
+    "Segment the tumor region.",
+    "Where is the lesion located in this scan?",
+    "Highlight the abnormal area in the left lung.",
+    "Segment the mass along the convexity suggestive of meningioma.",
+    "Which region shows the polyp?",
+    "Outline the enlarged heart in this chest X-ray.",
+    "Segment the hemorrhage in the brain.",
+    "Find the nodule in the right upper lobe.",
+]
+
+
+def timed(fn, steps, device):
+    fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps
+
+
+def run(model, prompt_ids, image_tensor, image_sam, image_path, steps, device):
+    def sequential():
+        for input_ids in prompt_ids:
+            model.segment(input_ids[None], image_tensor, image_sam, image_keys=[image_path])
+
+    def batched():
+        model.segment_prompts(prompt_ids, image_tensor, image_sam)
+
+    results = {}
+    model.embedding_cache = None
+    results["sequential"] = timed(sequential, steps, device)
+    model.enable_embedding_cache()
+    results["sequential + cache"] = timed(sequential, steps, device)
+    model.embedding_cache = None
+    results["batched"] = timed(batched, steps, device)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--checkpoint", type=str, default=None)
+    parser.add_argument("--image", type=str, required=True)
+    parser.add_argument("--num-prompts", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--device", type=str, default="cuda:0")
+    args = parser.parse_args()
+
+    model, tokenizer, image_processor, config = build_llm_seg(model_path=args.model_path, device=args.device)
+    if args.checkpoint is not None:
+        tokenizer = model.load_model(args.checkpoint)
+    model.to(args.device)
+    image_tensor = load_image_for_vlm(args.image, image_processor, config).to(args.device)
+    image_sam = transform_for_sam(args.image).to(args.device)
+
+    print(f"{'prompts':>8} {'mode':>20} {'ms/prompt':>10} {'speedup':>8}")
+    for num_prompts in args.num_prompts:
+        prompts = [PROMPTS[i % len(PROMPTS)] for i in range(num_prompts)]
+        prompt_ids = [process_prompt_seg(prompt, tokenizer)[0].to(args.device) for prompt in prompts]
+        results = run(model, prompt_ids, image_tensor, image_sam, args.image, args.steps, args.device)
+        for mode, seconds in results.items():
+            print(f"{num_prompts:>8} {mode:>20} {seconds * 1000 / num_prompts:>10.1f} "
+                  f"{results['sequential'] / seconds:>7.2f}x")
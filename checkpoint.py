@@ -0,0 +1,127 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from safetensors.torch import save_file, load_file
+
+TRAINING_STATE_NAME = "training_state.pt"
+TRAINABLE_NAME = "trainable.safetensors"
+
+
+def training_state(optimizer, scheduler, epoch, batch_in_epoch, global_step, sampler=None):
+    # Everything besides the model weights that a resumed run needs: optimizer
+    # and scheduler state, the position in the epoch and the sampler state
+    return {
+        "optimizer": optimizer.state_dict(),
+        "scheduler": scheduler.state_dict(),
+        "epoch": epoch,
+        "batch_in_epoch": batch_in_epoch,
+        "global_step": global_step,
+        "sampler": sampler.state_dict(batch_in_epoch) if sampler is not None else None,
+    }
+
+
+def load_training_state(load_path, optimizer, scheduler, sampler=None, map_location="cpu"):
+    state = torch.load(os.path.join(load_path, TRAINING_STATE_NAME), map_location=map_location)
+    optimizer.load_state_dict(state["optimizer"])
+    scheduler.load_state_dict(state["scheduler"])
+    if sampler is not None and state["sampler"] is not None:
+        sampler.load_state_dict(state["sampler"])
+    return state
+
+
+def trainable_state_dict(model):
+    # Parameters that require grad and the persistent buffers of the modules
+    # owning them (e.g. BatchNorm statistics). Frozen weights are left out,
+    # they are restored from the base checkpoints.
+    state = {}
+    for module_name, module in model.named_modules():
+        parameters = list(module.named_parameters(recurse=False))
+        if not any(parameter.requires_grad for _, parameter in parameters):
+            continue
+        prefix = module_name + "." if module_name else ""
+        for name, parameter in parameters:
+            if parameter.requires_grad:
+                state[prefix + name] = parameter
+        for name, buffer in module.named_buffers(recurse=False):
+            if buffer is not None and name not in module._non_persistent_buffers_set:
+                state[prefix + name] = buffer
+    return state
+
+
+def load_trainable_checkpoint(model, load_path, device="cpu"):
+    state = load_file(os.path.join(load_path, TRAINABLE_NAME), device=str(device))
+    missing, unexpected = model.load_state_dict(state, strict=False)
+    if unexpected:
+        raise KeyError(f"Unexpected keys in {load_path}: {unexpected[:5]}")
+    return state
+
+
+def replace_dir(tmp_path, path):
+    # Move a finished checkpoint directory into place. A previous checkpoint
+    # at path is kept as path.old until the new one is there.
+    old_path = path + ".old"
+    if os.path.exists(path):
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+class AsyncCheckpointWriter:
+    # Writes checkpoints in a background thread. save() copies the trainable
+    # tensors and the training state into reused pinned CPU buffers and
+    # returns; the thread waits for the copies, writes a temporary directory
+    # and renames it into place, so a crash never leaves a partial checkpoint.
+    # A save waits for the previous write before reusing the buffers.
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.buffers = {}
+        self.pin_memory = torch.cuda.is_available()
+
+    def snapshot(self, value, key):
+        if torch.is_tensor(value):
+            value = value.detach()
+            buffer = self.buffers.get(key)
+            if buffer is None or buffer.shape != value.shape or buffer.dtype != value.dtype:
+                buffer = torch.empty(value.shape, dtype=value.dtype, pin_memory=self.pin_memory)
+                self.buffers[key] = buffer
+            buffer.copy_(value, non_blocking=True)
+            return buffer
+        if isinstance(value, dict):
+            return {k: self.snapshot(v, f"{key}/{k}") for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(self.snapshot(v, f"{key}/{i}") for i, v in enumerate(value))
+        return value
+
+    def save(self, save_path, model, state=None):
+        self.wait()
+        tensors = self.snapshot(trainable_state_dict(model), "model")
+        state = self.snapshot(state, "state") if state is not None else None
+        copied = None
+        if torch.cuda.is_available():
+            copied = torch.cuda.Event()
+            copied.record()
+        self.pending = self.executor.submit(self.write, save_path, tensors, state, copied)
+
+    def write(self, save_path, tensors, state, copied):
+        if copied is not None:
+            copied.synchronize()
+        tmp_path = save_path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        save_file(tensors, os.path.join(tmp_path, TRAINABLE_NAME), metadata={"format": "pt"})
+        if state is not None:
+            torch.save(state, os.path.join(tmp_path, TRAINING_STATE_NAME))
+        replace_dir(tmp_path, save_path)
+
+    def wait(self):
+        # Block until the last checkpoint is on disk, re-raising its error
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
@@ -0,0 +1,262 @@
+import os
+import copy
+import json
+import math
+import hashlib
+import logging
+import argparse
+import numpy as np
+import torch
+
+# Offline cache of preprocessed samples. Every record holds the CLIP pixel
+# values (fp16), the resized SAM input (uint8) and the resized mask (bit-packed)
+# of one annotation image. Records have a fixed stride inside fixed-size shard
+# files, so a record is a memory-mapped slice and reading it needs no decode.
+
+CACHE_VERSION = 1
+INDEX_NAME = "index.json"
+SHARD_NAME = "shard_{:05d}.bin"
+FIELD_ALIGNMENT = 64
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [path, stat.st_mtime_ns, stat.st_size]
+
+
+def transform_fingerprint(dataset):
+    # Hash of the parameters that change the cached tensors
+    image_processor = dataset.image_processor
+    if hasattr(image_processor, "to_dict"):
+        processor_params = image_processor.to_dict()
+    else:
+        processor_params = type(image_processor).__name__
+    params = {
+        "version": CACHE_VERSION,
+        "image_size": dataset.image_size,
+        "mask_size": dataset.mask_size,
+        "image_aspect_ratio": getattr(dataset.data_config, "image_aspect_ratio", None),
+        "image_processor": processor_params,
+    }
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def record_layout(clip_shape, image_size, mask_size):
+    fields = [
+        ("clip", list(clip_shape), 2 * math.prod(clip_shape)),
+        ("sam", [3, image_size, image_size], 3 * image_size * image_size),
+        ("mask", [1, mask_size, mask_size], (mask_size * mask_size + 7) // 8),
+    ]
+    layout = {}
+    offset = 0
+    for name, shape, nbytes in fields:
+        layout[name] = {"offset": offset, "shape": shape, "nbytes": nbytes}
+        offset += -(-nbytes // FIELD_ALIGNMENT) * FIELD_ALIGNMENT
+    return layout, offset
+
+
+def read_index(cache_dir):
+    index_path = os.path.join(cache_dir, INDEX_NAME)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, "r") as f:
+        index = json.load(f)
+    if index.get("version") != CACHE_VERSION:
+        return None
+    return index
+
+
+def write_index(cache_dir, index):
+    # Written after the shards and renamed into place, so readers never see an
+    # index pointing at records that are not on disk yet
+    index_path = os.path.join(cache_dir, INDEX_NAME)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+
+def entry_is_fresh(entry):
+    try:
+        return file_signature(entry["image"][0]) == entry["image"] and \
+            file_signature(entry["mask"][0]) == entry["mask"]
+    except OSError:
+        return False
+
+
+class LazyMemmaps:
+    # Base of the stores that open their memory maps lazily. The maps are not
+    # pickled: every DataLoader worker opens its own. closed_memmaps holds
+    # each map attribute with its value before anything is opened.
+    closed_memmaps = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update({name: copy.copy(value) for name, value in self.closed_memmaps.items()})
+        return state
+
+
+class TensorCache(LazyMemmaps):
+    closed_memmaps = {"_shards": {}}
+
+    def __init__(self, cache_dir, index, entries):
+        self.cache_dir = cache_dir
+        self.layout = index["layout"]
+        self.stride = index["stride"]
+        self.records_per_shard = index["records_per_shard"]
+        self.entries = entries
+        self._shards = {}
+
+    @classmethod
+    def open(cls, cache_dir, fingerprint, validate=True):
+        # None when the cache is missing or was built with other transforms.
+        # Entries whose source image or mask changed since compilation are dropped.
+        index = read_index(cache_dir)
+        if index is None or index["fingerprint"] != fingerprint:
+            return None
+        entries = {}
+        for key, entry in index["entries"].items():
+            if validate and not entry_is_fresh(entry):
+                continue
+            entries[key] = (entry["shard"], entry["slot"])
+        stale = len(index["entries"]) - len(entries)
+        if stale > 0:
+            logging.warning(f"{stale} cached samples in {cache_dir} are stale, recompile the cache to refresh them")
+        return cls(cache_dir, index, entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def shard(self, shard_id):
+        records = self._shards.get(shard_id)
+        if records is None:
+            # Copy-on-write mapping: pages come from the page cache and tensors
+            # built on it are writable without touching the file
+            records = np.memmap(
+                os.path.join(self.cache_dir, SHARD_NAME.format(shard_id)),
+                dtype=np.uint8,
+                mode="c",
+                shape=(self.records_per_shard, self.stride)
+            )
+            self._shards[shard_id] = records
+        return records
+
+    def field(self, record, name):
+        field = self.layout[name]
+        return record[field["offset"]:field["offset"] + field["nbytes"]]
+
+    def get(self, key):
+        # (clip fp16, sam uint8, mask bool) for a key, or None on a miss.
+        # clip and sam are views on the mapped shard.
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        record = self.shard(entry[0])[entry[1]]
+        clip = self.field(record, "clip").view(np.float16).reshape(self.layout["clip"]["shape"])
+        sam = self.field(record, "sam").reshape(self.layout["sam"]["shape"])
+        mask_shape = self.layout["mask"]["shape"]
+        mask = np.unpackbits(self.field(record, "mask"), count=math.prod(mask_shape))
+        mask = mask.view(np.bool_).reshape(mask_shape)
+        return torch.from_numpy(clip), torch.from_numpy(sam), torch.from_numpy(mask)
+
+
+def open_shard_for_write(cache_dir, shard_id, records_per_shard, stride):
+    shard_path = os.path.join(cache_dir, SHARD_NAME.format(shard_id))
+    size = records_per_shard * stride
+    mode = "r+" if os.path.exists(shard_path) and os.path.getsize(shard_path) == size else "w+"
+    return np.memmap(shard_path, dtype=np.uint8, mode=mode, shape=(records_per_shard, stride))
+
+
+def compile_dataset(dataset, cache_dir, records_per_shard=256):
+    # Write the preprocessed tensors of every image in the dataset to cache_dir.
+    # Images whose source files are unchanged since the last run are skipped,
+    # changed transforms rebuild the whole cache.
+    os.makedirs(cache_dir, exist_ok=True)
+    fingerprint = transform_fingerprint(dataset)
+    index = read_index(cache_dir)
+    if index is not None and (index["fingerprint"] != fingerprint or index["records_per_shard"] != records_per_shard):
+        logging.info(f"Transforms changed, rebuilding tensor cache {cache_dir}")
+        index = None
+    if index is None:
+        index = {
+            "version": CACHE_VERSION,
+            "fingerprint": fingerprint,
+            "records_per_shard": records_per_shard,
+            "layout": None,
+            "stride": None,
+            "entries": {},
+        }
+    entries = index["entries"]
+    next_slot = max([e["shard"] * records_per_shard + e["slot"] + 1 for e in entries.values()], default=0)
+
+    shards = {}
+    seen = set()
+    written = 0
+    for idx in range(len(dataset)):
+        key = dataset.sample_key(idx)
+        if key in seen:
+            continue
+        seen.add(key)
+        image_path, mask_path, _ = dataset.sample_paths(idx)
+        image_signature = file_signature(image_path)
+        mask_signature = file_signature(mask_path)
+        entry = entries.get(key)
+        if entry is not None and entry["image"] == image_signature and entry["mask"] == mask_signature:
+            continue
+
+        image_pil = dataset.decode_image(idx, image_path)
+        clip = dataset.process_image(image_pil).numpy()
+        sam = dataset.process_sam_image_uint8(image_pil).numpy()
+        mask = dataset.process_mask_binary(mask_path).numpy()
+        if index["layout"] is None:
+            index["layout"], index["stride"] = record_layout(clip.shape, dataset.image_size, dataset.mask_size)
+        layout = index["layout"]
+
+        if entry is None:
+            entry = {"shard": next_slot // records_per_shard, "slot": next_slot % records_per_shard}
+            next_slot += 1
+        if entry["shard"] not in shards:
+            shards[entry["shard"]] = open_shard_for_write(cache_dir, entry["shard"], records_per_shard, index["stride"])
+        record = shards[entry["shard"]][entry["slot"]]
+        for name, value in (("clip", clip.view(np.uint8)), ("sam", sam), ("mask", np.packbits(mask))):
+            field = layout[name]
+            record[field["offset"]:field["offset"] + field["nbytes"]] = value.reshape(-1)
+        entry["image"] = image_signature
+        entry["mask"] = mask_signature
+        entries[key] = entry
+        written += 1
+
+    for records in shards.values():
+        records.flush()
+    write_index(cache_dir, index)
+    logging.info(f"Tensor cache {cache_dir}: wrote {written} of {len(seen)} samples")
+    return written
+
+
+if __name__ == "__main__":
+    from data_utils.dataset import PromptSegmentDataset
+    from data_utils.utils import load_processors
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--data-path", type=str, required=True)
+    parser.add_argument("--annotation-path", type=str, required=True)
+    parser.add_argument("--cache-dir", type=str, required=True)
+    parser.add_argument("--records-per-shard", type=int, default=256)
+    parser.add_argument("--mask-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    tokenizer, image_processor, config = load_processors(args.model_path)
+    dataset = PromptSegmentDataset(
+        data_path=args.data_path,
+        annotation_path=args.annotation_path,
+        data_config=config,
+        image_processor=image_processor,
+        tokenizer=tokenizer,
+        mask_size=args.mask_size
+    )
+    compile_dataset(dataset, args.cache_dir, records_per_shard=args.records_per_shard)
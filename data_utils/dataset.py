@@ -1,16 +1,124 @@
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset, DataLoader
-from data_utils.utils import load_annotation, load_image, binary_loader
+from data_utils.utils import load_annotation, load_image, binary_loader, prompt_text, answer_text, AnnotationIndex
+from data_utils.cache import TensorCache, transform_fingerprint
+from data_utils.token_store import TokenStore
+from data_utils.feature_cache import clip_transform_fingerprint, feature_key
+from data_utils.sampler import LengthBucketBatchSampler, RandomBatchSampler
 from llava.mm_utils import tokenizer_image_token
 from llava.mm_utils import process_images
 from torchvision import transforms 
+from collections import Counter
+import numpy as np
+import logging
+import json
 import os 
 
 IGNORE_INDEX = 0
 MAX_PROMPT_LENGTH = 512
+IMAGE_SIZE = 1024
+SAM_MEAN = [0.485, 0.456, 0.406]
+SAM_STD = [0.229, 0.224, 0.225]
 
-class PromptSegmentDataset(Dataset):
+class SampleProcessor:
+    # Image and mask preprocessing shared by PromptSegmentDataset and the
+    # streaming ShardDataset of data_utils/shards.py
+    def __init__(
+        self,
+        data_config,
+        image_processor,
+        uint8_output = False,
+        image_size = IMAGE_SIZE,
+        mask_size = IMAGE_SIZE
+    ):
+        self.image_processor = image_processor
+        self.data_config = data_config
+
+        self.image_size = image_size
+        self.mask_size = mask_size
+        self.mask_transform = transforms.Compose([
+            transforms.Resize((self.mask_size, self.mask_size)),
+            transforms.ToTensor(),
+        ])
+
+        self.sam_resize = transforms.Resize((self.image_size, self.image_size))
+        self.sam_normalize = transforms.Normalize(SAM_MEAN, SAM_STD)
+        self.image_sam_transform = transforms.Compose([
+            self.sam_resize,
+            transforms.ToTensor(),
+            self.sam_normalize
+        ])
+
+        # Return the SAM image and the mask as uint8, DevicePreprocess does
+        # the float conversion, normalization and binarization on the device
+        self.uint8_output = uint8_output
+        self._clip_transform = None
+
+    def clip_feature_key(self, sample_key):
+        # Key of the vision feature cache (data_utils/feature_cache.py) for
+        # the CLIP input of an image
+        if self._clip_transform is None:
+            self._clip_transform = clip_transform_fingerprint(self.image_processor, self.data_config)
+        return feature_key(sample_key, self._clip_transform)
+
+    def process_image(self, image_pil):
+        # Process the image using the image processor
+        image_tensor = process_images(
+            [image_pil], 
+            self.image_processor, 
+            self.data_config
+        )
+        # image_tensor = image_tensor.to(self.data_config.device, dtype=torch.float16)
+
+        return image_tensor.squeeze(0).to(torch.float16)
+    
+    def process_sam_image(self, image_pil):
+        image_sam_tensor = self.image_sam_transform(image_pil)
+        return image_sam_tensor.to(torch.float32)
+
+    def process_sam_image_uint8(self, image_pil):
+        # Resized SAM input before ToTensor/Normalize, (3, H, W) uint8
+        image_sam = np.array(self.sam_resize(image_pil), dtype=np.uint8)
+        return torch.from_numpy(image_sam).permute(2, 0, 1).contiguous()
+
+    def normalize_sam_image(self, image_sam_uint8):
+        # Same result as image_sam_transform for an image from process_sam_image_uint8
+        return self.sam_normalize(image_sam_uint8.to(torch.float32).div(255))
+
+    def process_mask(self, mask_path):
+        # Process the mask using the image processor
+        mask_image = binary_loader(mask_path)
+        mask_tensor = self.mask_transform(mask_image)
+        return mask_tensor
+
+    def process_mask_uint8(self, mask_path):
+        # Resized mask before ToTensor, (1, H, W) uint8
+        mask_image = transforms.functional.resize(binary_loader(mask_path), [self.mask_size, self.mask_size])
+        return torch.from_numpy(np.array(mask_image, dtype=np.uint8)).unsqueeze(0)
+
+    def process_mask_binary(self, mask_path):
+        # Resized mask thresholded at 0.5, (1, H, W) bool
+        mask_image = transforms.functional.resize(binary_loader(mask_path), [self.mask_size, self.mask_size])
+        return torch.from_numpy(np.asarray(mask_image) >= 128).unsqueeze(0)
+
+    def image_tensors(self, image_pil, mask_source):
+        # CLIP input, SAM input and mask of a decoded image, as uint8 or float
+        # depending on uint8_output. mask_source is a path or a file object.
+        if self.uint8_output:
+            return (
+                self.process_image(image_pil),
+                self.process_sam_image_uint8(image_pil),
+                self.process_mask_uint8(mask_source)
+            )
+        return (
+            self.process_image(image_pil),
+            self.process_sam_image(image_pil),
+            self.process_mask(mask_source)
+        )
+
+
+class PromptSegmentDataset(SampleProcessor, Dataset):
     def __init__(
         self,
         data_path,
@@ -19,43 +127,60 @@ class PromptSegmentDataset(Dataset):
         image_processor,
         tokenizer,
         trainsize = 512,
-        mode = "train"
+        mode = "train",
+        cache_dir = None,
+        token_store_dir = None,
+        uint8_output = False,
+        seed = None,
+        mask_size = IMAGE_SIZE
     ):
         self.data_path = data_path
         self.annotation_path = annotation_path
         self.tokenizer = tokenizer
-        self.annotation_df = None
-        self.train_df, self.test_df = load_annotation(annotation_path)
+        self.annotation = None
+        self.train_annotation, self.test_annotation = load_annotation(annotation_path, data_path, seed=seed)
         self.trainsize = trainsize
-        self.annotation_df = self.train_df
+        self.annotation = self.train_annotation
         # if mode == "train":
-        #     self.annotation_df = self.train_df
+        #     self.annotation = self.train_annotation
         # elif mode == "test":
-        #     self.annotation_df = self.test_df
+        #     self.annotation = self.test_annotation
 
         self.IMAGE_TOKEN_INDEX = -200
-        self.image_processor = image_processor
-        self.data_config = data_config
-        
-        self.mask_transform = transforms.Compose([
-            transforms.Resize((1024, 1024)),
-            transforms.ToTensor(),
-        ])
+        # mask_size below IMAGE_SIZE gives low resolution masks for supervising
+        # the decoder at that size
+        super().__init__(data_config, image_processor, uint8_output=uint8_output, mask_size=mask_size)
 
-        self.image_sam_transform = transforms.Compose([
-            transforms.Resize((1024, 1024)),
-            transforms.ToTensor(),
-            transforms.Normalize(
-                [0.485, 0.456, 0.406],
-                [0.229, 0.224, 0.225])
-        ])
+        # Number of image decodes per sample index, used to check that
+        # __getitem__ decodes each image once. Counts are per process, so
+        # with DataLoader workers each worker keeps its own counter.
+        self.decode_counter = Counter()
+
+        # Preprocessed tensors written by data_utils/cache.py, rows missing
+        # from the cache fall back to decoding the source files
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = TensorCache.open(cache_dir, transform_fingerprint(self))
+            if self.cache is None:
+                logging.warning(f"No valid tensor cache in {cache_dir}, decoding images on the fly")
+
+        # Pre-tokenized prompts and answers from data_utils/token_store.py
+        self.token_store = None
+        self.token_rows = None
+        if token_store_dir is not None:
+            self.token_store = TokenStore.open_or_build(
+                token_store_dir,
+                AnnotationIndex.concat([self.train_annotation, self.test_annotation]),
+                tokenizer
+            )
+            self.token_rows = self.token_store.rows(self.annotation)
         
     def __len__(self):
-        return len(self.annotation_df)
+        return len(self.annotation)
 
     def answer_process(self, question, prompt, answer):
         # Process the answer to get the input_ids
-        input_prompt = "<image>\n" + f"### User: {question} \n" + "### Assistant: \n" + answer + " " + prompt
+        input_prompt = answer_text(question, prompt, answer)
         # print("Input prompt:", input_prompt)
         answer_ids = tokenizer_image_token(
             input_prompt, 
@@ -68,8 +193,7 @@ class PromptSegmentDataset(Dataset):
 
     def prompt_process(self, prompt):
         # Process the prompt to get the input_ids and attention_mask
-        # prompt_for_vlm = "<image> " + "### User: You are doing the segmentation for the tumour with the condition: " + prompt + " Where is the position of the tumour? \n"
-        prompt_for_vlm = "<image> \n" + prompt 
+        prompt_for_vlm = prompt_text(prompt)
         input_ids = tokenizer_image_token(
             prompt_for_vlm, 
             self.tokenizer, 
@@ -79,67 +203,86 @@ class PromptSegmentDataset(Dataset):
         # print("Input ids key full:", input_ids)
         return input_ids
     
-    def process_image(self, image_path):
-        # Process the image using the image processor
-        image_pil = load_image(image_path)
-        image_tensor = process_images(
-            [image_pil], 
-            self.image_processor, 
-            self.data_config
+    def decode_image(self, idx, image_path):
+        # Decode the image once, the PIL image is shared by the SAM and CLIP paths
+        self.decode_counter[idx] += 1
+        return load_image(image_path)
+
+    def answer_lengths(self):
+        # Tokenized answer length of every row, used for length bucketing
+        if self.token_rows is not None:
+            return self.token_store.lengths("answers_ids", self.token_rows)
+        lengths = []
+        for idx in range(len(self)):
+            question, prompt, answers = self.sample_text(idx)
+            lengths.append(len(self.answer_process(question, prompt, answers)))
+        return np.array(lengths, dtype=np.int64)
+
+    def sample_key(self, idx):
+        # Annotation value identifying the image and mask of a row
+        return self.annotation.get("image_path", idx)
+
+    def sample_paths(self, idx):
+        # Resolved image path, mask path and class label of a row
+        return (
+            self.annotation.get("resolved_image_path", idx),
+            self.annotation.get("mask_path", idx),
+            int(self.annotation.labels[idx])
         )
-        # image_tensor = image_tensor.to(self.data_config.device, dtype=torch.float16)
 
-        return image_tensor.squeeze(0).to(torch.float16)
-    
-    def process_sam_image(self, image_path):
-        image_pil = load_image(image_path)
-        image_sam_tensor = self.image_sam_transform(image_pil)
-        return image_sam_tensor.to(torch.float32)
+    def sample_text(self, idx):
+        # Question, description and position of a row
+        return (
+            self.annotation.get("question", idx),
+            self.annotation.get("description", idx),
+            self.annotation.get("position", idx)
+        )
 
-    def process_mask(self, mask_path):
-        # Process the mask using the image processor
-        mask_image = binary_loader(mask_path)
-        mask_tensor = self.mask_transform(mask_image)
-        return mask_tensor
+    def feature_key(self, idx):
+        return self.clip_feature_key(self.sample_key(idx))
+
+    def clip_image(self, idx):
+        # CLIP pixel values of a row, from the tensor cache when present
+        cached = self.cache.get(self.sample_key(idx)) if self.cache is not None else None
+        if cached is not None:
+            return cached[0]
+        image_path, _, _ = self.sample_paths(idx)
+        return self.process_image(self.decode_image(idx, image_path))
+
+    def sample_token_ids(self, idx):
+        # Prompt and answer token ids of a row, from the token store when present
+        if self.token_rows is not None:
+            row = self.token_rows[idx]
+            input_ids = torch.from_numpy(self.token_store.get("input_ids", row).astype(np.int64))
+            answers_ids = torch.from_numpy(self.token_store.get("answers_ids", row).astype(np.int64))
+            return input_ids, answers_ids
+        question, prompt, answers = self.sample_text(idx)
+        return self.prompt_process(question), self.answer_process(question, prompt, answers)
 
     def __getitem__(self, idx):
-        # Get the image path and prompt from the dataframe
-        mask_path = os.path.join(self.data_path, self.annotation_df.iloc[idx]['image_path'])
-        mask_path = mask_path.replace("\\", "/")
-        image_path = mask_path.replace("train_masks", "train_images").replace("_Segmentation", "")
-        if "ISIC" in image_path:
-            image_path = image_path.replace(".png", ".jpg")
-        if "skin" in image_path:
-            label = 6
-        elif "breast" in image_path:
-            label = 1
-        elif "brain" in image_path:
-            label = 0
-        elif "dental" in image_path:
-            label = 2
-        elif "lung_CT" in image_path:
-            label = 3
-        elif "lung_Xray" in image_path:
-            label = 4
+        # Get the image path and prompt from the annotation index
+        image_path, mask_path, label = self.sample_paths(idx)
+        cached = self.cache.get(self.sample_key(idx)) if self.cache is not None else None
+        if cached is not None:
+            image_tensor, image_sam_uint8, mask_binary = cached
+            if self.uint8_output:
+                image_sam_tensor = image_sam_uint8
+                mask_tensor = mask_binary.to(torch.uint8) * 255
+            else:
+                image_sam_tensor = self.normalize_sam_image(image_sam_uint8)
+                mask_tensor = mask_binary.to(torch.float32)
         else:
-            label = 3
-        
-        prompt = self.annotation_df.iloc[idx]['description']
-        question = self.annotation_df.iloc[idx]['question']
-        answers = self.annotation_df.iloc[idx]['position']
-        mask_tensor = self.process_mask(mask_path)
-        image_sam_tensor = self.process_sam_image(image_path)
-        # Process the image and prompt
-        image_tensor = self.process_image(image_path)
-        input_ids = self.prompt_process(question)
-        answers_ids = self.answer_process(question, prompt, answers)    
+            image_pil = self.decode_image(idx, image_path)
+            image_tensor, image_sam_tensor, mask_tensor = self.image_tensors(image_pil, mask_path)
+        input_ids, answers_ids = self.sample_token_ids(idx)
         return {
             'input_ids': input_ids,
             'image_tensor': image_tensor,
             'mask_tensor': mask_tensor,
             'answers_ids': answers_ids,
             "image_sam": image_sam_tensor,
-            "label": label
+            "label": label,
+            "image_key": self.feature_key(idx)
         }
     
 def collate_fn(batch):
@@ -180,9 +323,57 @@ def collate_fn(batch):
         'answers_ids': answers_ids,
         'image_sam': image_sam_tensor,
         "attention_masks": attention_masks,
-        "label": torch.tensor([item['label'] for item in batch])
+        "label": torch.tensor([item['label'] for item in batch]),
+        # Vision feature cache keys, None when a sample has none
+        "image_keys": [item["image_key"] for item in batch] if all("image_key" in item for item in batch) else None
     }
 
+class DevicePreprocess(nn.Module):
+    # Turns uint8 batches from PromptSegmentDataset(uint8_output=True) into the
+    # float tensors of the default pipeline after the host to device copy.
+    # Float batches pass through unchanged.
+    def __init__(self, mean=SAM_MEAN, std=SAM_STD):
+        super().__init__()
+        self.register_buffer("mean", torch.tensor(mean).view(1, 3, 1, 1) * 255, persistent=False)
+        self.register_buffer("std", torch.tensor(std).view(1, 3, 1, 1) * 255, persistent=False)
+
+    def forward(self, image_sam, mask):
+        if image_sam.dtype == torch.uint8:
+            image_sam = (image_sam.to(torch.float32) - self.mean) / self.std
+        if mask.dtype == torch.uint8:
+            mask = (mask >= 128).to(torch.float32)
+        return image_sam, mask
+
+# DataLoader settings of create_dataloader, overridden per split by the JSON
+# config written by data_utils/loader_tuning.py
+LOADER_DEFAULTS = {
+    "train": {"num_workers": 16, "prefetch_factor": 2, "pin_memory": True, "persistent_workers": False},
+    "val": {"num_workers": 4, "prefetch_factor": 2, "pin_memory": True, "persistent_workers": False},
+}
+
+def loader_kwargs(loader_config, split):
+    # DataLoader keyword arguments of a split. loader_config is None, a dict
+    # like LOADER_DEFAULTS or the path of a JSON file holding one.
+    if isinstance(loader_config, str):
+        with open(loader_config, "r") as f:
+            loader_config = json.load(f)
+    kwargs = dict(LOADER_DEFAULTS[split])
+    if loader_config is not None:
+        kwargs.update(loader_config.get(split, {}))
+    if kwargs["num_workers"] == 0:
+        # Only valid with worker processes
+        kwargs.pop("prefetch_factor")
+        kwargs["persistent_workers"] = False
+    return kwargs
+
+def train_val_split(dataset, seed):
+    # 90/10 split of the dataset rows, the same for a given seed
+    return torch.utils.data.random_split(
+        dataset, 
+        [int(len(dataset) * 0.9), len(dataset) - int(len(dataset) * 0.9)],
+        generator=torch.Generator().manual_seed(seed)
+    )
+
 def create_dataloader(
     data_path,
     annotation_path,
@@ -190,29 +381,69 @@ def create_dataloader(
     image_processor,
     tokenizer,
     batch_size=2,
-    mode="train"
+    mode="train",
+    cache_dir=None,
+    token_store_dir=None,
+    bucket_by_length=False,
+    uint8_output=False,
+    seed=42,
+    mask_size=IMAGE_SIZE,
+    loader_config=None,
+    rank=0,
+    world_size=1
 ):
-    dataset = PromptSegmentDataset(
+    # With world_size > 1 (distributed.init_distributed) every rank gets its
+    # own train batches and val samples, batch_size is per rank
+    dataset_kwargs = dict(
         data_path=data_path,
         annotation_path=annotation_path,
         data_config=data_config,
         image_processor=image_processor,
         tokenizer=tokenizer,
-        mode=mode
+        mode=mode,
+        cache_dir=cache_dir,
+        token_store_dir=token_store_dir,
+        uint8_output=uint8_output,
+        seed=seed
     )
+    dataset = PromptSegmentDataset(mask_size=mask_size, **dataset_kwargs)
 
-    train_dataset, val_dataset = torch.utils.data.random_split(
-        dataset, 
-        [int(len(dataset) * 0.9), len(dataset) - int(len(dataset) * 0.9)]
-    )
+    # Seeded row order, split and batch order, so a resumed run sees the
+    # same data in the same order
+    train_dataset, val_dataset = train_val_split(dataset, seed)
+    if mask_size != IMAGE_SIZE:
+        # Training is supervised at mask_size, the validation Dice stays at full
+        # resolution. Same seed, so the second instance has the same row order.
+        val_dataset = torch.utils.data.Subset(
+            PromptSegmentDataset(mask_size=IMAGE_SIZE, **dataset_kwargs),
+            val_dataset.indices
+        )
+    if world_size > 1:
+        val_dataset = torch.utils.data.Subset(val_dataset.dataset, val_dataset.indices[rank::world_size])
     
+    if bucket_by_length:
+        # Batches of similar answer length to reduce padding in collate_fn
+        train_sampler = LengthBucketBatchSampler(
+            dataset.answer_lengths()[train_dataset.indices],
+            batch_size=batch_size,
+            max_length=MAX_PROMPT_LENGTH,
+            seed=seed,
+            num_replicas=world_size,
+            rank=rank
+        )
+    else:
+        train_sampler = RandomBatchSampler(
+            len(train_dataset),
+            batch_size=batch_size,
+            seed=seed,
+            num_replicas=world_size,
+            rank=rank
+        )
     train_dataloader = DataLoader(
         train_dataset, 
-        batch_size=batch_size, 
-        shuffle=True, 
+        batch_sampler=train_sampler, 
         collate_fn=collate_fn,
-        num_workers=16,
-        pin_memory=True
+        **loader_kwargs(loader_config, "train")
     )
 
     val_dataset = DataLoader(
@@ -220,8 +451,7 @@ def create_dataloader(
         batch_size=batch_size, 
         shuffle=False, 
         collate_fn=collate_fn,
-        num_workers=4,
-        pin_memory=True
+        **loader_kwargs(loader_config, "val")
     )
     dataloader = {
         "train": train_dataloader,
@@ -0,0 +1,284 @@
+import os
+import json
+import hashlib
+import logging
+import argparse
+import numpy as np
+import torch
+
+# Memory-mapped cache of CLIP vision tower outputs (the mm_projector input at
+# mm_vision_select_layer). The tower is frozen, so its output only depends on
+# the image and the CLIP transform: records are keyed by the sample key of
+# the image and a fingerprint of the transform (feature_key), which batches
+# carry as image_keys to encode_images of the LLaVA model the cache is
+# attached to. expand2square pads non-square images at a random offset, a
+# record holds the features of one draw like the pixels of the tensor cache.
+# Features are stored in the dtype the tower returns them in (the dtype of
+# the pixel values) and are only used when the tower runs with the same
+# weights, layer, compute dtype and autocast state as at precompute time.
+
+FEATURE_CACHE_VERSION = 2
+INDEX_NAME = "index.json"
+SHARD_NAME = "features_{:05d}.bin"
+NUMPY_DTYPES = {torch.float16: np.float16, torch.float32: np.float32}
+
+
+def tower_fingerprint(vision_tower, autocast_dtype=None):
+    params = {
+        "version": FEATURE_CACHE_VERSION,
+        "vision_tower": getattr(vision_tower, "vision_tower_name", type(vision_tower).__name__),
+        "select_layer": getattr(vision_tower, "select_layer", None),
+        "select_feature": getattr(vision_tower, "select_feature", None),
+        "dtype": str(getattr(vision_tower, "dtype", None)),
+        "autocast": str(autocast_dtype),
+    }
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+
+def active_autocast_dtype(device_type):
+    # Autocast dtype active for device_type, None outside autocast
+    if not torch.is_autocast_enabled(device_type):
+        return None
+    return torch.get_autocast_dtype(device_type)
+
+
+def clip_transform_fingerprint(image_processor, data_config):
+    # Hash of the parameters of the CLIP transform of SampleProcessor.process_image
+    if hasattr(image_processor, "to_dict"):
+        processor_params = image_processor.to_dict()
+    else:
+        processor_params = type(image_processor).__name__
+    params = {
+        "image_aspect_ratio": getattr(data_config, "image_aspect_ratio", None),
+        "image_processor": processor_params,
+    }
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def feature_key(sample_key, transform):
+    return hashlib.sha1(f"{transform}:{sample_key}".encode()).hexdigest()
+
+
+def image_keys(images):
+    # Content key of every (3, H, W) pixel tensor of a batch, one host copy
+    # for the whole batch
+    images = images.detach().to("cpu").contiguous()
+    keys = []
+    for image in images:
+        data = image.reshape(-1).view(torch.uint8).numpy()
+        header = f"{tuple(image.shape)}{image.dtype}".encode()
+        keys.append(hashlib.sha1(header + data.tobytes()).hexdigest())
+    return keys
+
+
+def read_index(cache_dir):
+    index_path = os.path.join(cache_dir, INDEX_NAME)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, "r") as f:
+        index = json.load(f)
+    if index.get("version") != FEATURE_CACHE_VERSION:
+        return None
+    return index
+
+
+class VisionFeatureCache:
+    def __init__(self, cache_dir, index):
+        self.cache_dir = cache_dir
+        self.fingerprint = index["fingerprint"]
+        self.dtype = getattr(torch, index["dtype"])
+        self.shape = tuple(index["shape"])
+        self.records_per_shard = index["records_per_shard"]
+        self.entries = index["entries"]
+        self._shards = {}
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def open(cls, cache_dir):
+        index = read_index(cache_dir)
+        if index is None:
+            return None
+        return cls(cache_dir, index)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+
+    def shard(self, shard_id):
+        features = self._shards.get(shard_id)
+        if features is None:
+            features = np.memmap(
+                os.path.join(self.cache_dir, SHARD_NAME.format(shard_id)),
+                dtype=NUMPY_DTYPES[self.dtype],
+                mode="c",
+                shape=(self.records_per_shard,) + self.shape
+            )
+            self._shards[shard_id] = features
+        return features
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        return self.shard(entry[0])[entry[1]]
+
+    def usable(self, images, vision_tower, keys):
+        return (
+            keys is not None
+            and torch.is_tensor(images)
+            and images.ndim == 4
+            and images.dtype == self.dtype
+            and tower_fingerprint(vision_tower, active_autocast_dtype(images.device.type)) == self.fingerprint
+        )
+
+    def encode(self, images, vision_tower, keys=None):
+        # vision_tower(images), with the cached rows read from disk and only
+        # the missing rows run through the tower. keys are the feature_key of
+        # every image, without them the cache is bypassed.
+        if not self.usable(images, vision_tower, keys):
+            self.misses += len(images)
+            return vision_tower(images)
+        cached = [self.get(key) for key in keys]
+        missing = [i for i, features in enumerate(cached) if features is None]
+        self.hits += len(cached) - len(missing)
+        self.misses += len(missing)
+        if len(missing) == len(cached):
+            return vision_tower(images)
+
+        features = torch.empty((len(images),) + self.shape, dtype=images.dtype)
+        for i, record in enumerate(cached):
+            if record is not None:
+                features[i] = torch.from_numpy(record)
+        features = features.to(images.device, non_blocking=True)
+        if missing:
+            missing_index = torch.tensor(missing, device=images.device)
+            features[missing_index] = vision_tower(images[missing_index])
+        return features
+
+
+def precompute_features(dataset, vision_tower, cache_dir, batch_size=32, records_per_shard=1024, autocast_dtype=None):
+    # Run the vision tower over the CLIP input of every image in the dataset
+    # (clip_image and feature_key of every row) and store the outputs, under
+    # autocast_dtype when given: the cache is only used under the same
+    # autocast. Features already in the cache are skipped, a different tower,
+    # layer, dtype or autocast rebuilds the cache.
+    os.makedirs(cache_dir, exist_ok=True)
+    fingerprint = tower_fingerprint(vision_tower, autocast_dtype)
+    device_type = next(vision_tower.parameters()).device.type
+    index = read_index(cache_dir)
+    if index is not None and (index["fingerprint"] != fingerprint or index["records_per_shard"] != records_per_shard):
+        logging.info(f"Vision tower changed, rebuilding feature cache {cache_dir}")
+        index = None
+
+    shards = {}
+    written = 0
+    seen = set()
+    rows = []
+
+    def flush(rows, index):
+        images = torch.stack([image for _, image in rows])
+        with torch.autocast(device_type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+            features = vision_tower(images).to("cpu")
+        if index is None:
+            index = {
+                "version": FEATURE_CACHE_VERSION,
+                "fingerprint": fingerprint,
+                "dtype": str(features.dtype).replace("torch.", ""),
+                "shape": list(features.shape[1:]),
+                "records_per_shard": records_per_shard,
+                "entries": {},
+            }
+        entries = index["entries"]
+        for (key, _), feature in zip(rows, features):
+            slot = len(entries)
+            shard_id = slot // records_per_shard
+            if shard_id not in shards:
+                shard_path = os.path.join(cache_dir, SHARD_NAME.format(shard_id))
+                mode = "r+" if os.path.exists(shard_path) else "w+"
+                shards[shard_id] = np.memmap(
+                    shard_path,
+                    dtype=NUMPY_DTYPES[feature.dtype],
+                    mode=mode,
+                    shape=(records_per_shard,) + tuple(feature.shape)
+                )
+            shards[shard_id][slot % records_per_shard] = feature.numpy()
+            entries[key] = [shard_id, slot % records_per_shard]
+        return index
+
+    for idx in range(len(dataset)):
+        key = dataset.feature_key(idx)
+        if key in seen or (index is not None and key in index["entries"]):
+            continue
+        seen.add(key)
+        rows.append((key, dataset.clip_image(idx)))
+        if len(rows) == batch_size:
+            index = flush(rows, index)
+            written += len(rows)
+            rows = []
+    if rows:
+        index = flush(rows, index)
+        written += len(rows)
+
+    for features in shards.values():
+        features.flush()
+    if index is not None:
+        # Index renamed into place after the shards are on disk
+        index_path = os.path.join(cache_dir, INDEX_NAME)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(index_path + ".tmp", index_path)
+    logging.info(f"Feature cache {cache_dir}: computed {written} of {len(seen)} new images")
+    return written
+
+
+if __name__ == "__main__":
+    from data_utils.dataset import PromptSegmentDataset
+    from data_utils.utils import load_processors
+    from llava.model.multimodal_encoder.clip_encoder import CLIPVisionTower
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--data-path", type=str, required=True)
+    parser.add_argument("--annotation-path", type=str, required=True)
+    parser.add_argument("--feature-cache-dir", type=str, required=True)
+    parser.add_argument("--cache-dir", type=str, default=None)
+    # Compute dtype of the tower during training, LLMSeg runs it in bfloat16
+    parser.add_argument("--dtype", type=str, default="bfloat16")
+    # train() runs the model under float16 autocast, "none" without autocast
+    parser.add_argument("--autocast-dtype", type=str, default="float16")
+    parser.add_argument("--device", type=str, default="cuda:0")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--records-per-shard", type=int, default=1024)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    tokenizer, image_processor, config = load_processors(args.model_path)
+    # The LLaVA checkpoint does not fine-tune the CLIP weights, the tower is
+    # loaded from mm_vision_tower like load_pretrained_model does
+    vision_tower = CLIPVisionTower(config.mm_vision_tower, args=config)
+    vision_tower.to(device=args.device, dtype=getattr(torch, args.dtype))
+    dataset = PromptSegmentDataset(
+        data_path=args.data_path,
+        annotation_path=args.annotation_path,
+        data_config=config,
+        image_processor=image_processor,
+        tokenizer=tokenizer,
+        cache_dir=args.cache_dir
+    )
+    with torch.no_grad():
+        precompute_features(
+            dataset,
+            vision_tower,
+            args.feature_cache_dir,
+            batch_size=args.batch_size,
+            records_per_shard=args.records_per_shard,
+            autocast_dtype=None if args.autocast_dtype == "none" else getattr(torch, args.autocast_dtype)
+        )
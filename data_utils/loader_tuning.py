@@ -0,0 +1,188 @@
+import json
+import time
+import logging
+import argparse
+import itertools
+import torch
+from torch.utils.data import DataLoader
+from data_utils.utils import binary_loader
+from data_utils.dataset import collate_fn, loader_kwargs
+from data_utils.sampler import RandomBatchSampler
+
+# Measures the train loader on the current machine and writes a loader config
+# for create_dataloader(loader_config=...):
+#
+#   python -m data_utils.loader_tuning --model-path ... --data-path ... \
+#       --annotation-path ... --output loader_config.json
+#
+# Stage times are measured in the main process, one sample at a time.
+# Throughput is measured for every combination of worker count, prefetch
+# factor and pin_memory with the real DataLoader.
+
+
+def stage_times(dataset, num_samples=32, batch_size=8):
+    # Mean seconds per sample of decode, transform and tokenize, and per batch
+    # of collate
+    totals = {"decode": 0.0, "transform": 0.0, "tokenize": 0.0, "collate": 0.0}
+    num_samples = min(num_samples, len(dataset))
+    samples = []
+    for idx in range(num_samples):
+        image_path, mask_path, label = dataset.sample_paths(idx)
+        start = time.perf_counter()
+        image_pil = dataset.decode_image(idx, image_path)
+        mask_pil = binary_loader(mask_path)
+        decoded = time.perf_counter()
+        image_tensor, image_sam_tensor, mask_tensor = dataset.image_tensors(image_pil, mask_pil)
+        transformed = time.perf_counter()
+        input_ids, answers_ids = dataset.sample_token_ids(idx)
+        tokenized = time.perf_counter()
+        totals["decode"] += decoded - start
+        totals["transform"] += transformed - decoded
+        totals["tokenize"] += tokenized - transformed
+        samples.append({
+            'input_ids': input_ids,
+            'image_tensor': image_tensor,
+            'mask_tensor': mask_tensor,
+            'answers_ids': answers_ids,
+            "image_sam": image_sam_tensor,
+            "label": label
+        })
+    batches = [samples[i:i + batch_size] for i in range(0, len(samples), batch_size)]
+    for batch in batches:
+        start = time.perf_counter()
+        collate_fn(batch)
+        totals["collate"] += time.perf_counter() - start
+    return {
+        "decode": totals["decode"] / num_samples,
+        "transform": totals["transform"] / num_samples,
+        "tokenize": totals["tokenize"] / num_samples,
+        "collate": totals["collate"] / len(batches),
+    }
+
+
+def measure_loader(dataset, batch_size, num_workers, prefetch_factor, pin_memory, num_batches=20, seed=0):
+    # (samples per second after the first batch, seconds to the first batch)
+    config = {
+        "num_workers": num_workers,
+        "prefetch_factor": prefetch_factor,
+        "pin_memory": pin_memory,
+        "persistent_workers": False,
+    }
+    loader = DataLoader(
+        dataset,
+        batch_sampler=RandomBatchSampler(len(dataset), batch_size=batch_size, seed=seed),
+        collate_fn=collate_fn,
+        **loader_kwargs({"train": config}, "train")
+    )
+    start = time.perf_counter()
+    iterator = iter(loader)
+    next(iterator)
+    first_batch = time.perf_counter()
+    samples = 0
+    for batch in itertools.islice(iterator, num_batches):
+        samples += len(batch["label"])
+    elapsed = time.perf_counter() - first_batch
+    del iterator
+    return samples / max(elapsed, 1e-9), first_batch - start
+
+
+def tune_loader(
+    dataset,
+    batch_size,
+    worker_counts=(0, 4, 8, 16),
+    prefetch_factors=(2, 4),
+    pin_memory_options=None,
+    num_batches=20,
+    tolerance=0.05
+):
+    # Grid results and the recommended config. The recommendation is the
+    # smallest worker count within tolerance of the best throughput, since
+    # idle workers still cost memory and CPU.
+    if pin_memory_options is None:
+        # Pinning only matters for host to device copies
+        pin_memory_options = (True, False) if torch.cuda.is_available() else (False,)
+    results = []
+    for num_workers, prefetch_factor, pin_memory in itertools.product(worker_counts, prefetch_factors, pin_memory_options):
+        if num_workers == 0 and prefetch_factor != prefetch_factors[0]:
+            continue
+        throughput, startup = measure_loader(dataset, batch_size, num_workers, prefetch_factor, pin_memory, num_batches)
+        results.append({
+            "num_workers": num_workers,
+            "prefetch_factor": prefetch_factor,
+            "pin_memory": pin_memory,
+            "samples_per_second": throughput,
+            "startup_seconds": startup,
+        })
+        logging.info(f"Loader workers={num_workers} prefetch={prefetch_factor} pin={pin_memory}: "
+                     f"{throughput:.1f} samples/s, first batch after {startup:.2f}s")
+
+    best = max(result["samples_per_second"] for result in results)
+    candidates = [r for r in results if r["samples_per_second"] >= (1 - tolerance) * best]
+    chosen = min(candidates, key=lambda r: (r["num_workers"], r["prefetch_factor"], -r["samples_per_second"]))
+    train_config = {
+        "num_workers": chosen["num_workers"],
+        "prefetch_factor": chosen["prefetch_factor"],
+        "pin_memory": chosen["pin_memory"],
+        # Train and val loaders alternate every epoch, keeping the workers
+        # alive saves their startup time
+        "persistent_workers": chosen["num_workers"] > 0,
+    }
+    recommendation = {"train": train_config, "val": dict(train_config)}
+    return results, recommendation
+
+
+def format_report(stages, results):
+    lines = ["Stage              ms"]
+    for name, seconds in stages.items():
+        unit = "batch" if name == "collate" else "sample"
+        lines.append(f"{name + ' / ' + unit:<18} {seconds * 1000:.2f}")
+    lines.append("")
+    lines.append(f"{'workers':>8} {'prefetch':>8} {'pin':>5} {'samples/s':>10} {'startup s':>10}")
+    for r in results:
+        lines.append(f"{r['num_workers']:>8} {r['prefetch_factor']:>8} {str(r['pin_memory']):>5} "
+                     f"{r['samples_per_second']:>10.1f} {r['startup_seconds']:>10.2f}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    from data_utils.dataset import PromptSegmentDataset
+    from data_utils.utils import load_processors
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--data-path", type=str, required=True)
+    parser.add_argument("--annotation-path", type=str, required=True)
+    parser.add_argument("--output", type=str, default="loader_config.json")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 4, 8, 16])
+    parser.add_argument("--prefetch", type=int, nargs="+", default=[2, 4])
+    parser.add_argument("--num-batches", type=int, default=20)
+    parser.add_argument("--cache-dir", type=str, default=None)
+    parser.add_argument("--token-store-dir", type=str, default=None)
+    parser.add_argument("--uint8-output", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    tokenizer, image_processor, config = load_processors(args.model_path)
+    dataset = PromptSegmentDataset(
+        data_path=args.data_path,
+        annotation_path=args.annotation_path,
+        data_config=config,
+        image_processor=image_processor,
+        tokenizer=tokenizer,
+        cache_dir=args.cache_dir,
+        token_store_dir=args.token_store_dir,
+        uint8_output=args.uint8_output
+    )
+    stages = stage_times(dataset, batch_size=args.batch_size)
+    results, recommendation = tune_loader(
+        dataset,
+        args.batch_size,
+        worker_counts=args.workers,
+        prefetch_factors=args.prefetch,
+        num_batches=args.num_batches
+    )
+    print(format_report(stages, results))
+    with open(args.output, "w") as f:
+        json.dump(recommendation, f, indent=2)
+    print(f"Recommended loader config written to {args.output}: {recommendation['train']}")
@@ -0,0 +1,135 @@
+from abc import ABC, abstractmethod
+import torch
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class ResumableBatchSampler(Sampler, ABC):
+    # Batch order is a function of (seed, epoch) only, so a run restarted from a
+    # checkpoint rebuilds the interrupted epoch and starts at start_batch without
+    # loading the batches that were already consumed.
+    # With num_replicas > 1 every rank builds the same batches and takes every
+    # num_replicas-th one from rank on. Ranks get the same number of batches:
+    # the first batches are repeated to fill the last round, or the last round
+    # is dropped with drop_last.
+    def __init__(self, num_samples, batch_size, drop_last=False, seed=0, num_replicas=1, rank=0):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch, start_batch=0):
+        self.epoch = epoch
+        self.start_batch = start_batch
+
+    def state_dict(self, consumed_batches):
+        # consumed_batches counts from the start of the epoch, including any
+        # batches skipped on resume
+        return {"seed": self.seed, "epoch": self.epoch, "start_batch": consumed_batches}
+
+    def load_state_dict(self, state):
+        self.seed = state["seed"]
+        self.set_epoch(state["epoch"], state["start_batch"])
+
+    def generator(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return generator
+
+    @abstractmethod
+    def batches(self):
+        # All batches of the epoch, each a sequence of sample indices
+        pass
+
+    def num_batches(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return -(-self.num_samples // self.batch_size)
+
+    def rank_batches(self, batches):
+        if self.num_replicas == 1:
+            return batches
+        if self.drop_last:
+            batches = batches[:len(batches) - len(batches) % self.num_replicas]
+        elif batches and len(batches) % self.num_replicas:
+            padding = self.num_replicas - len(batches) % self.num_replicas
+            batches = batches + (batches * padding)[:padding]
+        return batches[self.rank::self.num_replicas]
+
+    def num_rank_batches(self):
+        if self.drop_last:
+            return self.num_batches() // self.num_replicas
+        return -(-self.num_batches() // self.num_replicas)
+
+    def __iter__(self):
+        return iter(self.rank_batches(self.batches())[self.start_batch:])
+
+    def __len__(self):
+        return max(self.num_rank_batches() - self.start_batch, 0)
+
+
+class RandomBatchSampler(ResumableBatchSampler):
+    # Seeded equivalent of DataLoader(shuffle=True)
+    def batches(self):
+        indices = torch.randperm(self.num_samples, generator=self.generator()).tolist()
+        batches = [indices[i:i + self.batch_size] for i in range(0, self.num_samples, self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        return batches
+
+
+class LengthBucketBatchSampler(ResumableBatchSampler):
+    # Batches of samples with similar lengths. Every epoch the samples are
+    # shuffled, cut into buckets of bucket_size batches, sorted by length inside
+    # each bucket and split into batches; the batch order is shuffled again, so
+    # batches mix across buckets while each batch needs little padding.
+    def __init__(self, lengths, batch_size, bucket_size=64, max_length=None, drop_last=False, seed=0, num_replicas=1, rank=0):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        if max_length is not None:
+            self.lengths = np.minimum(self.lengths, max_length)
+        super().__init__(len(self.lengths), batch_size, drop_last=drop_last, seed=seed, num_replicas=num_replicas, rank=rank)
+        self.bucket_size = bucket_size
+        self.padding_efficiency = None
+
+    def batches(self):
+        generator = self.generator()
+        indices = torch.randperm(len(self.lengths), generator=generator).numpy()
+        chunk = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(indices), chunk):
+            bucket = indices[start:start + chunk]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            for batch_start in range(0, len(bucket), self.batch_size):
+                batches.append(bucket[batch_start:batch_start + self.batch_size])
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        order = torch.randperm(len(batches), generator=generator).tolist()
+        return [batches[i].tolist() for i in order]
+
+    def __iter__(self):
+        batches = self.rank_batches(self.batches())
+        self.padding_efficiency = padding_efficiency(self.lengths, batches)
+        return iter(batches[self.start_batch:])
+
+    def num_batches(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        chunk = self.batch_size * self.bucket_size
+        full, rest = divmod(len(self.lengths), chunk)
+        return full * self.bucket_size + -(-rest // self.batch_size)
+
+
+def padding_efficiency(lengths, batches):
+    # Real tokens over tokens after padding every batch to its longest sample
+    lengths = np.asarray(lengths)
+    real = 0
+    padded = 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        real += batch_lengths.sum()
+        padded += batch_lengths.max() * len(batch_lengths)
+    return float(real) / max(float(padded), 1.0)
@@ -0,0 +1,252 @@
+import io
+import os
+import json
+import random
+import tarfile
+import logging
+import argparse
+import torch
+from PIL import Image
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+from data_utils.dataset import SampleProcessor, collate_fn, train_val_split, loader_kwargs, IMAGE_SIZE
+
+# Sequential tar shards for streaming the training data from network storage.
+# A sample is a run of consecutive members sharing a key:
+#   {key}.image  bytes of the source image file
+#   {key}.mask   bytes of the source mask file
+#   {key}.json   label, prompt token ids and answer token ids
+# Files are stored as they are, decoding and resizing still happen in the
+# loader workers, but a shard is read in one sequential pass instead of three
+# random reads per sample.
+
+SHARD_VERSION = 1
+INDEX_NAME = "shards.json"
+SHARD_NAME = "shard_{:05d}.tar"
+
+
+def read_shard_index(shard_dir):
+    with open(os.path.join(shard_dir, INDEX_NAME), "r") as f:
+        index = json.load(f)
+    if index.get("version") != SHARD_VERSION:
+        raise ValueError(f"Unsupported shard version in {shard_dir}: {index.get('version')}")
+    return index
+
+
+def add_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def write_shards(dataset, indices, shard_dir, samples_per_shard=1000):
+    # Pack the rows `indices` of a PromptSegmentDataset into tar shards. Every
+    # shard is written under a temporary name and renamed when complete.
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = []
+    for shard_id, start in enumerate(range(0, len(indices), samples_per_shard)):
+        name = SHARD_NAME.format(shard_id)
+        tmp_path = os.path.join(shard_dir, name + ".tmp")
+        shard_indices = indices[start:start + samples_per_shard]
+        with tarfile.open(tmp_path, "w") as tar:
+            for position, idx in enumerate(shard_indices):
+                image_path, mask_path, label = dataset.sample_paths(idx)
+                input_ids, answers_ids = dataset.sample_token_ids(idx)
+                key = f"{position:08d}"
+                add_member(tar, key + ".image", read_file(image_path))
+                add_member(tar, key + ".mask", read_file(mask_path))
+                add_member(tar, key + ".json", json.dumps({
+                    "key": dataset.sample_key(idx),
+                    "label": label,
+                    "input_ids": input_ids.reshape(-1).tolist(),
+                    "answers_ids": answers_ids.reshape(-1).tolist(),
+                }).encode())
+        os.replace(tmp_path, os.path.join(shard_dir, name))
+        shards.append({"name": name, "num_samples": len(shard_indices)})
+
+    index_path = os.path.join(shard_dir, INDEX_NAME)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump({"version": SHARD_VERSION, "shards": shards}, f)
+    os.replace(index_path + ".tmp", index_path)
+    logging.info(f"Shards {shard_dir}: wrote {len(indices)} samples to {len(shards)} shards")
+    return shards
+
+
+def convert_dataset(dataset, shard_dir, samples_per_shard=1000, seed=42):
+    # train/ and val/ shards with the same split as create_dataloader(seed=seed)
+    train_dataset, val_dataset = train_val_split(dataset, seed)
+    write_shards(dataset, list(train_dataset.indices), os.path.join(shard_dir, "train"), samples_per_shard)
+    write_shards(dataset, list(val_dataset.indices), os.path.join(shard_dir, "val"), samples_per_shard)
+
+
+def read_shard(path):
+    # Samples of a shard in stored order, as dicts of raw member bytes
+    sample = {}
+    key = None
+    with tarfile.open(path, "r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key, field = member.name.split(".", 1)
+            if key is not None and member_key != key:
+                yield sample
+                sample = {}
+            key = member_key
+            sample[field] = tar.extractfile(member).read()
+    if sample:
+        yield sample
+
+
+class ShardDataset(SampleProcessor, IterableDataset):
+    # Streaming alternative to PromptSegmentDataset over shards written by
+    # write_shards. Each epoch the shard order is shuffled and the shards are
+    # dealt out to the DataLoader workers; each worker then shuffles samples
+    # through a buffer of shuffle_buffer raw samples. Use at least as many
+    # shards as workers, workers without a shard stay idle.
+    def __init__(
+        self,
+        shard_dir,
+        data_config,
+        image_processor,
+        shuffle = True,
+        shuffle_buffer = 1000,
+        uint8_output = False,
+        seed = 0,
+        mask_size = IMAGE_SIZE
+    ):
+        super().__init__(data_config, image_processor, uint8_output=uint8_output, mask_size=mask_size)
+        self.shard_dir = shard_dir
+        self.index = read_shard_index(shard_dir)
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return sum(shard["num_samples"] for shard in self.index["shards"])
+
+    def worker_shards(self):
+        worker = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        shards = [shard["name"] for shard in self.index["shards"]]
+        if self.shuffle:
+            # Same permutation in every worker, each worker takes its own slice
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        return worker_id, shards[worker_id::num_workers]
+
+    def raw_samples(self):
+        worker_id, shards = self.worker_shards()
+        rng = random.Random(f"{self.seed}-{self.epoch}-{worker_id}")
+        buffer = []
+        for name in shards:
+            for sample in read_shard(os.path.join(self.shard_dir, name)):
+                if not self.shuffle:
+                    yield sample
+                elif len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                else:
+                    i = rng.randrange(len(buffer))
+                    yield buffer[i]
+                    buffer[i] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def decode(self, sample):
+        meta = json.loads(sample["json"])
+        image_pil = Image.open(io.BytesIO(sample["image"])).convert("RGB")
+        image_tensor, image_sam_tensor, mask_tensor = self.image_tensors(image_pil, io.BytesIO(sample["mask"]))
+        return {
+            'input_ids': torch.tensor(meta["input_ids"], dtype=torch.int64),
+            'image_tensor': image_tensor,
+            'mask_tensor': mask_tensor,
+            'answers_ids': torch.tensor(meta["answers_ids"], dtype=torch.int64),
+            "image_sam": image_sam_tensor,
+            "label": meta["label"],
+            "image_key": self.clip_feature_key(meta["key"])
+        }
+
+    def __iter__(self):
+        for sample in self.raw_samples():
+            yield self.decode(sample)
+
+
+def create_shard_dataloader(
+    shard_dir,
+    data_config,
+    image_processor,
+    batch_size=2,
+    shuffle_buffer=1000,
+    uint8_output=False,
+    seed=42,
+    mask_size=IMAGE_SIZE,
+    loader_config=None
+):
+    # Same batches as create_dataloader, read from the train/ and val/ shards
+    # of convert_dataset. mask_size only applies to the train loader.
+    train_dataset = ShardDataset(
+        os.path.join(shard_dir, "train"),
+        data_config,
+        image_processor,
+        shuffle_buffer=shuffle_buffer,
+        uint8_output=uint8_output,
+        seed=seed,
+        mask_size=mask_size
+    )
+    val_dataset = ShardDataset(
+        os.path.join(shard_dir, "val"),
+        data_config,
+        image_processor,
+        shuffle=False,
+        uint8_output=uint8_output
+    )
+    train_dataloader = DataLoader(
+        train_dataset,
+        batch_size=batch_size,
+        collate_fn=collate_fn,
+        **loader_kwargs(loader_config, "train")
+    )
+    val_dataloader = DataLoader(
+        val_dataset,
+        batch_size=batch_size,
+        collate_fn=collate_fn,
+        **loader_kwargs(loader_config, "val")
+    )
+    return {
+        "train": train_dataloader,
+        "val": val_dataloader
+    }
+
+
+if __name__ == "__main__":
+    from data_utils.dataset import PromptSegmentDataset
+    from data_utils.utils import load_processors
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--data-path", type=str, required=True)
+    parser.add_argument("--annotation-path", type=str, required=True)
+    parser.add_argument("--shard-dir", type=str, required=True)
+    parser.add_argument("--token-store-dir", type=str, default=None)
+    parser.add_argument("--samples-per-shard", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    tokenizer, image_processor, config = load_processors(args.model_path)
+    dataset = PromptSegmentDataset(
+        data_path=args.data_path,
+        annotation_path=args.annotation_path,
+        data_config=config,
+        image_processor=image_processor,
+        tokenizer=tokenizer,
+        token_store_dir=args.token_store_dir,
+        seed=args.seed
+    )
+    convert_dataset(dataset, args.shard_dir, samples_per_shard=args.samples_per_shard, seed=args.seed)
@@ -0,0 +1,144 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import logging
+import argparse
+import numpy as np
+from llava.constants import IMAGE_TOKEN_INDEX
+from llava.mm_utils import tokenizer_image_token
+from data_utils.utils import prompt_text, answer_text
+from data_utils.cache import LazyMemmaps
+
+# Tokenized prompts and answers of the annotation CSVs. Every sequence field is
+# stored ragged as a flat int32 array of token ids plus int64 offsets, so the
+# ids of row i are values[offsets[i]:offsets[i + 1]].
+
+STORE_VERSION = 1
+FIELDS = ("input_ids", "answers_ids")
+ANNOTATION_COLUMNS = ("image_path", "question", "description", "position")
+
+
+def vocab_hash(tokenizer):
+    vocab = sorted(tokenizer.get_vocab().items())
+    return hashlib.sha1(json.dumps([vocab, tokenizer.bos_token_id]).encode()).hexdigest()
+
+
+def store_path(store_dir, tokenizer):
+    # One sub directory per tokenizer, so a tokenizer change builds a new store
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", str(tokenizer.name_or_path)).strip("_")[-64:]
+    return os.path.join(store_dir, f"{name}-{vocab_hash(tokenizer)[:16]}")
+
+
+def row_keys(annotation):
+    # Content key of every row of an AnnotationIndex, independent of the row order
+    columns = [annotation.columns[name] for name in ANNOTATION_COLUMNS]
+    return np.array(
+        [hashlib.sha1("\x1f".join(values).encode()).hexdigest() for values in zip(*columns)],
+        dtype="<U40"
+    )
+
+
+def build_token_store(path, annotation, tokenizer):
+    keys, rows = np.unique(row_keys(annotation), return_index=True)
+    sequences = {field: [] for field in FIELDS}
+    for row in rows.tolist():
+        question = annotation.get("question", row)
+        description = annotation.get("description", row)
+        position = annotation.get("position", row)
+        sequences["input_ids"].append(
+            tokenizer_image_token(prompt_text(question), tokenizer, IMAGE_TOKEN_INDEX)
+        )
+        sequences["answers_ids"].append(
+            tokenizer_image_token(answer_text(question, description, position), tokenizer, IMAGE_TOKEN_INDEX)
+        )
+
+    # Written to a temporary directory and renamed, so a crashed build never
+    # leaves a partial store behind
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "keys.npy"), keys)
+    for field, values in sequences.items():
+        lengths = np.array([len(v) for v in values], dtype=np.int64)
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat = np.fromiter((i for v in values for i in v), dtype=np.int32, count=int(offsets[-1]))
+        np.save(os.path.join(tmp_path, f"{field}.values.npy"), flat)
+        np.save(os.path.join(tmp_path, f"{field}.offsets.npy"), offsets)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({
+            "version": STORE_VERSION,
+            "tokenizer": str(tokenizer.name_or_path),
+            "vocab_hash": vocab_hash(tokenizer),
+            "num_rows": len(keys),
+        }, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    logging.info(f"Token store {path}: tokenized {len(keys)} annotation rows")
+    return path
+
+
+class TokenStore(LazyMemmaps):
+    closed_memmaps = {"_values": None}
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        keys = np.load(os.path.join(path, "keys.npy"))
+        self.key_to_row = {key: row for row, key in enumerate(keys.tolist())}
+        self.offsets = {field: np.load(os.path.join(path, f"{field}.offsets.npy")) for field in FIELDS}
+        self._values = None
+
+    @classmethod
+    def open_or_build(cls, store_dir, annotation, tokenizer):
+        # Store of the current tokenizer, built when it is missing or does not
+        # cover every annotation row
+        path = store_path(store_dir, tokenizer)
+        if os.path.exists(os.path.join(path, "meta.json")):
+            store = cls(path)
+            if store.meta["version"] == STORE_VERSION and (store.rows(annotation) >= 0).all():
+                return store
+            logging.info(f"Annotations changed, rebuilding token store {path}")
+        os.makedirs(store_dir, exist_ok=True)
+        build_token_store(path, annotation, tokenizer)
+        return cls(path)
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = {
+                field: np.load(os.path.join(self.path, f"{field}.values.npy"), mmap_mode="r")
+                for field in FIELDS
+            }
+        return self._values
+
+    def rows(self, annotation):
+        # Store row of every annotation row, -1 for rows that are not stored
+        return np.array([self.key_to_row.get(key, -1) for key in row_keys(annotation).tolist()], dtype=np.int64)
+
+    def lengths(self, field, rows):
+        offsets = self.offsets[field]
+        return offsets[rows + 1] - offsets[rows]
+
+    def get(self, field, row):
+        offsets = self.offsets[field]
+        return self.values[field][offsets[row]:offsets[row + 1]]
+
+
+if __name__ == "__main__":
+    from data_utils.utils import load_annotation, load_processors, AnnotationIndex
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", type=str, required=True)
+    parser.add_argument("--annotation-path", type=str, required=True)
+    parser.add_argument("--store-dir", type=str, required=True)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    tokenizer, _, _ = load_processors(args.model_path)
+    train_annotation, test_annotation = load_annotation(args.annotation_path)
+    annotation = AnnotationIndex.concat([train_annotation, test_annotation])
+    build_token_store(store_path(args.store_dir, tokenizer), annotation, tokenizer)
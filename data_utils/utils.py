@@ -7,9 +7,88 @@ from PIL import Image
 import requests
 from io import BytesIO
 from sklearn.utils import shuffle
+from llava.constants import DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
 
-def load_annotation(annotation_path):
-    list_df_path = os.listdir(annotation_path)
+# Class label of an image, first keyword found in the image path wins
+LABEL_KEYWORDS = [
+    ("skin", 6),
+    ("breast", 1),
+    ("brain", 0),
+    ("dental", 2),
+    ("lung_CT", 3),
+    ("lung_Xray", 4),
+]
+DEFAULT_LABEL = 3
+TEXT_COLUMNS = ["image_path", "question", "description", "position"]
+
+class StringColumn:
+    # Strings kept as one UTF-8 buffer plus offsets. Unlike a list of Python
+    # strings it is two NumPy arrays, so DataLoader workers forked from the main
+    # process share its pages instead of copying them on refcount updates.
+    def __init__(self, values):
+        encoded = [str(value).encode("utf-8") for value in values]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(np.array([len(value) for value in encoded], dtype=np.int64), out=self.offsets[1:])
+        self.data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+class AnnotationIndex:
+    # Columnar view of the annotation rows: resolved image and mask paths,
+    # integer class labels and the text columns, all indexed by row position
+    def __init__(self, columns, labels):
+        self.columns = columns
+        self.labels = labels
+
+    @classmethod
+    def from_dataframe(cls, df, data_path=""):
+        mask_paths = pd.Series(
+            [os.path.join(data_path, path) for path in df["image_path"].astype(str)], dtype=object
+        ).str.replace("\\", "/", regex=False)
+        image_paths = mask_paths.str.replace("train_masks", "train_images", regex=False)
+        image_paths = image_paths.str.replace("_Segmentation", "", regex=False)
+        isic = image_paths.str.contains("ISIC", regex=False)
+        image_paths = image_paths.where(~isic, image_paths.str.replace(".png", ".jpg", regex=False))
+
+        labels = np.full(len(df), DEFAULT_LABEL, dtype=np.int64)
+        assigned = np.zeros(len(df), dtype=bool)
+        for keyword, label in LABEL_KEYWORDS:
+            found = image_paths.str.contains(keyword, regex=False).to_numpy(dtype=bool) & ~assigned
+            labels[found] = label
+            assigned |= found
+
+        columns = {name: StringColumn(df[name]) for name in TEXT_COLUMNS}
+        columns["mask_path"] = StringColumn(mask_paths)
+        columns["resolved_image_path"] = StringColumn(image_paths)
+        return cls(columns, labels)
+
+    @classmethod
+    def concat(cls, indices):
+        columns = {
+            name: StringColumn([value for index in indices for value in index.columns[name]])
+            for name in indices[0].columns
+        }
+        return cls(columns, np.concatenate([index.labels for index in indices]))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def get(self, name, idx):
+        return self.columns[name][idx]
+
+def load_annotation(annotation_path, data_path="", seed=None):
+    # Train and test AnnotationIndex of all CSVs in annotation_path, image
+    # paths are resolved relative to data_path. A seed makes the row order
+    # reproducible across runs.
+    list_df_path = sorted(os.listdir(annotation_path))
     list_df_path = [os.path.join(annotation_path, df) for df in list_df_path]
     list_df = []
     for df_path in list_df_path:
@@ -20,11 +99,19 @@ def load_annotation(annotation_path):
     df = pd.concat(list_df, ignore_index=True)
     df = df.dropna()
     # df = df.sample(frac=1, random_state=42)
-    df = shuffle(df)
+    df = shuffle(df, random_state=seed)
     df = df.reset_index(drop=True)
     train_df = df[df['split'] == 'train']
     test_df = df[df['split'] == 'test']
-    return train_df, test_df
+    return AnnotationIndex.from_dataframe(train_df, data_path), AnnotationIndex.from_dataframe(test_df, data_path)
+
+def prompt_text(question):
+    # Prompt for the segmentation embedding
+    return "<image> \n" + question
+
+def answer_text(question, prompt, answer):
+    # Conversation used for the language modelling loss
+    return "<image>\n" + f"### User: {question} \n" + "### Assistant: \n" + answer + " " + prompt
 
 def load_image(image_file):
     if image_file.startswith('http://') or image_file.startswith('https://'):
@@ -35,6 +122,26 @@ def load_image(image_file):
     return image
 
 def binary_loader(mask_path):
+    # mask_path is a path, an open binary file or an already decoded image
+    if isinstance(mask_path, Image.Image):
+        return mask_path.convert('L')
+    if hasattr(mask_path, 'read'):
+        return Image.open(mask_path).convert('L')
     with open(mask_path, 'rb') as f:
         img = Image.open(f)
-        return img.convert('L')
\ No newline at end of file
+        return img.convert('L')
+
+def load_processors(model_path):
+    # Tokenizer, CLIP image processor and config of a LLaVA checkpoint without
+    # loading the model weights, for the offline dataset tools
+    from transformers import AutoTokenizer, CLIPImageProcessor
+    from llava.model import LlavaMistralConfig
+    config = LlavaMistralConfig.from_pretrained(model_path)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    # Same token additions as load_pretrained_model
+    if getattr(config, "mm_use_im_patch_token", True):
+        tokenizer.add_tokens([DEFAULT_IMAGE_PATCH_TOKEN], special_tokens=True)
+    if getattr(config, "mm_use_im_start_end", False):
+        tokenizer.add_tokens([DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN], special_tokens=True)
+    image_processor = CLIPImageProcessor.from_pretrained(config.mm_vision_tower)
+    return tokenizer, image_processor, config
@@ -0,0 +1,112 @@
+import os
+import logging
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+from checkpoint import trainable_state_dict
+
+# Data parallel training without DistributedDataParallel: every rank runs the
+# full LLMSeg on its own batches and the gradients of the trainable
+# parameters (LoRA, image encoder, mask decoder, cls head) are averaged with
+# all_reduce before the optimizer step. Frozen weights are never communicated.
+#
+#   torchrun --nproc_per_node 4 train.py
+#
+# Ranks use NCCL on GPUs and gloo on CPU.
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(backend=None, init_method="env://", rank=None, world_size=None):
+    # (rank, world_size, device) of this process. Without torchrun variables
+    # and arguments this is a single process run on cuda:0 or the CPU.
+    rank = int(os.environ.get("RANK", 0)) if rank is None else rank
+    world_size = int(os.environ.get("WORLD_SIZE", 1)) if world_size is None else world_size
+    local_rank = int(os.environ.get("LOCAL_RANK", rank))
+    if backend is None:
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    if backend == "nccl":
+        device = f"cuda:{local_rank}"
+        torch.cuda.set_device(device)
+    else:
+        device = "cpu"
+    if world_size > 1 and not is_distributed():
+        dist.init_process_group(backend, init_method=init_method, rank=rank, world_size=world_size)
+        if rank != 0:
+            # Only rank 0 writes the training log
+            logging.getLogger().setLevel(logging.WARNING)
+    return rank, world_size, device
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def trainable_parameters(model):
+    return [parameter for parameter in model.parameters() if parameter.requires_grad]
+
+
+def broadcast_trainable(model, src=0):
+    # Same trainable weights and buffers on every rank, LoRA and the decoder
+    # are initialized randomly per process
+    tensors = [tensor.data for tensor in trainable_state_dict(model).values()]
+    for bucket in buckets(tensors):
+        flat = _flatten_dense_tensors(bucket)
+        dist.broadcast(flat, src)
+        for tensor, synced in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+            tensor.copy_(synced)
+
+
+def all_reduce_gradients(model, bucket_numel=2 ** 24):
+    # Average the gradients of the trainable parameters over the ranks, in
+    # flat buckets of up to bucket_numel elements. A parameter without a
+    # gradient on this rank contributes zeros, so every rank sends the same
+    # buckets.
+    world_size = get_world_size()
+    if world_size == 1:
+        return
+    grads = []
+    for parameter in trainable_parameters(model):
+        if parameter.grad is None:
+            parameter.grad = torch.zeros_like(parameter)
+        grads.append(parameter.grad)
+    for bucket in buckets(grads, bucket_numel):
+        flat = _flatten_dense_tensors(bucket)
+        dist.all_reduce(flat)
+        flat /= world_size
+        for grad, synced in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+            grad.copy_(synced)
+
+
+def buckets(tensors, bucket_numel=2 ** 24):
+    # Consecutive tensors of one dtype and device, up to bucket_numel elements
+    bucket = []
+    numel = 0
+    for tensor in tensors:
+        if bucket and (
+            numel + tensor.numel() > bucket_numel
+            or tensor.dtype != bucket[0].dtype
+            or tensor.device != bucket[0].device
+        ):
+            yield bucket
+            bucket = []
+            numel = 0
+        bucket.append(tensor)
+        numel += tensor.numel()
+    if bucket:
+        yield bucket
@@ -73,7 +73,9 @@ def infer(
     model,
     tokenizer,
     config,
-    device = "cuda:2"
+    device = "cuda:2",
+    reuse_prefill = False,
+    mask_only = False
 ):
     image_tensor = load_image_for_vlm(image_path, image_processor, config)
     image_tensor_for_sam = transform_for_sam(image_path)
@@ -81,6 +83,11 @@ def infer(
     image_tensor = image_tensor.to(device)
     input_ids = process_prompt(prompt, tokenizer)
     input_ids_for_seg = process_prompt_seg(prompt, tokenizer).to(device)
+    if reuse_prefill:
+        # The mask decoder reads the hidden states of the generation prompt,
+        # captured during generate, instead of a second LLM forward over the
+        # segmentation prompt it was trained on
+        input_ids_for_seg = None
     input_ids = input_ids.to(device)
     # print(input_ids.shape)
     # print(image_tensor.shape)
@@ -91,22 +98,33 @@ def infer(
     # threshold = 0.5
     with autocast(dtype=torch.float16):
         with torch.no_grad():
-            output_mask, output_ids = model.generate(
-                input_ids = input_ids,
-                input_ids_for_seg = input_ids_for_seg,
-                image_tensor_for_vlm = image_tensor,
-                image_tensor_for_image_enc = image_tensor_for_sam,
-                attention_mask = None,
-                temperature=0.2,
-                max_new_tokens=512,
-                top_p=0.95
-            )
-            print(output_mask.shape, output_ids.shape)
-            print(output_ids)
-            print(output_ids[0, input_ids.shape[1]:])
-            print(output_ids[0, :])
-            # outputs = tokenizer.decode(output_ids[0, input_ids.shape[1]:], skip_special_tokens=True)
-            outputs_1 = tokenizer.decode(output_ids[0, :], skip_special_tokens=True)
+            if mask_only:
+                # One forward over the segmentation prompt, no answer text
+                output_mask = model.segment(
+                    input_ids = process_prompt_seg(prompt, tokenizer).to(device),
+                    image_tensor_for_vlm = image_tensor,
+                    image_tensor_for_image_enc = image_tensor_for_sam,
+                    image_keys = [image_path]
+                )
+                outputs_1 = ""
+            else:
+                output_mask, output_ids = model.generate(
+                    input_ids = input_ids,
+                    input_ids_for_seg = input_ids_for_seg,
+                    image_tensor_for_vlm = image_tensor,
+                    image_tensor_for_image_enc = image_tensor_for_sam,
+                    attention_mask = None,
+                    temperature=0.2,
+                    max_new_tokens=512,
+                    top_p=0.95,
+                    image_keys = [image_path]
+                )
+                print(output_mask.shape, output_ids.shape)
+                print(output_ids)
+                print(output_ids[0, input_ids.shape[1]:])
+                print(output_ids[0, :])
+                # outputs = tokenizer.decode(output_ids[0, input_ids.shape[1]:], skip_special_tokens=True)
+                outputs_1 = tokenizer.decode(output_ids[0, :], skip_special_tokens=True)
             # print("Output:", outputs)
             # print("Output 1:", outputs_1)
             res = output_mask.sigmoid().cpu().numpy().squeeze()
@@ -134,6 +152,11 @@ if __name__ == "__main__":
     # image_path = "/home/mamba/ML_project/Testing/Huy/llm_seg/dataset/data/brain_tumors_ct_scan/train_images/2.png"
     # prompt = " CT scan demonstrating a dural-based mass along the convexity suggestive of meningioma."
     results_path = "results/lm_seg_test_3_full_2_ckpt_12"
+    # Masks only, without generating the answers (left empty in the csv)
+    mask_only = False
+    # Mask from the hidden states of the generation prompt, skipping the
+    # second LLM forward over the segmentation prompt the model was trained on
+    reuse_prefill = False
     
     mask_path = results_path + "/masks/"
     if not os.path.exists(results_path):
@@ -169,7 +192,9 @@ if __name__ == "__main__":
                     image_processor,
                     model,
                     tokenizer,
-                    config
+                    config,
+                    reuse_prefill=reuse_prefill,
+                    mask_only=mask_only
                 )
                 mask = mask * 255
                 # mask = mask.astype(np.uint8)
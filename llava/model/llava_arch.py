@@ -14,6 +14,7 @@
 
 
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 import os
 from glob import glob
 
@@ -115,13 +116,56 @@ class LlavaMetaForCausalLM(ABC):
     def get_vision_tower(self):
         return self.get_model().get_vision_tower()
 
-    def encode_images(self, images):
-        image_features = self.get_model().get_vision_tower()(images)
-        image_features = self.get_model().mm_projector(image_features)
+    def encode_images(self, images, image_keys=None):
+        # vision_feature_cache is an optional data_utils.feature_cache.VisionFeatureCache
+        # holding precomputed vision tower outputs, looked up by the
+        # image_keys of the batch
+        vision_tower = self.get_model().get_vision_tower()
+        feature_cache = getattr(self, "vision_feature_cache", None)
+        if feature_cache is not None:
+            image_features = feature_cache.encode(images, vision_tower, image_keys)
+        else:
+            image_features = vision_tower(images)
+        # The tower returns features in the dtype of the images
+        mm_projector = self.get_model().mm_projector
+        image_features = mm_projector(image_features.to(next(mm_projector.parameters()).dtype))
+        return image_features
+
+    def encode_batch_images(self, images, image_keys=None):
+        # Projected features of a batch of images, a list per sample for list or
+        # 5D inputs. Can be computed once and passed as image_features to
+        # several calls on the same images.
+        if type(images) is list or images.ndim == 5:
+            concat_images = torch.cat([image for image in images], dim=0)
+            image_features = self.encode_images(concat_images)
+            split_sizes = [image.shape[0] for image in images]
+            image_features = torch.split(image_features, split_sizes, dim=0)
+            image_features = [x.flatten(0, 1).to(self.device) for x in image_features]
+        else:
+            image_features = self.encode_images(images, image_keys).to(self.device)
         return image_features
 
+    @contextmanager
+    def capture_prefill_hidden_state(self):
+        # Records the output of the final norm (hidden_states[-1]) of the first
+        # forward in the block, which is the prefill over the whole prompt when
+        # the block runs generate(). Cheaper than output_hidden_states, which
+        # keeps every layer of every decoding step.
+        captured = []
+
+        def hook(module, inputs, output):
+            if not captured:
+                captured.append(output)
+
+        handle = self.get_model().norm.register_forward_hook(hook)
+        try:
+            yield captured
+        finally:
+            handle.remove()
+
     def prepare_inputs_labels_for_multimodal(
-        self, input_ids, position_ids, attention_mask, past_key_values, labels, images, image_sizes=None
+        self, input_ids, position_ids, attention_mask, past_key_values, labels, images, image_sizes=None,
+        image_features=None
     ):
         vision_tower = self.get_vision_tower()
         # print(input_ids.shape)
@@ -137,14 +181,8 @@ class LlavaMetaForCausalLM(ABC):
                 position_ids = torch.sum(attention_mask, dim=1).unsqueeze(-1) - 1
             return input_ids, position_ids, attention_mask, past_key_values, None, labels
 
-        if type(images) is list or images.ndim == 5:
-            concat_images = torch.cat([image for image in images], dim=0)
-            image_features = self.encode_images(concat_images)
-            split_sizes = [image.shape[0] for image in images]
-            image_features = torch.split(image_features, split_sizes, dim=0)
-            image_features = [x.flatten(0, 1).to(self.device) for x in image_features]
-        else:
-            image_features = self.encode_images(images).to(self.device)
+        if image_features is None:
+            image_features = self.encode_batch_images(images)
 
         # TODO: image start / end is not implemented here to support pretraining.
         if getattr(self.config, 'tune_mm_mlp_adapter', False) and getattr(self.config, 'mm_use_im_start_end', False):
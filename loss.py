@@ -50,8 +50,16 @@ class BceDiceLoss(nn.Module):
 
         return loss
 
-def structure_loss(pred, mask):
-    weit = 1 + 5 * torch.abs(F.avg_pool2d(mask, kernel_size=31, stride=1, padding=15) - mask)
+def structure_kernel_size(mask_size, base_size=1024, base_kernel=31):
+    # Boundary weighting window of structure_loss, 31 pixels at 1024 and scaled
+    # to cover the same image fraction at other mask sizes (odd, at least 3)
+    kernel_size = round(base_kernel * mask_size / base_size)
+    return max(3, kernel_size // 2 * 2 + 1)
+
+def structure_loss(pred, mask, kernel_size=None):
+    if kernel_size is None:
+        kernel_size = structure_kernel_size(mask.shape[-1])
+    weit = 1 + 5 * torch.abs(F.avg_pool2d(mask, kernel_size=kernel_size, stride=1, padding=kernel_size // 2) - mask)
     wbce = F.binary_cross_entropy_with_logits(pred, mask, reduce='none')
     wbce = (weit * wbce).sum(dim=(2, 3)) / weit.sum(dim=(2, 3))
 
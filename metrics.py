@@ -0,0 +1,33 @@
+import torch
+import torch.distributed as dist
+
+
+class DeviceMetrics:
+    # Running sums of scalar metrics kept on the device. update() only queues
+    # device work; flush() reads all sums back with a single synchronization.
+    def __init__(self, names, device="cuda:0"):
+        self.names = list(names)
+        self.sums = torch.zeros(len(self.names), dtype=torch.float32, device=device)
+        self.count = 0
+
+    def reset(self):
+        self.sums.zero_()
+        self.count = 0
+
+    def update(self, **values):
+        self.sums += torch.stack([values[name].detach().float().reshape(()) for name in self.names])
+        self.count += 1
+
+    def all_reduce(self):
+        # Sums and counts of all ranks, call on every rank before flush()
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        totals = torch.cat([self.sums, self.sums.new_tensor([self.count])])
+        dist.all_reduce(totals)
+        self.sums.copy_(totals[:-1])
+        self.count = int(totals[-1].item())
+
+    def flush(self):
+        # Averages since the last reset, as Python floats
+        sums = self.sums.tolist()
+        return {name: value / max(self.count, 1) for name, value in zip(self.names, sums)}
@@ -1,67 +1,220 @@
 import math
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import torch.nn.functional as F
 from torch.optim.optimizer import Optimizer
 
-class Adam16(Optimizer):
-
-    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=0):
-        defaults = dict(lr=lr, betas=betas, eps=eps,
-                        weight_decay=weight_decay)
-        params = list(params)
-        super(Adam16, self).__init__(params, defaults)
-        # for group in self.param_groups:
-            # for p in group['params']:
-        
-        self.fp32_param_groups = [p.data.float().cuda() for p in params]
-        if not isinstance(self.fp32_param_groups[0], dict):
-            self.fp32_param_groups = [{'params': self.fp32_param_groups}]
 
+def quantize_blockwise(tensor, block_size=256, signed=True):
+    # 8-bit codes of a float tensor, one float32 absmax per block of
+    # block_size values. Values are companded with a square root before
+    # rounding, so small values keep more precision than with a linear code.
+    flat = tensor.reshape(-1).float()
+    padding = -flat.numel() % block_size
+    if padding:
+        flat = F.pad(flat, (0, padding))
+    blocks = flat.view(-1, block_size)
+    absmax = blocks.abs().amax(dim=1, keepdim=True).clamp_min(torch.finfo(torch.float32).tiny)
+    normed = (blocks / absmax).abs_().sqrt_()
+    if signed:
+        codes = normed.mul_(127).round_().mul_(blocks.sign()).to(torch.int8)
+    else:
+        # Rounded up, so a positive second moment never becomes zero
+        codes = normed.mul_(255).ceil_().to(torch.uint8)
+    return codes, absmax.squeeze(1)
+
+
+def dequantize_blockwise(codes, absmax, shape, signed=True):
+    normed = codes.float().div_(127 if signed else 255)
+    values = normed.mul_(normed.abs()).mul_(absmax[:, None])
+    return values.view(-1)[:math.prod(shape)].view(shape)
+
+
+class MixedPrecisionAdamW(Optimizer):
+    # AdamW for float16, bfloat16 and float32 parameters. Low precision
+    # parameters get a float32 master copy in the optimizer state; the update
+    # is computed on the masters in float32 with grouped torch._foreach_ ops
+    # and copied back into the parameters. With quantize_state the moments are
+    # stored 8-bit blockwise quantized (about 2 bytes per parameter for both
+    # instead of 8) and only dequantized for chunks of chunk_numel values
+    # during the step.
+    #
+    # With offload the masters and moments live in (pinned) CPU memory.
+    # step() copies the gradients down and returns; a background thread
+    # updates the masters on the CPU chunk by chunk and copies each chunk back
+    # to the parameters while the next chunk is computed. The update overlaps
+    # with whatever runs until the next zero_grad(), step() or state_dict(),
+    # which wait for it, so the parameters are current before the next forward.
+    def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=1e-2,
+                 quantize_state=False, block_size=256, chunk_numel=2 ** 24, offload=False):
+        defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
+        super().__init__(params, defaults)
+        self.quantize_state = quantize_state
+        self.block_size = block_size
+        self.chunk_numel = chunk_numel
+        self.offload = offload
+        self.pin_memory = offload and torch.cuda.is_available()
+        # Pinned gradient copies, reused to stage the updated parameters
+        self.buffers = {}
+        self.executor = ThreadPoolExecutor(max_workers=1) if offload else None
+        self.pending = None
+
+    def init_state(self, p, state):
+        state['step'] = 0
+        device = 'cpu' if self.offload else p.device
+        if p.dtype != torch.float32 or self.offload:
+            state['master'] = torch.empty(p.shape, dtype=torch.float32, device=device, pin_memory=self.pin_memory)
+            state['master'].copy_(p.detach())
+        zeros = torch.zeros(p.shape, dtype=torch.float32, device=device, pin_memory=self.pin_memory)
+        if self.quantize_state:
+            state['exp_avg'], state['exp_avg_absmax'] = quantize_blockwise(zeros, self.block_size, signed=True)
+            state['exp_avg_sq'], state['exp_avg_sq_absmax'] = quantize_blockwise(zeros, self.block_size, signed=False)
+        else:
+            state['exp_avg'] = zeros
+            state['exp_avg_sq'] = zeros.clone()
+
+    def moments(self, p, state):
+        if 'exp_avg_absmax' not in state:
+            return state['exp_avg'], state['exp_avg_sq']
+        return (
+            dequantize_blockwise(state['exp_avg'], state['exp_avg_absmax'], p.shape, signed=True),
+            dequantize_blockwise(state['exp_avg_sq'], state['exp_avg_sq_absmax'], p.shape, signed=False),
+        )
+
+    def chunks(self, params):
+        chunk = []
+        numel = 0
+        for p in params:
+            if chunk and numel + p.numel() > self.chunk_numel:
+                yield chunk
+                chunk = []
+                numel = 0
+            chunk.append(p)
+            numel += p.numel()
+        if chunk:
+            yield chunk
+
+    @torch.no_grad()
     def step(self, closure=None):
-        """Performs a single optimization step.
-        Arguments:
-            closure (callable, optional): A closure that reevaluates the model
-                and returns the loss.
-        """
+        self.synchronize()
         loss = None
         if closure is not None:
-            loss = closure()
-
-        for group,fp32_group in zip(self.param_groups,self.fp32_param_groups):
-            for p,fp32_p in zip(group['params'],fp32_group['params']):
-                if p.grad is None:
-                    continue
-                    
-                grad = p.grad.data.float()
-                state = self.state[p]
+            with torch.enable_grad():
+                loss = closure()
+
+        if self.offload:
+            self.offload_step()
+            return loss
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None]
+            for chunk in self.chunks(params):
+                masters = self.update(group, chunk, [p.grad for p in chunk])
+                low_precision = [(p, master) for p, master in zip(chunk, masters) if master is not p]
+                if low_precision:
+                    torch._foreach_copy_([p for p, _ in low_precision], [master for _, master in low_precision])
+        return loss
 
-                # State initialization
-                if len(state) == 0:
-                    state['step'] = 0
-                    # Exponential moving average of gradient values
-                    state['exp_avg'] = grad.new().resize_as_(grad).zero_()
-                    # Exponential moving average of squared gradient values
-                    state['exp_avg_sq'] = grad.new().resize_as_(grad).zero_()
+    def offload_step(self):
+        work = []
+        for group in self.param_groups:
+            params = [p for p in group['params'] if p.grad is not None]
+            for p in params:
+                if len(self.state[p]) == 0:
+                    self.init_state(p, self.state[p])
+                buffer = self.buffers.get(p)
+                if buffer is None:
+                    buffer = torch.empty(p.shape, dtype=p.dtype, pin_memory=self.pin_memory)
+                    self.buffers[p] = buffer
+                buffer.copy_(p.grad, non_blocking=True)
+            # Hyperparameters of this step, a scheduler may change them
+            # while the update runs
+            work.append((dict(group), params))
+        copied = None
+        if self.pin_memory:
+            copied = torch.cuda.Event()
+            copied.record()
+        self.pending = self.executor.submit(self.offload_update, work, copied)
 
-                exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
-                beta1, beta2 = group['betas']
+    @torch.no_grad()
+    def offload_update(self, work, copied):
+        if copied is not None:
+            copied.synchronize()
+        for group, params in work:
+            for chunk in self.chunks(params):
+                buffers = [self.buffers[p] for p in chunk]
+                masters = self.update(group, chunk, buffers)
+                torch._foreach_copy_(buffers, masters)
+                for p, buffer in zip(chunk, buffers):
+                    p.copy_(buffer, non_blocking=True)
 
-                state['step'] += 1
+    def synchronize(self):
+        # Wait for the offloaded update of the last step, re-raising its error
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
 
-                if group['weight_decay'] != 0:
-                    grad = grad.add(group['weight_decay'], fp32_p)
+    def zero_grad(self, set_to_none=True):
+        self.synchronize()
+        super().zero_grad(set_to_none)
 
-                # Decay the first and second moment running average coefficient
-                exp_avg.mul_(beta1).add_(1 - beta1, grad)
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
+    def state_dict(self):
+        self.synchronize()
+        return super().state_dict()
 
-                denom = exp_avg_sq.sqrt().add_(group['eps'])
+    def update(self, group, params, grads):
+        # Updates the float32 masters (the parameters themselves when float32
+        # and not offloaded) and returns them
+        beta1, beta2 = group['betas']
+        grads = [grad.float() for grad in grads]
+        masters, exp_avgs, exp_avg_sqs = [], [], []
+        step_sizes, bias_correction2_sqrts = [], []
+        for p in params:
+            state = self.state[p]
+            if len(state) == 0:
+                self.init_state(p, state)
+            state['step'] += 1
+            masters.append(state.get('master', p))
+            exp_avg, exp_avg_sq = self.moments(p, state)
+            exp_avgs.append(exp_avg)
+            exp_avg_sqs.append(exp_avg_sq)
+            step_sizes.append(-group['lr'] / (1 - beta1 ** state['step']))
+            bias_correction2_sqrts.append(math.sqrt(1 - beta2 ** state['step']))
+
+        if group['weight_decay'] != 0:
+            torch._foreach_mul_(masters, 1 - group['lr'] * group['weight_decay'])
+        torch._foreach_lerp_(exp_avgs, grads, 1 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, 1 - beta2)
+        denoms = torch._foreach_sqrt(exp_avg_sqs)
+        torch._foreach_div_(denoms, bias_correction2_sqrts)
+        torch._foreach_add_(denoms, group['eps'])
+        torch._foreach_addcdiv_(masters, exp_avgs, denoms, step_sizes)
+
+        if self.quantize_state:
+            for p, exp_avg, exp_avg_sq in zip(params, exp_avgs, exp_avg_sqs):
+                state = self.state[p]
+                state['exp_avg'], state['exp_avg_absmax'] = quantize_blockwise(exp_avg, self.block_size, signed=True)
+                state['exp_avg_sq'], state['exp_avg_sq_absmax'] = quantize_blockwise(exp_avg_sq, self.block_size, signed=False)
+        return masters
 
-                bias_correction1 = 1 - beta1 ** state['step']
-                bias_correction2 = 1 - beta2 ** state['step']
-                step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
-            
-                # print(type(fp32_p))
-                fp32_p.addcdiv_(-step_size, exp_avg, denom)
-                p.data = fp32_p.half()
+    def load_state_dict(self, state_dict):
+        self.synchronize()
+        super().load_state_dict(state_dict)
+        # Optimizer.load_state_dict casts floating point state to the dtype of
+        # the parameter and moves it to its device, the masters and moments
+        # are restored in float32 and offloaded state stays on the CPU
+        for group, saved_group in zip(self.param_groups, state_dict['param_groups']):
+            for p, index in zip(group['params'], saved_group['params']):
+                for key, value in state_dict['state'].get(index, {}).items():
+                    if torch.is_tensor(value) and (value.is_floating_point() or self.offload):
+                        device = 'cpu' if self.offload else p.device
+                        restored = torch.empty(value.shape, dtype=value.dtype, device=device, pin_memory=self.pin_memory)
+                        self.state[p][key] = restored.copy_(value)
 
-        return loss
\ No newline at end of file
+    def state_bytes(self):
+        return sum(
+            value.numel() * value.element_size()
+            for state in self.state.values()
+            for value in state.values()
+            if torch.is_tensor(value)
+        )
@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import logging
+from contextlib import contextmanager, nullcontext
+import torch
+
+# Opt-in wall-clock and peak memory profile of the training step stages.
+# Stages are timed between CUDA synchronizations, which serializes the GPU
+# with the host: use it to see where step time goes, not for production runs.
+
+
+class StepProfiler:
+    def __init__(self, output_dir=None, device="cuda:0", warmup=5, active=50):
+        # Steps [warmup, warmup + active) are recorded, then the Chrome trace
+        # and the summary are written to output_dir and profiling stops
+        self.enabled = output_dir is not None
+        self.output_dir = output_dir
+        self.cuda = torch.cuda.is_available() and str(device).startswith("cuda")
+        self.device = device
+        self.warmup = warmup
+        self.active = active
+        self.step_index = 0
+        self.events = []
+        self.open_stages = {}
+        self.origin = time.perf_counter_ns()
+
+    @property
+    def recording(self):
+        return self.enabled and self.warmup <= self.step_index < self.warmup + self.active
+
+    def synchronize(self):
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+
+    def start(self, name):
+        if not self.recording:
+            return
+        self.synchronize()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.open_stages[name] = time.perf_counter_ns()
+
+    def stop(self, name):
+        start = self.open_stages.pop(name, None)
+        if start is None:
+            return
+        self.synchronize()
+        end = time.perf_counter_ns()
+        peak = torch.cuda.max_memory_allocated(self.device) / 2 ** 20 if self.cuda else None
+        self.events.append({
+            "name": name,
+            "ph": "X",
+            "ts": (start - self.origin) / 1000,
+            "dur": (end - start) / 1000,
+            "pid": 0,
+            "tid": 0,
+            "args": {"step": self.step_index, "peak_memory_mib": peak},
+        })
+
+    @contextmanager
+    def stage(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def step(self):
+        # Call once at the end of every training step
+        self.step_index += 1
+        if self.enabled and self.step_index == self.warmup + self.active:
+            self.export()
+            self.enabled = False
+
+    def summary(self):
+        stages = {}
+        for event in self.events:
+            stage = stages.setdefault(event["name"], {"calls": 0, "total_ms": 0.0, "peak_memory_mib": None})
+            stage["calls"] += 1
+            stage["total_ms"] += event["dur"] / 1000
+            peak = event["args"]["peak_memory_mib"]
+            if peak is not None:
+                stage["peak_memory_mib"] = max(peak, stage["peak_memory_mib"] or 0.0)
+        return stages
+
+    def format_summary(self):
+        stages = self.summary()
+        total = sum(stage["total_ms"] for stage in stages.values())
+        lines = [f"{'stage':<28} {'calls':>6} {'mean ms':>10} {'total ms':>10} {'share':>7} {'peak MiB':>10}"]
+        for name, stage in sorted(stages.items(), key=lambda item: -item[1]["total_ms"]):
+            peak = stage["peak_memory_mib"]
+            lines.append(
+                f"{name:<28} {stage['calls']:>6} {stage['total_ms'] / stage['calls']:>10.2f} "
+                f"{stage['total_ms']:>10.1f} {stage['total_ms'] / max(total, 1e-9):>7.1%} "
+                f"{'-' if peak is None else f'{peak:.0f}':>10}"
+            )
+        return "\n".join(lines)
+
+    def export(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        trace_path = os.path.join(self.output_dir, "step_trace.json")
+        with open(trace_path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+        summary = self.format_summary()
+        with open(os.path.join(self.output_dir, "step_summary.txt"), "w") as f:
+            f.write(summary + "\n")
+        logging.info(f"Step profile of {self.active} steps written to {trace_path}\n{summary}")
+
+
+def profile_stage(profiler, name):
+    # Stage context of an optional profiler, used inside the model
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name)
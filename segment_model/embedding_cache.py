@@ -0,0 +1,93 @@
+from collections import OrderedDict
+import torch
+import torch.nn.functional as F
+from data_utils.feature_cache import image_keys
+
+# In-memory LRU cache of per-image embeddings for inference, keyed by an
+# image key (one the caller gives, e.g. the image path, or sam_image_keys),
+# so repeated questions about the same scan skip the image encoders. Entries
+# stay on the device they were computed on and the least recently used are
+# evicted once the cached tensors exceed max_bytes. The encoder weights are
+# assumed fixed: clear() after loading other weights or changing their dtype.
+
+KEY_SIZE = 128
+
+
+def tensor_bytes(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+def sam_image_keys(images):
+    # image_keys of the TinySAM input, average pooled on its device to at
+    # most KEY_SIZE x KEY_SIZE before the host copy (3x128x128 of a 1024
+    # input). Unlike the CLIP input, padded at a random offset by
+    # expand2square, it is the same for every load of an image.
+    size = (min(images.shape[-2], KEY_SIZE), min(images.shape[-1], KEY_SIZE))
+    return image_keys(F.adaptive_avg_pool2d(images.detach().float(), size))
+
+
+class EmbeddingCache:
+    def __init__(self, max_bytes=2 * 2 ** 30):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def reset_counters(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        nbytes = tensor_bytes(value)
+        if nbytes > self.max_bytes:
+            return
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.nbytes -= tensor_bytes(previous)
+        self.entries[key] = value
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= tensor_bytes(evicted)
+            self.evictions += 1
+
+    def encode(self, name, images, encoder, keys=None):
+        # encoder(images) for a (B, ...) batch of images, the rows of images
+        # seen before read from the cache and the others encoded in one call.
+        # name keeps the outputs of different encoders apart. keys default to
+        # a hash of the pixels, which copies images to the host.
+        if keys is None:
+            keys = image_keys(images)
+        keys = [f"{name}:{key}" for key in keys]
+        rows = [self.get(key) for key in keys]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        self.hits += len(rows) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            missing_index = torch.tensor(missing, device=images.device)
+            encoded = encoder(images[missing_index]).detach()
+            for i, row in zip(missing, encoded):
+                # Cloned so an entry does not keep the whole batch alive
+                rows[i] = row.clone()
+                self.put(keys[i], rows[i])
+        return torch.stack(rows)
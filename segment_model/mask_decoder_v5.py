@@ -1,6 +1,7 @@
 import torch 
 import torch.nn as nn 
 import torch.nn.functional as F
+import torch.utils.checkpoint as checkpoint
 import numpy as np
 class MaskRefinerWithDeepSupervision(nn.Module):
     def __init__(self):
@@ -254,8 +255,11 @@ class FFN(nn.Module):
         return x
 
 class PromptedMaskDecoder(nn.Module):
-    def __init__(self, prompt_dim=4096, image_dim=256, hidden_dim=512):
+    def __init__(self, prompt_dim=4096, image_dim=256, hidden_dim=512, use_checkpoint=False):
         super().__init__()
+        # Recompute the attention and encoder_layer activations over the
+        # 64x64 image tokens in backward instead of storing them
+        self.use_checkpoint = use_checkpoint
 
         self.prompt_projection = nn.Sequential(
             nn.Linear(prompt_dim, hidden_dim),
@@ -328,15 +332,25 @@ class PromptedMaskDecoder(nn.Module):
 
         # self.decoder = MaskDecoder(image_dim)
 
-    def forward(self, image_feat, prompt_feat):
+    def prompt_attention(self, image_flat, prompt_proj, prompt_padding_mask=None):
+        attn_out, _ = self.attn(image_flat, prompt_proj, prompt_proj, key_padding_mask=prompt_padding_mask)  # (B, H*W, hidden_dim)
+        # print("attn_out nan or inf:", torch.isnan(attn_out).any(), torch.isinf(attn_out).any())
+        return self.norm1(attn_out)
+
+    def forward(self, image_feat, prompt_feat, output_size=None, prompt_mask=None):
         """
-        image_feat: (B, 256, 64, 64) - float32
-        prompt_feat: (B, T, 2048) - float16
+        image_feat: (B, 256, 64, 64) - any float dtype
+        prompt_feat: (B, T, 2048) - any float dtype
+        output_size: side of the returned mask, 16 * H (1024) when None
+        prompt_mask: (B, T) - nonzero for real prompt tokens, padding is not attended
         """
         B, _, H, W = image_feat.shape
         T = prompt_feat.shape[1]
 
-        prompt_feat = prompt_feat.float()
+        # Activations of the LLM and the image encoder in the decoder dtype
+        dtype = self.out_dec.weight.dtype
+        prompt_feat = prompt_feat.to(dtype)
+        image_feat = image_feat.to(dtype)
         # print("prompt_proj before nan or inf:", torch.isnan(prompt_feat).any(), torch.isinf(prompt_feat).any())
         image_identity = image_feat
         # image_feat = self.adapter(image_feat)
@@ -344,12 +358,13 @@ class PromptedMaskDecoder(nn.Module):
         # print("prompt_proj nan or inf:", torch.isnan(prompt_proj).any(), torch.isinf(prompt_proj).any())
         # print("position of nan:", torch.where(torch.isnan(prompt_proj)))
         image_flat = image_feat.flatten(2).transpose(1, 2)  # (B, H*W, hidden_dim)
-        attn_out, _ = self.attn(image_flat, prompt_proj, prompt_proj)  # (B, H*W, hidden_dim)
-        # print("image_proj nan or inf:", torch.isnan(image_feat).any(), torch.isinf(image_feat).any())
-         # (B, H*W, hidden_dim)
-        # print("attn_out nan or inf:", torch.isnan(attn_out).any(), torch.isinf(attn_out).any())
-        attn_out = self.norm1(attn_out)  # (B, H*W, hidden_dim)
-        attn_out = self.encoder_layer(attn_out) 
+        prompt_padding_mask = None if prompt_mask is None else ~prompt_mask.bool()
+        if self.use_checkpoint and torch.is_grad_enabled():
+            attn_out = checkpoint.checkpoint(self.prompt_attention, image_flat, prompt_proj, prompt_padding_mask, use_reentrant=False)
+            attn_out = checkpoint.checkpoint(self.encoder_layer, attn_out, use_reentrant=False)
+        else:
+            attn_out = self.prompt_attention(image_flat, prompt_proj, prompt_padding_mask)  # (B, H*W, hidden_dim)
+            attn_out = self.encoder_layer(attn_out) 
         attn_out = self.ffn(attn_out)  # (B, H*W, hidden_dim)
         attn_map = attn_out.transpose(1, 2).reshape(B, -1, H, W)  # (B, hidden_dim, H, W)
         # print(attn_map.shape)
@@ -364,7 +379,10 @@ class PromptedMaskDecoder(nn.Module):
         attn_map = self.mask_generation(attn_map)  # (B, hidden_dim // 4, H, W)
         # attn_map = self.relu(attn_map)
         mask = self.out_dec(attn_map)  # (B, 1, 128, 128)
-        mask = F.interpolate(mask, scale_factor=16, mode='bilinear', align_corners=True)  # (B, 1, 64, 64)
+        if output_size is None:
+            mask = F.interpolate(mask, scale_factor=16, mode='bilinear', align_corners=True)  # (B, 1, 64, 64)
+        else:
+            mask = F.interpolate(mask, size=(output_size, output_size), mode='bilinear', align_corners=True)
         # image_encoder_mask = F.interpolate(image_identity, scale_factor=16, mode='bilinear', align_corners=True)  # (B, 256, 64, 64)
         # print(mask.shape)
         return mask
@@ -11,7 +11,13 @@ from segment_model.mask_decoder_v5 import PromptedMaskDecoder
 import peft
 from peft import LoraConfig, TaskType, get_peft_model
 from peft import PeftModel
+from peft import load_peft_weights, set_peft_model_state_dict
+from profiler import profile_stage
+from checkpoint import TRAINABLE_NAME, load_trainable_checkpoint
+from segment_model.precision import TRAINING_PRECISION, module_dtype
+from segment_model.embedding_cache import EmbeddingCache, sam_image_keys
 import math 
+import os
 # from segment_anything import sam_model_registry
 
 
@@ -29,7 +35,7 @@ class ImageEncoder(nn.Module):
 
     def forward(self, inputs):
         # with torch.no_grad():
-        return self.image_encoder(inputs)
+        return self.image_encoder(inputs.to(module_dtype(self.image_encoder)))
 
 class LLMSeg(nn.Module):
     def __init__(
@@ -38,7 +44,8 @@ class LLMSeg(nn.Module):
             model_base=None, 
             load_8bit=False, 
             load_4bit=False, 
-            device="cuda:0"
+            device="cuda:0",
+            precision=None
         ):
 
         super(LLMSeg, self).__init__()
@@ -66,8 +73,6 @@ class LLMSeg(nn.Module):
 
         self.model = get_peft_model(self.base_model, lora_config)
         # self.model.to(dtype=torch.float32)
-        if self.training:
-            self.model.to(dtype=torch.bfloat16)
         # else:
         #     self.model.to(dtype=torch.float32)
         # for param in self.model.parameters():
@@ -94,6 +99,13 @@ class LLMSeg(nn.Module):
         torch.nn.init.xavier_uniform_(self.cls[2].weight)
         torch.nn.init.ones_(self.cls[2].bias)
 
+        # Optional profiler.StepProfiler timing the forward stages
+        self.profiler = None
+        # Optional embedding_cache.EmbeddingCache for generate and segment
+        self.embedding_cache = None
+        # Weight dtypes are set once here, forward only casts activations
+        self.apply_precision_policy(precision if precision is not None else TRAINING_PRECISION)
+
         # for param in self.image_encoder.parameters():
             # param.requires_grad = False
 
@@ -107,12 +119,84 @@ class LLMSeg(nn.Module):
         torch.save(self.mask_decoder.state_dict(), save_path + "/mask_decoder.pth")
         torch.save(self.cls.state_dict(), save_path + "/cls.pth")
 
+    def load_trainable_state(self, load_path):
+        # Restore the weights written by save_model or by the checkpoint writer
+        # of train.py to continue training, the LoRA adapter stays unmerged
+        # and trainable
+        print("Resuming model from:", load_path)
+        if os.path.exists(os.path.join(load_path, TRAINABLE_NAME)):
+            load_trainable_checkpoint(self, load_path, device=self.device)
+            return
+        adapter_weights = load_peft_weights(load_path + "/lora_adapter", device=self.device)
+        set_peft_model_state_dict(self.model, adapter_weights)
+        self.image_encoder.load_state_dict(torch.load(load_path + "/image_encoder.pth", map_location=self.device))
+        self.mask_decoder.load_state_dict(torch.load(load_path + "/mask_decoder.pth", map_location=self.device))
+        self.cls.load_state_dict(torch.load(load_path + "/cls.pth", map_location=self.device))
+
+    def apply_precision_policy(self, policy):
+        # segment_model.precision.PrecisionPolicy, e.g. INFERENCE_FP16_PRECISION
+        # after load_model for float16 inference
+        self.precision = policy
+        policy.apply(self.model, self.base_model.get_vision_tower(), self.image_encoder, self.mask_decoder, self.cls)
+        if self.embedding_cache is not None:
+            self.embedding_cache.clear()
+
+    def enable_activation_checkpointing(self, encoder_layers=True, decoder=True):
+        # Trade recompute for activation memory: encoder_layers is a bool for
+        # all TinyViT layers or one per layer, decoder covers the attention
+        # over the image tokens. benchmarks/activation_checkpointing.py
+        # reports the memory and time of each setting.
+        self.image_encoder.image_encoder.set_use_checkpoint(encoder_layers)
+        self.mask_decoder.use_checkpoint = decoder
+
+    def enable_vision_feature_cache(self, cache_dir):
+        # Read CLIP vision tower outputs precomputed by data_utils/feature_cache.py
+        from data_utils.feature_cache import VisionFeatureCache
+        cache = VisionFeatureCache.open(cache_dir)
+        if cache is None:
+            print("No vision feature cache in:", cache_dir)
+            return None
+        print(f"Vision feature cache with {len(cache)} images:", cache_dir)
+        self.base_model.vision_feature_cache = cache
+        return cache
+
+    def enable_embedding_cache(self, max_bytes=2 * 2 ** 30):
+        # LRU cache of the TinySAM embeddings and projected CLIP features of
+        # recently seen images, shared by generate and segment. About 4 MiB
+        # per image for TinySAM (256x64x64 float32) and 4.5 MiB for CLIP
+        # (576x4096 in the 16-bit LLM dtype).
+        self.embedding_cache = EmbeddingCache(max_bytes)
+        return self.embedding_cache
+
+    def encode_inference_images(self, image_tensor_for_vlm, image_tensor_for_image_enc, image_keys=None):
+        # Projected CLIP features and TinySAM embedding of generate and
+        # segment, through the embedding cache when it is enabled. Both
+        # tensors are transforms of the same images and share one key per
+        # image: image_keys when given, otherwise sam_image_keys, the only
+        # host copy of the call.
+        cache = self.embedding_cache
+        if cache is None or not torch.is_tensor(image_tensor_for_vlm) or image_tensor_for_vlm.ndim != 4:
+            return self.model.encode_batch_images(image_tensor_for_vlm), self.image_encoder(image_tensor_for_image_enc)
+        if image_keys is None:
+            image_keys = sam_image_keys(image_tensor_for_image_enc)
+        image_features = cache.encode("clip", image_tensor_for_vlm, self.model.encode_batch_images, image_keys)
+        image_embedding = cache.encode("image_encoder", image_tensor_for_image_enc, self.image_encoder, image_keys)
+        return image_features, image_embedding
+
+    @property
+    def vision_feature_cache(self):
+        return getattr(self.base_model, "vision_feature_cache", None)
+
     def load_model(self, load_path):
         print("Loading model from:", load_path)
-        self.tokenizer = self.tokenizer.from_pretrained(load_path + "/lora_adapter/")
-        self.mask_decoder.load_state_dict(torch.load(load_path + "/mask_decoder.pth"))
-        self.image_encoder.load_state_dict(torch.load(load_path + "/image_encoder.pth"))
-        self.model = PeftModel.from_pretrained(self.model, load_path + "/lora_adapter/")
+        if os.path.exists(os.path.join(load_path, TRAINABLE_NAME)):
+            # Checkpoint of the train.py writer, the tokenizer is unchanged
+            load_trainable_checkpoint(self, load_path, device=self.device)
+        else:
+            self.tokenizer = self.tokenizer.from_pretrained(load_path + "/lora_adapter/")
+            self.mask_decoder.load_state_dict(torch.load(load_path + "/mask_decoder.pth"))
+            self.image_encoder.load_state_dict(torch.load(load_path + "/image_encoder.pth"))
+            self.model = PeftModel.from_pretrained(self.model, load_path + "/lora_adapter/")
         self.model.generation_config.pad_token_id = self.tokenizer.pad_token_id
         # self.model.generation_config.IMAGE_TOKEN_ID = self.tokenizer.IMAGE_TOKEN_ID
         self.mask_decoder.to(self.device)
@@ -120,6 +204,8 @@ class LLMSeg(nn.Module):
         self.model = self.model.merge_and_unload()
         self.image_encoder.eval()
         self.model.eval()
+        if self.embedding_cache is not None:
+            self.embedding_cache.clear()
         return self.tokenizer
     
     def generate(
@@ -131,45 +217,118 @@ class LLMSeg(nn.Module):
         attention_mask = None,
         temperature=0.0001,
         max_new_tokens=512,
-        top_p=0.95
+        top_p=0.95,
+        image_keys=None
     ):
         self.image_encoder.eval()
         self.model.eval()
         self.mask_decoder.eval()
+        # The decoder prompt embedding is the last hidden state of the prompt.
+        # When the segmentation prompt is the generation prompt it is taken
+        # from the prefill of generate() instead of a second forward pass.
+        reuse_prefill = input_ids_for_seg is None or torch.equal(input_ids_for_seg, input_ids)
         with torch.no_grad():
-            output_ids = self.model.generate(
-                inputs = input_ids,
-                images = image_tensor_for_vlm,
-                do_sample=True if temperature > 0 else False,
-                temperature=temperature,
-                max_new_tokens=max_new_tokens,
-                top_p=top_p
+            image_features, image_embedding = self.encode_inference_images(
+                image_tensor_for_vlm, image_tensor_for_image_enc, image_keys
             )
+            with self.base_model.capture_prefill_hidden_state() as prefill:
+                output_ids = self.model.generate(
+                    inputs = input_ids,
+                    images = image_tensor_for_vlm,
+                    image_features = image_features,
+                    do_sample=True if temperature > 0 else False,
+                    temperature=temperature,
+                    max_new_tokens=max_new_tokens,
+                    top_p=top_p
+                )
 
-            image_embedding = self.image_encoder(image_tensor_for_image_enc)
-            # shape_embedding = input_ids.shape[-1]
-            # prompt_embedding = self.model.extract_last_hidden_state(
-            #     input_ids = input_ids,
-            #     images = image_tensor_for_vlm,
-            #     do_sample=False,
-            #     temperature=0,
-            #     max_new_tokens=max_new_tokens,
-            #     top_p=top_p
-            # # )["hidden_states"][-1][:shape_embedding, :]
-            
-            prompt_embedding = self.base_model.extract_last_hidden_state(
-                input_ids = input_ids_for_seg if input_ids_for_seg is not None else input_ids,
-                images = image_tensor_for_vlm,
-                do_sample=False,
-                temperature=0,
-                max_new_tokens=max_new_tokens,
-                top_p=top_p
-            )["hidden_states"][-1]
+            if reuse_prefill:
+                prompt_embedding = prefill[0]
+            else:
+                prompt_embedding = self.base_model.extract_last_hidden_state(
+                    input_ids = input_ids_for_seg,
+                    images = image_tensor_for_vlm,
+                    image_features = image_features
+                )["hidden_states"][-1]
             final_mask = self.mask_decoder(
                 image_embedding, prompt_embedding
             )
         return final_mask, output_ids
 
+    def segment(
+        self,
+        input_ids,
+        image_tensor_for_vlm,
+        image_tensor_for_image_enc,
+        attention_mask=None,
+        output_size=None,
+        image_keys=None
+    ):
+        # Masks of a batch without text generation: a single prefill for the
+        # prompt embeddings, the image encoder and the mask decoder. With an
+        # attention_mask the input_ids may be padded, the decoder does not
+        # attend to the padding. image_keys (one per image, e.g. its path)
+        # are the embedding cache keys, by default a hash of the SAM input.
+        self.image_encoder.eval()
+        self.model.eval()
+        self.mask_decoder.eval()
+        with torch.no_grad():
+            image_features, image_embedding = self.encode_inference_images(
+                image_tensor_for_vlm, image_tensor_for_image_enc, image_keys
+            )
+            outputs = self.model.extract_last_hidden_state(
+                input_ids = input_ids,
+                images = image_tensor_for_vlm,
+                attention_mask = attention_mask,
+                image_features = image_features
+            )
+            final_mask = self.mask_decoder(
+                image_embedding,
+                outputs["hidden_states"][-1],
+                output_size=output_size,
+                prompt_mask=outputs["attention_mask"]
+            )
+        return final_mask
+
+    def segment_prompts(
+        self,
+        prompt_ids,
+        image_tensor_for_vlm,
+        image_tensor_for_image_enc,
+        output_size=None,
+        image_keys=None
+    ):
+        # One mask per prompt for a single image (batch of 1): the image is
+        # encoded once, the prompts (a list of 1D input_ids with the image
+        # token) run through the LLM as one right padded batch and the decoder
+        # gets the image embedding broadcast over the prompts
+        self.image_encoder.eval()
+        self.model.eval()
+        self.mask_decoder.eval()
+        num_prompts = len(prompt_ids)
+        # Padding is dropped by prepare_inputs_labels_for_multimodal, its id
+        # does not matter
+        input_ids = nn.utils.rnn.pad_sequence(prompt_ids, batch_first=True)
+        lengths = torch.tensor([len(ids) for ids in prompt_ids], device=input_ids.device)
+        attention_mask = (torch.arange(input_ids.shape[1], device=input_ids.device) < lengths[:, None]).long()
+        with torch.no_grad():
+            image_features, image_embedding = self.encode_inference_images(
+                image_tensor_for_vlm, image_tensor_for_image_enc, image_keys
+            )
+            outputs = self.model.extract_last_hidden_state(
+                input_ids = input_ids,
+                images = image_tensor_for_vlm.expand(num_prompts, *image_tensor_for_vlm.shape[1:]),
+                attention_mask = attention_mask,
+                image_features = image_features.expand(num_prompts, *image_features.shape[1:])
+            )
+            final_mask = self.mask_decoder(
+                image_embedding.expand(num_prompts, *image_embedding.shape[1:]),
+                outputs["hidden_states"][-1],
+                output_size=output_size,
+                prompt_mask=outputs["attention_mask"]
+            )
+        return final_mask
+
     def forward(self,
         input_ids,
         image_tensor_for_vlm,
@@ -178,44 +337,53 @@ class LLMSeg(nn.Module):
         answers=None,
         temperature=0.0001,
         max_new_tokens=512,
-        top_p=0.95
+        top_p=0.95,
+        mask_size=None,
+        image_keys=None
     ):
-        if self.training:
-            self.model.to(dtype=torch.bfloat16)
-        else:
-            self.model.to(dtype=torch.float16)
+        # Image features are computed once and shared by the prompt pass and
+        # the logit-loss pass instead of running CLIP and mm_projector twice.
+        # image_keys of the batch look the features up in the vision feature cache.
+        with profile_stage(self.profiler, "encode_images"):
+            image_features = self.model.encode_batch_images(image_tensor_for_vlm, image_keys)
 
-        with torch.no_grad():
+        with torch.no_grad(), profile_stage(self.profiler, "extract_last_hidden_state"):
             prompt_embedding = self.model.extract_last_hidden_state(
                 input_ids = input_ids,
                 images = image_tensor_for_vlm,
+                image_features = image_features,
                 do_sample=False,
                 temperature=0,
                 max_new_tokens=max_new_tokens,
                 top_p=top_p
             )["hidden_states"][-1]
 
-        image_embedding = self.image_encoder(image_tensor_for_image_enc)
+        with profile_stage(self.profiler, "image_encoder"):
+            image_embedding = self.image_encoder(image_tensor_for_image_enc)
         # print(image_embedding)
-        output_cls = self.cls(image_embedding)
+        output_cls = self.cls(image_embedding.to(module_dtype(self.cls)))
         # print("Output cls:", output_cls)
-        final_mask = self.mask_decoder(
-            image_embedding, prompt_embedding
-        )
+        with profile_stage(self.profiler, "mask_decoder"):
+            final_mask = self.mask_decoder(
+                image_embedding, prompt_embedding, output_size=mask_size
+            )
         if self.training:
-            logit_loss = self.model(
-                input_ids = answers,
-                attention_mask=attention_mask,
-                images=image_tensor_for_vlm,
-                use_cache = False,
-                labels=answers
-            ).loss
+            with profile_stage(self.profiler, "logit_loss_forward"):
+                logit_loss = self.model(
+                    input_ids = answers,
+                    attention_mask=attention_mask,
+                    images=image_tensor_for_vlm,
+                    image_features=image_features,
+                    use_cache = False,
+                    labels=answers
+                ).loss
             return final_mask, output_cls, logit_loss
         else:
             output = self.model(
                 input_ids = input_ids,
                 attention_mask=attention_mask,
-                images=image_tensor_for_vlm
+                images=image_tensor_for_vlm,
+                image_features=image_features
             )
             return final_mask, output
 
@@ -224,14 +392,16 @@ def build_llm_seg(
         model_base=None, 
         load_8bit=False, 
         load_4bit=False, 
-        device="cuda:0"
+        device="cuda:0",
+        precision=None
 ):
     llm_seg = LLMSeg(
         model_path=model_path,
         model_base=model_base,
         load_8bit=load_8bit,
         load_4bit=load_4bit,
-        device=device
+        device=device,
+        precision=precision
     )
 
     tokenizer, image_processor, context_len, config = llm_seg.get_model_utils()
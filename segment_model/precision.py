@@ -0,0 +1,50 @@
+import torch
+from peft.tuners.lora import LoraLayer
+
+
+class PrecisionPolicy:
+    # Weight dtype of every LLMSeg component. The weights are cast once when
+    # the policy is applied; train()/eval() switches keep them as they are and
+    # only activations are cast where two components meet.
+    def __init__(
+        self,
+        llm=torch.bfloat16,
+        lora=torch.bfloat16,
+        vision_tower=torch.bfloat16,
+        image_encoder=torch.float32,
+        mask_decoder=torch.float32,
+        cls=torch.float32
+    ):
+        self.llm = llm
+        self.lora = lora
+        self.vision_tower = vision_tower
+        self.image_encoder = image_encoder
+        self.mask_decoder = mask_decoder
+        self.cls = cls
+
+    def __repr__(self):
+        dtypes = ", ".join(f"{name}={str(dtype).replace('torch.', '')}" for name, dtype in vars(self).items())
+        return f"PrecisionPolicy({dtypes})"
+
+    def apply(self, llm, vision_tower, image_encoder, mask_decoder, cls):
+        # llm is the PeftModel (or the merged model), the LoRA adapters, the
+        # vision tower and mm_projector inside it are cast separately
+        llm.to(dtype=self.llm)
+        for module in llm.modules():
+            if isinstance(module, LoraLayer):
+                for name in module.adapter_layer_names:
+                    getattr(module, name).to(dtype=self.lora)
+        vision_tower.to(dtype=self.vision_tower)
+        image_encoder.to(dtype=self.image_encoder)
+        mask_decoder.to(dtype=self.mask_decoder)
+        cls.to(dtype=self.cls)
+
+
+def module_dtype(module):
+    return next(module.parameters()).dtype
+
+
+# Default of LLMSeg: bfloat16 LLM with LoRA, float32 segmentation heads
+TRAINING_PRECISION = PrecisionPolicy()
+# float16 LLM for inference on GPUs without bfloat16
+INFERENCE_FP16_PRECISION = PrecisionPolicy(llm=torch.float16, lora=torch.float16, vision_tower=torch.float16)
@@ -0,0 +1,46 @@
+import copy
+
+import torch
+import torch.nn as nn
+
+from segment_model.mask_decoder_v5 import PromptedMaskDecoder
+from tinysam.modeling.tiny_vit_sam import BasicLayer, ConvLayer, PatchMerging
+
+
+def forward_backward(module, *inputs):
+    torch.manual_seed(1)
+    output = module(*inputs)
+    output.float().pow(2).mean().backward()
+    return output.detach(), {name: p.grad.clone() for name, p in module.named_parameters() if p.grad is not None}
+
+
+def assert_same_step(module, *inputs):
+    # Same output, gradients and BatchNorm statistics with checkpointing
+    checkpointed = copy.deepcopy(module)
+    checkpointed.use_checkpoint = True
+    output, grads = forward_backward(module, *inputs)
+    checkpointed_output, checkpointed_grads = forward_backward(checkpointed, *inputs)
+    assert torch.allclose(checkpointed_output, output, atol=1e-6)
+    assert grads.keys() == checkpointed_grads.keys()
+    for name, grad in grads.items():
+        assert torch.allclose(checkpointed_grads[name], grad, atol=1e-6), name
+    for (name, buffer), (_, checkpointed_buffer) in zip(module.named_buffers(), checkpointed.named_buffers()):
+        assert torch.equal(checkpointed_buffer, buffer), name
+
+
+def test_tiny_vit_layers_checkpointing():
+    torch.manual_seed(0)
+    conv_layer = ConvLayer(16, (16, 16), depth=2, activation=nn.GELU, drop_path=0.1,
+                           downsample=PatchMerging, out_dim=32)
+    assert any(isinstance(m, nn.BatchNorm2d) for m in conv_layer.modules())
+    assert_same_step(conv_layer, torch.randn(2, 16, 16, 16))
+
+    basic_layer = BasicLayer(32, (14, 14), depth=2, num_heads=2, window_size=7, drop_path=0.1)
+    assert_same_step(basic_layer, torch.randn(2, 14 * 14, 32))
+
+
+def test_decoder_checkpointing():
+    torch.manual_seed(0)
+    decoder = PromptedMaskDecoder(prompt_dim=64)
+    # encoder_layer dropout is replayed with the same random state
+    assert_same_step(decoder, torch.randn(2, 256, 8, 8), torch.randn(2, 5, 64))
@@ -0,0 +1,52 @@
+import os
+
+import torch
+import torch.nn as nn
+
+from checkpoint import AsyncCheckpointWriter, load_trainable_checkpoint, load_training_state, training_state
+
+
+class TinySegModel(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.frozen = nn.Linear(4, 4)
+        self.frozen.requires_grad_(False)
+        self.encoder = nn.Sequential(nn.Conv2d(3, 4, 3), nn.BatchNorm2d(4))
+        self.head = nn.Linear(4, 2)
+
+
+def test_async_writer_saves_trainable_state(tmp_path):
+    torch.manual_seed(0)
+    model = TinySegModel()
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-3)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=15)
+    model.encoder(torch.randn(2, 3, 5, 5)).sum().backward()
+    optimizer.step()
+
+    save_path = str(tmp_path / "last")
+    writer = AsyncCheckpointWriter()
+    writer.save(save_path, model, training_state(optimizer, scheduler, 1, 7, 8))
+    expected = {name: value.clone() for name, value in model.state_dict().items()}
+    # Every save snapshots the weights of that moment, the last one wins
+    with torch.no_grad():
+        model.head.weight.add_(1)
+    writer.save(save_path, model, training_state(optimizer, scheduler, 1, 9, 10))
+    writer.close()
+    assert sorted(os.listdir(tmp_path)) == ["last"]
+
+    restored = TinySegModel()
+    state = load_trainable_checkpoint(restored, save_path)
+    assert "frozen.weight" not in state
+    assert {"encoder.1.running_mean", "encoder.1.num_batches_tracked", "head.weight"} <= set(state)
+    assert torch.equal(restored.head.weight, expected["head.weight"] + 1)
+    assert torch.equal(restored.encoder[1].running_var, expected["encoder.1.running_var"])
+    assert not torch.equal(restored.frozen.weight, expected["frozen.weight"])
+
+    restored_optimizer = torch.optim.AdamW([p for p in restored.parameters() if p.requires_grad], lr=1e-3)
+    restored_scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(restored_optimizer, T_max=15)
+    resume = load_training_state(save_path, restored_optimizer, restored_scheduler)
+    assert (resume["batch_in_epoch"], resume["global_step"]) == (9, 10)
+    assert torch.equal(
+        restored_optimizer.state_dict()["state"][0]["exp_avg"],
+        optimizer.state_dict()["state"][0]["exp_avg"]
+    )
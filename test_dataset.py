@@ -0,0 +1,272 @@
+import os
+import zlib
+import pickle
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from data_utils.dataset import PromptSegmentDataset, DevicePreprocess, collate_fn
+
+
+class FakeTokenizer:
+    bos_token_id = 1
+
+    def __init__(self, name_or_path="fake-tokenizer"):
+        self.name_or_path = name_or_path
+        self.vocab = {"<unk>": 0, "<s>": 1}
+
+    def get_vocab(self):
+        return dict(self.vocab)
+
+    def __call__(self, text):
+        input_ids = [self.bos_token_id]
+        for word in text.split():
+            input_ids.append(self.vocab.get(word, 2 + zlib.crc32(word.encode()) % 1000))
+        return SimpleNamespace(input_ids=input_ids)
+
+
+class FakeImageProcessor:
+    image_mean = [0.5, 0.5, 0.5]
+
+    def preprocess(self, image, return_tensors="pt"):
+        pixel_values = transforms.ToTensor()(image.resize((32, 32)))
+        return {"pixel_values": [pixel_values]}
+
+
+def write_sample(data_path, name, size=(36, 36)):
+    image_dir = os.path.join(data_path, "lung_CT", "train_images")
+    mask_dir = os.path.join(data_path, "lung_CT", "train_masks")
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(mask_dir, exist_ok=True)
+    rng = np.random.default_rng(len(name))
+    image = rng.integers(0, 255, size=(size[1], size[0], 3), dtype=np.uint8)
+    mask = (rng.random((size[1], size[0])) > 0.5).astype(np.uint8) * 255
+    Image.fromarray(image).save(os.path.join(image_dir, name))
+    Image.fromarray(mask).save(os.path.join(mask_dir, name))
+    return "lung_CT/train_masks/" + name
+
+
+@pytest.fixture
+def dataset_dirs(tmp_path):
+    data_path = str(tmp_path / "data")
+    annotation_path = str(tmp_path / "annotation")
+    os.makedirs(annotation_path)
+    rows = []
+    for i in range(4):
+        rows.append({
+            "image_path": write_sample(data_path, f"{i}.png"),
+            "description": f"nodule number {i} in the left lung",
+            "question": f"where is nodule {i} ?",
+            "position": "left" if i % 2 else "right",
+            "split": "train",
+        })
+    pd.DataFrame(rows).to_csv(os.path.join(annotation_path, "lung_CT.csv"), index=False)
+    return data_path, annotation_path
+
+
+def build_dataset(dataset_dirs, tokenizer=None, **kwargs):
+    data_path, annotation_path = dataset_dirs
+    return PromptSegmentDataset(
+        data_path=data_path,
+        annotation_path=annotation_path,
+        data_config=SimpleNamespace(image_aspect_ratio="pad"),
+        image_processor=FakeImageProcessor(),
+        tokenizer=tokenizer if tokenizer is not None else FakeTokenizer(),
+        **kwargs
+    )
+
+
+def test_getitem_decodes_image_once(dataset_dirs):
+    dataset = build_dataset(dataset_dirs)
+    sample = dataset[0]
+    assert dataset.decode_counter[0] == 1
+    assert sum(dataset.decode_counter.values()) == 1
+    assert sample["image_sam"].shape == (3, 1024, 1024)
+    assert sample["image_tensor"].shape == (3, 32, 32)
+    assert sample["image_tensor"].dtype == torch.float16
+    assert sample["mask_tensor"].shape == (1, 1024, 1024)
+
+
+def test_feature_keys_ignore_random_padding(dataset_dirs):
+    dataset = build_dataset(dataset_dirs)
+    # Non-square: expand2square pads at a random offset
+    image_path, _, _ = dataset.sample_paths(0)
+    Image.new("RGB", (60, 36), (200, 10, 10)).save(image_path)
+    draws = [dataset[0] for _ in range(20)]
+    assert any(not torch.equal(draw["image_tensor"], draws[0]["image_tensor"]) for draw in draws)
+    assert {draw["image_key"] for draw in draws} == {dataset.feature_key(0)}
+    assert len({dataset.feature_key(idx) for idx in range(len(dataset))}) == len(dataset)
+    batch = collate_fn([dataset[0], dataset[1]])
+    assert batch["image_keys"] == [dataset.feature_key(0), dataset.feature_key(1)]
+
+    # Another CLIP transform gets other keys
+    other = build_dataset(dataset_dirs)
+    other.data_config = SimpleNamespace(image_aspect_ratio=None)
+    assert other.feature_key(0) != dataset.feature_key(0)
+
+
+def test_tensor_cache_matches_decode_path(dataset_dirs, tmp_path):
+    from data_utils.cache import compile_dataset
+
+    cache_dir = str(tmp_path / "cache")
+    assert compile_dataset(build_dataset(dataset_dirs), cache_dir, records_per_shard=3) == 4
+    decoded = build_dataset(dataset_dirs)
+    cached = build_dataset(dataset_dirs, cache_dir=cache_dir)
+    cached.annotation = decoded.annotation
+    assert len(cached.cache) == 4
+
+    for idx in range(len(decoded)):
+        expected = decoded[idx]
+        sample = cached[idx]
+        assert torch.equal(sample["image_tensor"], expected["image_tensor"])
+        assert torch.allclose(sample["image_sam"], expected["image_sam"], atol=1e-6)
+        assert torch.equal(sample["mask_tensor"], (expected["mask_tensor"] >= 0.5).float())
+    assert sum(cached.decode_counter.values()) == 0
+    # A DataLoader worker gets the cache without the open memory maps
+    assert cached.cache._shards
+    worker_cache = pickle.loads(pickle.dumps(cached.cache))
+    assert worker_cache._shards == {} and len(worker_cache) == 4
+
+    # A rewritten source image invalidates its record only
+    image_path, _, _ = decoded.sample_paths(0)
+    stat = os.stat(image_path)
+    os.utime(image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    stale = build_dataset(dataset_dirs, cache_dir=cache_dir)
+    assert len(stale.cache) == 3
+    assert decoded.sample_key(0) not in stale.cache
+    assert compile_dataset(stale, cache_dir, records_per_shard=3) == 1
+
+
+def test_token_store_matches_tokenizer(dataset_dirs, tmp_path):
+    store_dir = str(tmp_path / "tokens")
+    tokenizer = FakeTokenizer()
+    dataset = build_dataset(dataset_dirs, tokenizer=tokenizer, token_store_dir=store_dir)
+    for idx in range(len(dataset)):
+        sample = dataset[idx]
+        question, description, position = dataset.sample_text(idx)
+        assert torch.equal(sample["input_ids"], dataset.prompt_process(question))
+        assert torch.equal(sample["answers_ids"], dataset.answer_process(question, description, position))
+    assert (sample["input_ids"] == dataset.IMAGE_TOKEN_INDEX).sum() == 1
+    store = dataset.token_store
+    worker_store = pickle.loads(pickle.dumps(store))
+    assert store._values is not None and worker_store._values is None
+    assert np.array_equal(worker_store.get("input_ids", 0), store.get("input_ids", 0))
+
+    # The same tokenizer reuses the store, a new vocabulary gets its own
+    build_dataset(dataset_dirs, tokenizer=tokenizer, token_store_dir=store_dir)
+    assert len(os.listdir(store_dir)) == 1
+    tokenizer.vocab["<new>"] = len(tokenizer.vocab)
+    build_dataset(dataset_dirs, tokenizer=tokenizer, token_store_dir=store_dir)
+    assert len(os.listdir(store_dir)) == 2
+
+
+def test_uint8_output_matches_float_pipeline(dataset_dirs):
+    dataset = build_dataset(dataset_dirs)
+    uint8_dataset = build_dataset(dataset_dirs, uint8_output=True)
+    uint8_dataset.annotation = dataset.annotation
+
+    expected = collate_fn([dataset[0], dataset[1]])
+    batch = collate_fn([uint8_dataset[0], uint8_dataset[1]])
+    assert batch["image_sam"].dtype == torch.uint8
+    assert batch["mask_tensor"].dtype == torch.uint8
+
+    image_sam, mask = DevicePreprocess()(batch["image_sam"], batch["mask_tensor"])
+    assert torch.allclose(image_sam, expected["image_sam"], atol=1e-5)
+    assert torch.equal(mask, (expected["mask_tensor"] >= 0.5).float())
+
+
+def test_annotation_index_resolves_paths_and_labels():
+    from data_utils.utils import AnnotationIndex
+
+    df = pd.DataFrame({
+        "image_path": [
+            "skin/train_masks/ISIC_0001_Segmentation.png",
+            "breast_tumors/train_masks/3.png",
+            "lung_Xray\\train_masks\\7.png",
+            "polyp/train_masks/1.png",
+        ],
+        "question": ["q0", "q1", "q2", "q3"],
+        "description": ["d0", "d1", "d2", "d3"],
+        "position": ["p0", "p1", "p2", "p3"],
+    })
+    index = AnnotationIndex.from_dataframe(df, "/data")
+    assert index.get("resolved_image_path", 0) == "/data/skin/train_images/ISIC_0001.jpg"
+    assert index.get("mask_path", 0) == "/data/skin/train_masks/ISIC_0001_Segmentation.png"
+    assert index.get("resolved_image_path", 2) == "/data/lung_Xray/train_images/7.png"
+    assert index.labels.tolist() == [6, 1, 4, 3]
+    assert index.get("question", 3) == "q3"
+    assert len(AnnotationIndex.concat([index, index])) == 8
+
+
+def test_shard_dataset_streams_every_sample(dataset_dirs, tmp_path):
+    from torch.utils.data import DataLoader
+    from data_utils.shards import ShardDataset, write_shards
+
+    decoded = build_dataset(dataset_dirs)
+    shard_dir = str(tmp_path / "shards")
+    write_shards(decoded, list(range(len(decoded))), shard_dir, samples_per_shard=1)
+    expected = {}
+    for idx in range(len(decoded)):
+        sample = decoded[idx]
+        expected[tuple(sample["input_ids"].tolist())] = sample
+
+    streamed = ShardDataset(
+        shard_dir,
+        data_config=SimpleNamespace(image_aspect_ratio="pad"),
+        image_processor=FakeImageProcessor(),
+        shuffle_buffer=2,
+        seed=0
+    )
+    assert len(streamed) == 4
+    samples = list(streamed)
+    assert sorted(tuple(s["input_ids"].tolist()) for s in samples) == sorted(expected)
+    for sample in samples:
+        reference = expected[tuple(sample["input_ids"].tolist())]
+        for name in ("image_tensor", "image_sam", "mask_tensor", "answers_ids"):
+            assert torch.equal(sample[name], reference[name])
+        assert sample["label"] == reference["label"]
+
+    # Reshuffled across epochs, every worker reads its own shards
+    order = [tuple(s["input_ids"].tolist()) for s in samples]
+    streamed.set_epoch(1)
+    assert [tuple(s["input_ids"].tolist()) for s in streamed] != order
+    loader = DataLoader(streamed, batch_size=1, num_workers=2, collate_fn=collate_fn)
+    assert sorted(tuple(batch["input_ids"][0].tolist()) for batch in loader) == sorted(expected)
+
+
+def test_low_resolution_masks(dataset_dirs):
+    full = build_dataset(dataset_dirs)
+    low = build_dataset(dataset_dirs, mask_size=256)
+    sample = low[0]
+    assert sample["mask_tensor"].shape == (1, 256, 256)
+    assert sample["image_sam"].shape == (3, 1024, 1024)
+    assert torch.equal(sample["image_sam"], full[0]["image_sam"])
+
+
+def test_loader_tuning_config_feeds_create_dataloader(dataset_dirs, tmp_path):
+    import json
+    from data_utils.dataset import loader_kwargs
+    from data_utils.loader_tuning import stage_times, tune_loader
+
+    dataset = build_dataset(dataset_dirs)
+    stages = stage_times(dataset, num_samples=2, batch_size=2)
+    assert set(stages) == {"decode", "transform", "tokenize", "collate"}
+    assert all(seconds > 0 for seconds in stages.values())
+
+    results, recommendation = tune_loader(dataset, 2, worker_counts=(0,), prefetch_factors=(2, 4), num_batches=1)
+    assert len(results) == 1 and results[0]["samples_per_second"] > 0
+    assert recommendation["train"]["num_workers"] == 0
+
+    config_path = str(tmp_path / "loader_config.json")
+    with open(config_path, "w") as f:
+        json.dump({"train": {"num_workers": 2, "prefetch_factor": 4, "persistent_workers": True}}, f)
+    assert loader_kwargs(config_path, "train") == {
+        "num_workers": 2, "prefetch_factor": 4, "pin_memory": True, "persistent_workers": True
+    }
+    assert loader_kwargs(config_path, "val")["num_workers"] == 4
+    assert loader_kwargs(recommendation, "train") == {"num_workers": 0, "pin_memory": False, "persistent_workers": False}
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, Subset
+
+from data_utils.sampler import LengthBucketBatchSampler, RandomBatchSampler
+from test_train import SyntheticSegDataset, TinyLLMSeg
+
+
+def test_samplers_shard_batches_across_ranks():
+    lengths = np.random.default_rng(0).integers(10, 400, size=100)
+    for make in (lambda **kwargs: RandomBatchSampler(len(lengths), batch_size=8, seed=3, **kwargs),
+                 lambda **kwargs: LengthBucketBatchSampler(lengths, batch_size=8, bucket_size=4, seed=3, **kwargs)):
+        batches = list(make())
+        ranks = [list(make(num_replicas=3, rank=rank)) for rank in range(3)]
+        # 13 batches: every rank gets 5, batches 0 and 1 fill the last round
+        assert [len(rank_batches) for rank_batches in ranks] == [5, 5, 5]
+        assert [len(make(num_replicas=3, rank=rank)) for rank in range(3)] == [5, 5, 5]
+        assert ranks[0] == batches[0::3]
+        assert ranks[1][-1] == batches[0] and ranks[2][-1] == batches[1]
+
+        dropped = [list(make(num_replicas=3, rank=rank, drop_last=True)) for rank in range(3)]
+        assert all(len(rank_batches) == len(dropped[0]) for rank_batches in dropped)
+
+
+def train_rank(rank, world_size, init_file, save_dir, result_path):
+    from distributed import init_distributed, cleanup_distributed
+    from train import train, evaluate
+
+    init_distributed(backend="gloo", init_method=f"file://{init_file}", rank=rank, world_size=world_size)
+    # Different initial weights per rank, train() starts from those of rank 0
+    torch.manual_seed(rank)
+    model = TinyLLMSeg().double()
+    dataset = SyntheticSegDataset(8)
+    loaders = {
+        "train": DataLoader(dataset, batch_sampler=RandomBatchSampler(8, batch_size=2, seed=1, num_replicas=world_size, rank=rank)),
+        "val": DataLoader(Subset(dataset, list(range(rank, 8, world_size))), batch_size=1),
+    }
+    optimizer = torch.optim.SGD(model.parameters(), lr=1.0)
+    train(model, loaders, optimizer, num_epochs=1, device="cpu", save_dir=save_dir, checkpoint_every=0, max_grad_norm=100.0)
+    dice = evaluate(model, loaders["val"], device="cpu")
+    torch.save({"state": model.state_dict(), "dice": dice}, result_path.format(rank))
+    cleanup_distributed()
+
+
+def test_distributed_training_matches_accumulation(tmp_path):
+    from train import train, evaluate
+
+    save_dir = str(tmp_path / "distributed")
+    result_path = str(tmp_path / "rank{}.pt")
+    mp.spawn(train_rank, args=(2, str(tmp_path / "init"), save_dir, result_path), nprocs=2)
+    ranks = [torch.load(result_path.format(rank)) for rank in range(2)]
+
+    # Two ranks with batches of 2 take the same steps as one process
+    # accumulating two batches of 2 in the same order
+    torch.manual_seed(0)
+    model = TinyLLMSeg().double()
+    dataset = SyntheticSegDataset(8)
+    loaders = {
+        "train": DataLoader(dataset, batch_sampler=RandomBatchSampler(8, batch_size=2, seed=1)),
+        "val": DataLoader(dataset, batch_size=1),
+    }
+    optimizer = torch.optim.SGD(model.parameters(), lr=1.0)
+    train(model, loaders, optimizer, num_epochs=1, device="cpu", save_dir=str(tmp_path / "single"),
+          checkpoint_every=0, accumulation_steps=2, max_grad_norm=100.0)
+    dice = evaluate(model, loaders["val"], device="cpu")
+
+    for result in ranks:
+        for name, value in model.state_dict().items():
+            assert torch.allclose(result["state"][name], value, atol=1e-10), name
+        # Val Dice over the samples of both ranks
+        assert abs(result["dice"] - dice) < 1e-6
+    # Only rank 0 writes checkpoints
+    assert os.listdir(save_dir) == ["llm_seg_1"]
@@ -0,0 +1,194 @@
+import random
+from types import SimpleNamespace
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+from torchvision import transforms
+from transformers import CLIPImageProcessor
+
+from llava.constants import IMAGE_TOKEN_INDEX
+from llava.mm_utils import process_images
+from data_utils.feature_cache import image_keys
+import segment_model.model
+from segment_model.embedding_cache import EmbeddingCache, sam_image_keys
+from segment_model.mask_decoder_v5 import PromptedMaskDecoder
+from segment_model.model import LLMSeg
+from test_multimodal import tiny_llava
+
+
+def tiny_llm_seg():
+    # LLMSeg around tiny_llava without loading pretrained weights
+    model = LLMSeg.__new__(LLMSeg)
+    nn.Module.__init__(model)
+    model.base_model = tiny_llava()
+    model.model = model.base_model
+    model.image_encoder = nn.Conv2d(3, 8, 3, padding=1)
+    model.mask_decoder = PromptedMaskDecoder(prompt_dim=32, image_dim=8, hidden_dim=16)
+    model.mask_decoder.encoder_layer = nn.TransformerEncoderLayer(d_model=8, nhead=2, batch_first=True, dim_feedforward=16)
+    model.cls = nn.Sequential(nn.AdaptiveAvgPool2d((1, 1)), nn.Flatten(), nn.Linear(8, 7))
+    model.profiler = None
+    model.embedding_cache = None
+    return model.eval()
+
+
+def count_llm_forwards(model):
+    calls = []
+    model.base_model.get_model().norm.register_forward_hook(lambda *args: calls.append(1))
+    return calls
+
+
+def test_generate_reuses_prefill_hidden_states():
+    model = tiny_llm_seg()
+    images = torch.randn(2, 3, 8, 8)
+    image_sam = torch.randn(2, 3, 4, 4)
+    input_ids = torch.tensor([[1, IMAGE_TOKEN_INDEX, 5, 6], [1, IMAGE_TOKEN_INDEX, 7, 8]])
+    seg_ids = torch.tensor([[1, IMAGE_TOKEN_INDEX, 9, 6], [1, IMAGE_TOKEN_INDEX, 9, 8]])
+    calls = count_llm_forwards(model)
+
+    mask, output_ids = model.generate(input_ids, images, image_sam, temperature=0, max_new_tokens=3)
+    # One prefill and two decoding steps, no separate forward for the mask
+    assert len(calls) == 3 and output_ids.shape == (2, 3)
+    hidden = model.base_model.extract_last_hidden_state(input_ids=input_ids, images=images)["hidden_states"][-1]
+    assert torch.allclose(mask, model.mask_decoder(model.image_encoder(image_sam), hidden), atol=1e-6)
+
+    calls.clear()
+    same_mask, same_ids = model.generate(input_ids, images, image_sam, input_ids_for_seg=input_ids.clone(), temperature=0, max_new_tokens=3)
+    assert len(calls) == 3 and torch.equal(same_ids, output_ids) and torch.allclose(same_mask, mask, atol=1e-6)
+
+    # A different segmentation prompt still gets its own forward
+    calls.clear()
+    seg_mask, _ = model.generate(input_ids, images, image_sam, input_ids_for_seg=seg_ids, temperature=0, max_new_tokens=3)
+    assert len(calls) == 4
+    hidden = model.base_model.extract_last_hidden_state(input_ids=seg_ids, images=images)["hidden_states"][-1]
+    assert torch.allclose(seg_mask, model.mask_decoder(model.image_encoder(image_sam), hidden), atol=1e-6)
+
+
+def test_segment_padded_batch_matches_single_prompts():
+    model = tiny_llm_seg()
+    images = torch.randn(2, 3, 8, 8)
+    image_sam = torch.randn(2, 3, 4, 4)
+    prompts = [torch.tensor([1, IMAGE_TOKEN_INDEX, 5, 6, 7]), torch.tensor([1, IMAGE_TOKEN_INDEX, 8])]
+    input_ids = torch.nn.utils.rnn.pad_sequence(prompts, batch_first=True)
+    attention_mask = torch.tensor([[1, 1, 1, 1, 1], [1, 1, 1, 0, 0]])
+    calls = count_llm_forwards(model)
+
+    masks = model.segment(input_ids, images, image_sam, attention_mask=attention_mask, output_size=16)
+    assert len(calls) == 1 and masks.shape == (2, 1, 16, 16)
+    for i, prompt in enumerate(prompts):
+        single = model.segment(prompt[None], images[i:i + 1], image_sam[i:i + 1], output_size=16)
+        assert torch.allclose(masks[i], single[0], atol=1e-5)
+    generated, _ = model.generate(prompts[1][None], images[1:], image_sam[1:], temperature=0, max_new_tokens=2)
+    assert torch.allclose(model.segment(prompts[1][None], images[1:], image_sam[1:]), generated, atol=1e-6)
+
+
+def test_embedding_cache_lru():
+    cache = EmbeddingCache(max_bytes=3 * 4 * 4)
+    encoder_calls = []
+
+    def encoder(images):
+        encoder_calls.append(len(images))
+        return images.flatten(1)[:, :4] * 2
+
+    images = torch.randn(4, 1, 2, 2)
+    assert torch.equal(cache.encode("a", images[:2], encoder), images[:2].flatten(1) * 2)
+    # Row 1 cached, row 2 encoded alone
+    assert torch.equal(cache.encode("a", images[1:3], encoder), images[1:3].flatten(1) * 2)
+    assert encoder_calls == [2, 1] and (cache.hits, cache.misses, cache.evictions) == (1, 3, 0)
+    # Another encoder does not share entries
+    cache.encode("b", images[:1], encoder)
+    assert cache.misses == 4
+    # Four rows of 16 bytes over a bound of 48, the least recently used goes
+    assert cache.evictions == 1 and cache.nbytes == 48 and len(cache) == 3
+    cache.encode("a", images[1:3], encoder)
+    assert encoder_calls == [2, 1, 1]
+    cache.encode("a", images[:1], encoder)
+    assert encoder_calls == [2, 1, 1, 1] and cache.evictions == 2
+
+
+def test_embedding_cache_shared_by_generate_and_segment():
+    model = tiny_llm_seg()
+    cache = model.enable_embedding_cache()
+    tower = model.base_model.get_model().vision_tower
+    sam_calls = []
+    model.image_encoder.register_forward_hook(lambda *args: sam_calls.append(1))
+    images = torch.randn(1, 3, 8, 8)
+    image_sam = torch.randn(1, 3, 4, 4)
+    input_ids = torch.tensor([[1, IMAGE_TOKEN_INDEX, 5, 6]])
+
+    mask, _ = model.generate(input_ids, images, image_sam, temperature=0, max_new_tokens=2)
+    assert torch.allclose(model.segment(input_ids, images, image_sam), mask, atol=1e-6)
+    model.segment(torch.tensor([[1, IMAGE_TOKEN_INDEX, 7]]), images, image_sam)
+    assert tower.calls == 1 and len(sam_calls) == 1
+    assert (cache.hits, cache.misses) == (4, 2)
+
+    model.embedding_cache = None
+    assert torch.allclose(model.segment(input_ids, images, image_sam), mask, atol=1e-6)
+
+
+def test_embedding_cache_hashes_sam_input_once(monkeypatch):
+    model = tiny_llm_seg()
+    cache = model.enable_embedding_cache()
+    hashed = []
+
+    def counting_keys(images):
+        hashed.append(images.shape)
+        return sam_image_keys(images)
+
+    monkeypatch.setattr(segment_model.model, "sam_image_keys", counting_keys)
+    images = torch.randn(1, 3, 8, 8)
+    image_sam = torch.randn(1, 3, 4, 4)
+    input_ids = torch.tensor([[1, IMAGE_TOKEN_INDEX, 5, 6]])
+
+    mask = model.segment(input_ids, images, image_sam)
+    # One hash of the SAM input, shared by the CLIP features
+    assert hashed == [image_sam.shape]
+    key = sam_image_keys(image_sam)[0]
+    assert set(cache.entries) == {f"clip:{key}", f"image_encoder:{key}"}
+
+    # Keys given by the caller skip the hash
+    hashed.clear()
+    assert torch.allclose(model.segment(input_ids, images, image_sam, image_keys=["scan.png"]), mask, atol=1e-6)
+    assert torch.allclose(model.segment(input_ids, images, image_sam, image_keys=["scan.png"]), mask, atol=1e-6)
+    assert hashed == [] and (cache.hits, cache.misses) == (2, 4)
+
+
+def test_embedding_cache_hits_non_square_images():
+    model = tiny_llm_seg()
+    cache = model.enable_embedding_cache()
+    image_processor = CLIPImageProcessor(size={"shortest_edge": 8}, crop_size={"height": 8, "width": 8})
+    config = SimpleNamespace(image_aspect_ratio="pad")
+    sam_transform = transforms.Compose([transforms.Resize((16, 16)), transforms.ToTensor()])
+    image = Image.fromarray(np.random.RandomState(0).randint(0, 255, (20, 30, 3), dtype=np.uint8))
+    input_ids = torch.tensor([[1, IMAGE_TOKEN_INDEX, 5, 6]])
+
+    random.seed(0)
+    clip_inputs = [process_images([image], image_processor, config) for _ in range(8)]
+    # expand2square pads at a random offset, the CLIP input of the image varies
+    assert len(set(image_keys(torch.cat(clip_inputs)))) == 2
+    model.generate(input_ids, clip_inputs[0], sam_transform(image)[None], temperature=0, max_new_tokens=2)
+    for images in clip_inputs[1:]:
+        model.segment(input_ids, images, sam_transform(image)[None])
+    # Hits on both encoders for every call after the first
+    assert (cache.hits, cache.misses) == (14, 2) and len(cache) == 2
+
+
+def test_segment_prompts_matches_one_call_per_prompt():
+    model = tiny_llm_seg()
+    tower = model.base_model.get_model().vision_tower
+    sam_calls = []
+    model.image_encoder.register_forward_hook(lambda *args: sam_calls.append(1))
+    images = torch.randn(1, 3, 8, 8)
+    image_sam = torch.randn(1, 3, 4, 4)
+    prompts = [
+        torch.tensor([1, IMAGE_TOKEN_INDEX, 5, 6, 7]),
+        torch.tensor([1, IMAGE_TOKEN_INDEX, 8]),
+        torch.tensor([IMAGE_TOKEN_INDEX, 9, 10, 11]),
+    ]
+    calls = count_llm_forwards(model)
+
+    masks = model.segment_prompts(prompts, images, image_sam, output_size=16)
+    assert masks.shape == (3, 1, 16, 16)
+    assert len(calls) == 1 and tower.calls == 1 and len(sam_calls) == 1
+    for prompt, mask in zip(prompts, masks):
+        assert torch.allclose(model.segment(prompt[None], images, image_sam, output_size=16)[0], mask, atol=1e-5)
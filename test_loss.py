@@ -0,0 +1,29 @@
+import torch
+
+from loss import structure_loss, structure_kernel_size
+from segment_model.mask_decoder_v5 import PromptedMaskDecoder
+
+
+def test_structure_kernel_scales_with_mask_size():
+    assert structure_kernel_size(1024) == 31
+    assert structure_kernel_size(512) == 17
+    assert structure_kernel_size(256) == 9
+    assert structure_kernel_size(32) == 3
+
+    mask = (torch.rand(2, 1, 64, 64) > 0.5).float()
+    pred = torch.randn(2, 1, 64, 64)
+    assert torch.equal(structure_loss(pred, mask), structure_loss(pred, mask, kernel_size=3))
+
+
+def test_decoder_output_size():
+    torch.manual_seed(0)
+    decoder = PromptedMaskDecoder().eval()
+    image_feat = torch.randn(1, 256, 8, 8)
+    prompt_feat = torch.randn(1, 5, 4096)
+    with torch.no_grad():
+        full = decoder(image_feat, prompt_feat)
+        low = decoder(image_feat, prompt_feat, output_size=32)
+        same = decoder(image_feat, prompt_feat, output_size=128)
+    assert full.shape == (1, 1, 128, 128)
+    assert low.shape == (1, 1, 32, 32)
+    assert torch.allclose(same, full)
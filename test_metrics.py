@@ -0,0 +1,17 @@
+import torch
+
+from metrics import DeviceMetrics
+
+
+def test_device_metrics_average_until_reset():
+    metrics = DeviceMetrics(["loss", "cls_loss"], device="cpu")
+    for step in range(4):
+        loss = torch.tensor(float(step), requires_grad=True) * 2
+        metrics.update(loss=loss, cls_loss=torch.tensor([1.0]))
+    assert metrics.flush() == {"loss": 3.0, "cls_loss": 1.0}
+    assert metrics.count == 4
+
+    metrics.reset()
+    assert metrics.flush() == {"loss": 0.0, "cls_loss": 0.0}
+    metrics.update(loss=torch.tensor(5.0, dtype=torch.float16), cls_loss=torch.tensor(2.0))
+    assert metrics.flush() == {"loss": 5.0, "cls_loss": 2.0}
@@ -0,0 +1,131 @@
+import torch
+import torch.nn as nn
+
+from llava.constants import IMAGE_TOKEN_INDEX
+from llava.model.language_model.llava_mistral import LlavaMistralForCausalLM, LlavaMistralConfig
+
+
+class CountingVisionTower(nn.Module):
+    # (B, 3, 4p, 4p) images to 16 patch features of size 12, returned in the
+    # dtype of the images like CLIPVisionTower
+    vision_tower_name = "counting"
+    select_layer = -2
+    select_feature = "patch"
+
+    def __init__(self, patch_size=2):
+        super().__init__()
+        self.patch_size = patch_size
+        self.proj = nn.Linear(3 * patch_size * patch_size, 12)
+        self.calls = 0
+
+    @property
+    def dtype(self):
+        return self.proj.weight.dtype
+
+    @torch.no_grad()
+    def forward(self, images):
+        self.calls += 1
+        p = self.patch_size
+        patches = images.unfold(2, p, p).unfold(3, p, p).permute(0, 2, 3, 1, 4, 5).flatten(3).flatten(1, 2)
+        return self.proj(patches.to(self.dtype)).to(images.dtype)
+
+
+def tiny_llava():
+    torch.manual_seed(0)
+    config = LlavaMistralConfig(
+        vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=64
+    )
+    model = LlavaMistralForCausalLM(config).eval()
+    model.get_model().vision_tower = CountingVisionTower(patch_size=2)
+    model.get_model().mm_projector = nn.Linear(12, 32)
+    return model
+
+
+def test_precomputed_image_features_match():
+    model = tiny_llava()
+    tower = model.get_model().vision_tower
+    images = torch.randn(2, 3, 8, 8)
+    input_ids = torch.tensor([[1, IMAGE_TOKEN_INDEX, 5, 6], [1, IMAGE_TOKEN_INDEX, 7, 0]])
+    answers = torch.tensor([[1, IMAGE_TOKEN_INDEX, 5, 6, 9, 10], [1, IMAGE_TOKEN_INDEX, 7, 11, 0, 0]])
+    attention_mask = (answers != 0).long()
+
+    hidden = model.extract_last_hidden_state(input_ids=input_ids, images=images)["hidden_states"][-1]
+    loss = model(input_ids=answers, attention_mask=attention_mask, images=images, labels=answers).loss
+    assert tower.calls == 2
+
+    tower.calls = 0
+    image_features = model.encode_batch_images(images)
+    shared_hidden = model.extract_last_hidden_state(
+        input_ids=input_ids, images=images, image_features=image_features
+    )["hidden_states"][-1]
+    shared_loss = model(
+        input_ids=answers, attention_mask=attention_mask, images=images, image_features=image_features, labels=answers
+    ).loss
+    assert tower.calls == 1
+    assert torch.equal(shared_hidden, hidden)
+    assert torch.equal(shared_loss, loss)
+
+
+def test_vision_feature_cache(tmp_path):
+    from data_utils.feature_cache import VisionFeatureCache, precompute_features
+
+    class ImageDataset:
+        def __init__(self, images, keys):
+            self.images = images
+            self.keys = keys
+
+        def __len__(self):
+            return len(self.images)
+
+        def clip_image(self, idx):
+            return self.images[idx]
+
+        def feature_key(self, idx):
+            return self.keys[idx]
+
+    model = tiny_llava()
+    model.get_model().vision_tower = CountingVisionTower(patch_size=8)
+    tower = model.get_model().vision_tower
+    images = torch.randn(4, 3, 32, 32)
+    keys = ["a", "b", "c", "d"]
+    # Cached features are only used under the autocast they were computed in
+    autocast = lambda: torch.autocast("cpu", dtype=torch.bfloat16)
+    with autocast():
+        expected = tower(images)
+    assert not torch.equal(expected, tower(images))
+
+    cache_dir = str(tmp_path / "features")
+    # Repeated rows share one record
+    dataset = ImageDataset([images[0], images[1], images[0]], ["a", "b", "a"])
+    assert precompute_features(dataset, tower, cache_dir, batch_size=2, autocast_dtype=torch.bfloat16) == 2
+    cache = VisionFeatureCache.open(cache_dir)
+    assert len(cache) == 2
+    model.vision_feature_cache = cache
+
+    tower.calls = 0
+    with autocast():
+        features = model.encode_batch_images(images, image_keys=keys)
+    assert tower.calls == 1
+    assert (cache.hits, cache.misses) == (2, 2)
+    with autocast():
+        assert torch.equal(features, model.get_model().mm_projector(expected))
+
+    assert precompute_features(ImageDataset(list(images), keys), tower, cache_dir, batch_size=3, autocast_dtype=torch.bfloat16) == 2
+    cache = VisionFeatureCache.open(cache_dir)
+    model.vision_feature_cache = cache
+    tower.calls = 0
+    with autocast():
+        assert torch.equal(model.encode_images(images, keys), features)
+    assert tower.calls == 0 and cache.hit_rate == 1.0
+
+    # Without autocast, without keys or with the tower in another dtype the
+    # cache is bypassed
+    assert torch.equal(model.encode_images(images, keys), model.get_model().mm_projector(tower(images)))
+    with autocast():
+        model.encode_images(images)
+    assert cache.misses == 8
+    tower.double()
+    with autocast():
+        model.encode_images(images, keys)
+    assert cache.misses == 12
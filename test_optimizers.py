@@ -0,0 +1,96 @@
+import torch
+
+from optimizers import MixedPrecisionAdamW, dequantize_blockwise, quantize_blockwise
+
+
+def make_params(dtype, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    shapes = [(64, 32), (32,), (300,), (5, 7, 3)]
+    return [torch.randn(shape, generator=generator).to(dtype).requires_grad_() for shape in shapes]
+
+
+def run(optimizer_cls, params, steps=20, **kwargs):
+    optimizer = optimizer_cls(params, lr=1e-2, weight_decay=0.1, **kwargs)
+    generator = torch.Generator().manual_seed(1)
+    for _ in range(steps):
+        for p in params:
+            p.grad = torch.randn(p.shape, generator=generator).to(p.dtype)
+        optimizer.step()
+    return optimizer
+
+
+def test_matches_torch_adamw_in_float32():
+    expected = make_params(torch.float32)
+    run(torch.optim.AdamW, expected)
+    params = make_params(torch.float32)
+    optimizer = run(MixedPrecisionAdamW, params, chunk_numel=1000)
+    for p, e in zip(params, expected):
+        assert torch.allclose(p, e, atol=1e-6)
+    # No master copy for float32 parameters
+    assert all("master" not in state for state in optimizer.state.values())
+
+
+def test_low_precision_params_follow_float32_masters():
+    reference = make_params(torch.float32)
+    run(torch.optim.AdamW, reference)
+    for dtype in (torch.bfloat16, torch.float16):
+        params = make_params(dtype)
+        optimizer = run(MixedPrecisionAdamW, params)
+        for p, r in zip(params, reference):
+            master = optimizer.state[p]["master"]
+            assert p.dtype == dtype and master.dtype == torch.float32
+            assert torch.equal(p, master.to(dtype))
+            # Updates of 1e-2 are smaller than the bfloat16 spacing of most
+            # weights, the masters accumulate them
+            assert (master - r).abs().max() < 2e-2
+
+
+def test_quantized_state_is_close_and_small():
+    reference = make_params(torch.float32)
+    reference_optimizer = run(MixedPrecisionAdamW, reference)
+    params = make_params(torch.float32)
+    optimizer = run(MixedPrecisionAdamW, params, quantize_state=True, block_size=64)
+    for p, r in zip(params, reference):
+        assert (p - r).abs().max() < 2e-2
+    assert optimizer.state_bytes() < 0.3 * reference_optimizer.state_bytes()
+
+    values = torch.randn(1000) * torch.logspace(-4, 0, 1000)
+    codes, absmax = quantize_blockwise(values, block_size=64)
+    assert codes.dtype == torch.int8
+    restored = dequantize_blockwise(codes, absmax, values.shape)
+    assert ((restored - values).abs() <= 0.02 * absmax.repeat_interleave(64)[:1000]).all()
+    codes, absmax = quantize_blockwise(values.abs(), block_size=64, signed=False)
+    assert (dequantize_blockwise(codes, absmax, values.shape, signed=False) > 0).all()
+
+
+def test_state_dict_keeps_float32_state():
+    params = make_params(torch.bfloat16)
+    optimizer = run(MixedPrecisionAdamW, params, steps=3, quantize_state=True)
+    restored_params = [p.detach().clone().requires_grad_() for p in params]
+    restored = MixedPrecisionAdamW(restored_params, lr=1e-2, weight_decay=0.1, quantize_state=True)
+    restored.load_state_dict(optimizer.state_dict())
+    for p, r in zip(params, restored_params):
+        state, restored_state = optimizer.state[p], restored.state[r]
+        assert restored_state["master"].dtype == torch.float32
+        assert torch.equal(restored_state["master"], state["master"])
+        assert torch.equal(restored_state["exp_avg"], state["exp_avg"])
+        assert torch.equal(restored_state["exp_avg_sq_absmax"], state["exp_avg_sq_absmax"])
+
+
+def test_offloaded_step_matches():
+    expected = make_params(torch.bfloat16)
+    run(MixedPrecisionAdamW, expected, quantize_state=True)
+    params = make_params(torch.bfloat16)
+    optimizer = run(MixedPrecisionAdamW, params, quantize_state=True, offload=True, chunk_numel=1000)
+    optimizer.synchronize()
+    for p, e in zip(params, expected):
+        assert torch.equal(p, e)
+    assert all(value.device.type == "cpu" for state in optimizer.state.values() for value in state.values()
+               if torch.is_tensor(value))
+
+    # The update runs in the background with the learning rate of its step
+    optimizer.step()
+    optimizer.param_groups[0]["lr"] = 0.0
+    optimizer.zero_grad()
+    assert all(p.grad is None for p in params)
+    assert not torch.equal(params[0], expected[0])
@@ -0,0 +1,44 @@
+import torch
+import torch.nn as nn
+from peft import LoraConfig, TaskType, get_peft_model
+
+from llava.constants import IMAGE_TOKEN_INDEX
+from segment_model.mask_decoder_v5 import PromptedMaskDecoder
+from segment_model.precision import PrecisionPolicy
+from test_multimodal import tiny_llava
+
+
+def test_policy_sets_dtypes_once():
+    base_model = tiny_llava()
+    llm = get_peft_model(base_model, LoraConfig(r=4, target_modules=["q_proj", "v_proj"], task_type=TaskType.CAUSAL_LM))
+    image_encoder = nn.Conv2d(3, 8, 3, padding=1)
+    mask_decoder = PromptedMaskDecoder(prompt_dim=32, image_dim=8, hidden_dim=16)
+    # nn.TransformerEncoderLayer of the decoder is built for 256 channels
+    mask_decoder.encoder_layer = nn.TransformerEncoderLayer(d_model=8, nhead=2, batch_first=True, dim_feedforward=16)
+    cls = nn.Sequential(nn.AdaptiveAvgPool2d((1, 1)), nn.Flatten(), nn.Linear(8, 7))
+    policy = PrecisionPolicy(llm=torch.bfloat16, lora=torch.float32, vision_tower=torch.float32)
+    policy.apply(llm, base_model.get_vision_tower(), image_encoder, mask_decoder, cls)
+
+    for name, param in llm.named_parameters():
+        if "lora_" in name or "vision_tower" in name:
+            assert param.dtype == torch.float32, name
+        else:
+            assert param.dtype == torch.bfloat16, name
+    assert mask_decoder.out_dec.weight.dtype == torch.float32
+    weights = {name: param.data_ptr() for name, param in llm.named_parameters()}
+
+    images = torch.randn(2, 3, 8, 8)
+    input_ids = torch.tensor([[1, IMAGE_TOKEN_INDEX, 5, 6], [1, IMAGE_TOKEN_INDEX, 7, 0]])
+    for training in (True, False):
+        llm.train(training)
+        # Activations are cast where components meet, without autocast
+        image_features = llm.encode_batch_images(images)
+        assert image_features.dtype == torch.bfloat16
+        hidden = llm.extract_last_hidden_state(
+            input_ids=input_ids, images=images, image_features=image_features
+        )["hidden_states"][-1]
+        assert hidden.dtype == torch.bfloat16
+        mask = mask_decoder(image_encoder(torch.randn(2, 3, 4, 4)), hidden, output_size=16)
+        assert mask.dtype == torch.float32 and mask.shape == (2, 1, 16, 16)
+        # train/eval switches and forwards never re-cast or reallocate weights
+        assert {name: param.data_ptr() for name, param in llm.named_parameters()} == weights
@@ -0,0 +1,40 @@
+import json
+import os
+
+from profiler import StepProfiler, profile_stage
+
+
+def test_step_profiler_records_window(tmp_path):
+    output_dir = str(tmp_path / "profile")
+    profiler = StepProfiler(output_dir, device="cpu", warmup=1, active=2)
+    for _ in range(4):
+        profiler.start("data_wait")
+        profiler.stop("data_wait")
+        with profiler.stage("backward"):
+            sum(range(1000))
+        with profile_stage(profiler, "mask_decoder"):
+            pass
+        profiler.step()
+
+    assert not profiler.enabled
+    with open(os.path.join(output_dir, "step_trace.json")) as f:
+        events = json.load(f)["traceEvents"]
+    assert len(events) == 6
+    assert {event["args"]["step"] for event in events} == {1, 2}
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
+
+    summary = profiler.summary()
+    assert set(summary) == {"data_wait", "backward", "mask_decoder"}
+    assert all(stage["calls"] == 2 for stage in summary.values())
+    with open(os.path.join(output_dir, "step_summary.txt")) as f:
+        assert "backward" in f.read()
+
+
+def test_disabled_profiler_records_nothing():
+    profiler = StepProfiler(None, device="cpu")
+    with profiler.stage("backward"):
+        pass
+    profiler.step()
+    assert profiler.events == []
+    with profile_stage(None, "mask_decoder"):
+        pass
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from data_utils.sampler import LengthBucketBatchSampler, RandomBatchSampler, ResumableBatchSampler, padding_efficiency
+
+
+def test_length_bucket_batches_cover_dataset():
+    lengths = np.random.default_rng(0).integers(10, 400, size=1000)
+    sampler = LengthBucketBatchSampler(lengths, batch_size=8, bucket_size=16)
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+
+    random_batches = np.random.default_rng(1).permutation(len(lengths)).reshape(-1, 8)
+    assert sampler.padding_efficiency > padding_efficiency(lengths, random_batches) + 0.2
+
+    # Deterministic for an epoch, reshuffled across epochs
+    assert list(sampler) == batches
+    sampler.set_epoch(1)
+    assert list(sampler) != batches
+
+
+def test_length_bucket_drop_last():
+    sampler = LengthBucketBatchSampler(np.arange(1, 101), batch_size=8, bucket_size=4, drop_last=True)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 12
+    assert all(len(batch) == 8 for batch in batches)
+
+
+def test_sampler_resumes_mid_epoch():
+    lengths = np.random.default_rng(0).integers(10, 400, size=200)
+    for make in (lambda: RandomBatchSampler(len(lengths), batch_size=8, seed=3),
+                 lambda: LengthBucketBatchSampler(lengths, batch_size=8, bucket_size=4, seed=3)):
+        sampler = make()
+        sampler.set_epoch(2)
+        batches = list(sampler)
+        state = sampler.state_dict(consumed_batches=7)
+
+        resumed = make()
+        resumed.load_state_dict(state)
+        assert len(resumed) == len(batches) - 7
+        assert list(resumed) == batches[7:]
+
+
+def test_sampler_without_batches_fails_on_creation():
+    class NoBatches(ResumableBatchSampler):
+        pass
+
+    with pytest.raises(TypeError):
+        NoBatches(10, batch_size=2)
@@ -0,0 +1,91 @@
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+from train import train
+
+
+class TinyLLMSeg(nn.Module):
+    # Same call signature and outputs as LLMSeg, float64 so autocast leaves it alone
+    def __init__(self):
+        super().__init__()
+        self.encoder = nn.Conv2d(3, 4, 3, padding=1)
+        self.mask_head = nn.Conv2d(4, 1, 1)
+        self.cls_head = nn.Linear(4, 2)
+        self.text = nn.Embedding(10, 4)
+        self.profiler = None
+
+    def forward(self, input_ids, image_tensor_for_vlm, image_tensor_for_image_enc, attention_mask=None, answers=None, mask_size=None, image_keys=None):
+        features = torch.relu(self.encoder(image_tensor_for_image_enc))
+        masks = self.mask_head(features)
+        output_cls = self.cls_head(features.mean(dim=(2, 3)) + self.text(input_ids).mean(dim=1))
+        if not self.training:
+            return masks, output_cls
+        # Per-sample mean like the segment and cls losses
+        logit_loss = ((self.text(answers).sum(dim=-1) - 1) ** 2).mean()
+        return masks, output_cls, logit_loss
+
+
+class SyntheticSegDataset(torch.utils.data.Dataset):
+    def __init__(self, num_samples):
+        generator = torch.Generator().manual_seed(0)
+        self.images = torch.randn(num_samples, 3, 8, 8, generator=generator, dtype=torch.float64)
+        self.masks = (torch.rand(num_samples, 1, 8, 8, generator=generator) > 0.5).double()
+        self.input_ids = torch.randint(0, 10, (num_samples, 5), generator=generator)
+        self.answers = torch.randint(0, 10, (num_samples, 3), generator=generator)
+        self.labels = torch.randint(0, 2, (num_samples,), generator=generator)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        return {
+            "input_ids": self.input_ids[idx],
+            "image_tensor": self.images[idx],
+            "image_sam": self.images[idx],
+            "mask_tensor": self.masks[idx],
+            "attention_masks": torch.ones(5, dtype=torch.long),
+            "answers_ids": self.answers[idx],
+            "label": self.labels[idx],
+        }
+
+
+def train_once(tmp_path, batch_size, accumulation_steps, num_samples, max_grad_norm):
+    torch.manual_seed(0)
+    model = TinyLLMSeg().double()
+    dataset = SyntheticSegDataset(num_samples)
+    loaders = {
+        "train": DataLoader(dataset, batch_size=batch_size),
+        "val": DataLoader(dataset, batch_size=num_samples),
+    }
+    # Plain SGD with lr 1 subtracts the clipped gradient, so equal weights
+    # after training mean equal gradients at every step
+    optimizer = torch.optim.SGD(model.parameters(), lr=1.0)
+    train(
+        model,
+        loaders,
+        optimizer,
+        num_epochs=1,
+        device="cpu",
+        save_dir=str(tmp_path / f"b{batch_size}_a{accumulation_steps}"),
+        checkpoint_every=0,
+        accumulation_steps=accumulation_steps,
+        max_grad_norm=max_grad_norm
+    )
+    return model.state_dict()
+
+
+def test_accumulated_gradients_match_large_batch(tmp_path):
+    # Two optimizer steps of 4 and 2 samples, the second accumulated group is
+    # shorter than accumulation_steps. The gradient norm of the first step is
+    # about 5.8: 100 checks the loss scaling, 4 the clipping of the sum.
+    for max_grad_norm in [100.0, 4.0]:
+        expected = train_once(tmp_path, 4, 1, num_samples=6, max_grad_norm=max_grad_norm)
+        for batch_size, accumulation_steps in [(2, 2), (1, 4)]:
+            accumulated = train_once(tmp_path, batch_size, accumulation_steps, num_samples=6, max_grad_norm=max_grad_norm)
+            for name, value in expected.items():
+                assert torch.allclose(accumulated[name], value, atol=1e-10), name
+
+    # The same micro-batches without accumulation take three different steps
+    micro_steps = train_once(tmp_path, 2, 1, num_samples=6, max_grad_norm=4.0)
+    assert not torch.allclose(micro_steps["mask_head.weight"], expected["mask_head.weight"])
@@ -8,6 +8,7 @@
 # --------------------------------------------------------
 
 import itertools
+from contextlib import contextmanager, nullcontext
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -147,6 +148,30 @@ class PatchMerging(nn.Module):
         return x
 
 
+@contextmanager
+def frozen_bn_stats(module):
+    # BatchNorm running statistics are left untouched while a checkpointed
+    # block is recomputed in backward, so they are updated once per step
+    norms = [m for m in module.modules()
+             if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    states = [(m.momentum, m.num_batches_tracked.clone()) for m in norms]
+    for m in norms:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(norms, states):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def checkpoint_block(blk, x):
+    # Activations of blk are recomputed in backward instead of being stored
+    return checkpoint.checkpoint(
+        blk, x, use_reentrant=False,
+        context_fn=lambda: (nullcontext(), frozen_bn_stats(blk)))
+
+
 class ConvLayer(nn.Module):
     def __init__(self, dim, input_resolution, depth,
                  activation,
@@ -178,7 +203,7 @@ class ConvLayer(nn.Module):
     def forward(self, x):
         for blk in self.blocks:
             if self.use_checkpoint:
-                x = checkpoint.checkpoint(blk, x)
+                x = checkpoint_block(blk, x)
             else:
                 x = blk(x)
         if self.downsample is not None:
@@ -436,7 +461,7 @@ class BasicLayer(nn.Module):
     def forward(self, x):
         for blk in self.blocks:
             if self.use_checkpoint:
-                x = checkpoint.checkpoint(blk, x)
+                x = checkpoint_block(blk, x)
             else:
                 x = blk(x)
         if self.downsample is not None:
@@ -550,6 +575,16 @@ class TinyViT(nn.Module):
             ),
             LayerNorm2d(256),
         )
+    def set_use_checkpoint(self, use_checkpoint):
+        # Activation checkpointing of the blocks, a bool for all layers or
+        # one bool per layer (the ConvLayer first)
+        if isinstance(use_checkpoint, bool):
+            use_checkpoint = [use_checkpoint] * len(self.layers)
+        assert len(use_checkpoint) == len(self.layers), \
+            f'expected {len(self.layers)} flags, got {len(use_checkpoint)}'
+        for layer, enabled in zip(self.layers, use_checkpoint):
+            layer.use_checkpoint = bool(enabled)
+
     def set_layer_lr_decay(self, layer_lr_decay):
         decay_rate = layer_lr_decay
 
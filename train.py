@@ -7,18 +7,17 @@ from torch.amp import autocast
 from llava.mm_utils import get_model_name_from_path
 from llava.utils import disable_torch_init
 from llava.model.builder import load_pretrained_model
-from data_utils.dataset import create_dataloader
+from data_utils.dataset import create_dataloader, DevicePreprocess
 from loss import structure_loss, dice_score, BceDiceLoss
 from tqdm import tqdm
 import logging
+import os
 import torch.nn.functional as F
-from optimizers import Adam16
-
-logging.basicConfig(
-    filename='logs/training.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+from optimizers import MixedPrecisionAdamW
+from checkpoint import AsyncCheckpointWriter, training_state, load_training_state
+from profiler import StepProfiler
+from metrics import DeviceMetrics
+from distributed import init_distributed, cleanup_distributed, is_main_process, get_world_size, broadcast_trainable, all_reduce_gradients
 
 def count_train_parameters(model):
     trainable_params = filter(lambda p: p.requires_grad, model.parameters())
@@ -27,15 +26,17 @@ def count_train_parameters(model):
     return num_params
 
 def evaluate(model, val_loader, device="cuda:0"): 
-    dice_score_list = []
+    metrics = DeviceMetrics(["dice"], device=device)
+    preprocess = DevicePreprocess().to(device)
     print("Number of val sample", len(val_loader))
     for batch in tqdm(val_loader, desc="Evaluating"):
         model.eval()
         model.to(device)
         input_ids = batch['input_ids'].to(device)
         image_tensor = batch['image_tensor'].to(device)
-        mask_tensor = batch['mask_tensor'].to(device)
-        image_sam_tensor = batch['image_sam'].to(device)
+        mask_tensor = batch['mask_tensor'].to(device, non_blocking=True)
+        image_sam_tensor = batch['image_sam'].to(device, non_blocking=True)
+        image_sam_tensor, mask_tensor = preprocess(image_sam_tensor, mask_tensor)
         # answer_ids = batch['answers_ids'].to(device)
         # attention_mask = batch['attention_masks'].to(device)
         with torch.no_grad():
@@ -45,9 +46,11 @@ def evaluate(model, val_loader, device="cuda:0"):
             # print("Dice score value:", dice_score_value)
             # print("loss:", loss.item())
             # print("dice_score_value:", dice_score_value)
-            dice_score_list.append(dice_score_value.item())
+            metrics.update(dice=dice_score_value)
         # break
-    mean_dice = sum(dice_score_list) / len(dice_score_list)
+    # Mean over the val batches of all ranks
+    metrics.all_reduce()
+    mean_dice = metrics.flush()["dice"]
     return mean_dice
         
 def train(
@@ -55,7 +58,14 @@ def train(
     full_loader,
     optimizer,
     num_epochs=10,
-    device="cuda:0"
+    device="cuda:0",
+    save_dir="/home/mamba/ML_project/Testing/Huy/llm_seg/training_results/weights3_full",
+    resume_from=None,
+    checkpoint_every=1000,
+    profile_dir=None,
+    detect_anomaly=False,
+    accumulation_steps=1,
+    max_grad_norm=2.0
 ):
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(
         optimizer,
@@ -64,17 +74,57 @@ def train(
     )
 
     bce_dice_loss = BceDiceLoss()
+    preprocess = DevicePreprocess().to(device)
+
+    # Anomaly detection re-runs every backward with checks, debugging only
+    torch.autograd.set_detect_anomaly(detect_anomaly)
+    # Trainable weights and training state are written in the background,
+    # LLMSeg.load_model and load_trainable_state read this format
+    checkpoint_writer = AsyncCheckpointWriter()
+    # Loss sums stay on the device and are read back at the logging interval
+    metrics = DeviceMetrics(["loss", "llm_loss", "segment_loss", "cls_loss"], device=device)
+    # With profile_dir, a Chrome trace and a summary of the step stages are
+    # written there after the first profiled steps
+    profiler = StepProfiler(profile_dir, device=device)
+    model.profiler = profiler if profiler.enabled else None
+
+    # In distributed runs (distributed.init_distributed) every rank trains on
+    # its own batches, gradients are averaged over the ranks before each
+    # optimizer step and only rank 0 writes checkpoints and logs
+    main_process = is_main_process()
+    if get_world_size() > 1:
+        model.to(device)
+        broadcast_trainable(model)
 
     dataloader = full_loader["train"]
     val_dataloader = full_loader["val"]
-    for epoch in range(num_epochs):
+    batch_sampler = dataloader.batch_sampler
+    resumable = hasattr(batch_sampler, "set_epoch")
+
+    start_epoch = 0
+    start_batch = 0
+    global_step = 0
+    if resume_from is not None:
+        # The sampler rebuilds the interrupted epoch from its seed and skips the
+        # consumed batches without loading them
+        model.load_trainable_state(resume_from)
+        state = load_training_state(resume_from, optimizer, scheduler, batch_sampler if resumable else None)
+        start_epoch = state["epoch"]
+        start_batch = state["batch_in_epoch"]
+        global_step = state["global_step"]
+        logging.info(f"Resuming from {resume_from} at epoch {start_epoch+1}, batch {start_batch}, step {global_step}")
+
+    for epoch in range(start_epoch, num_epochs):
         model.train()
         model.to(device)
-        ep_loss = 0
-        total_llm_loss = 0
-        total_segment_loss = 0
-        total_cls_loss = 0
-        progress_bar = tqdm(dataloader, desc=f"Epoch {epoch+1}/{num_epochs}")
+        metrics.reset()
+        batch_in_epoch = start_batch if epoch == start_epoch else 0
+        if resumable:
+            batch_sampler.set_epoch(epoch, batch_in_epoch)
+        elif hasattr(dataloader.dataset, "set_epoch"):
+            # Streaming ShardDataset, reshuffled per epoch but not resumable mid-epoch
+            dataloader.dataset.set_epoch(epoch)
+        progress_bar = tqdm(dataloader, desc=f"Epoch {epoch+1}/{num_epochs}", disable=not main_process)
         cnt = 0
 
         # if epoch > 1:
@@ -82,22 +132,34 @@ def train(
         #     for param in model.model.parameters():
         #         param.requires_grad = False
 
+        # Loader batches are micro-batches, accumulation_steps of them make one
+        # optimizer step. Groups are counted from the start of the epoch, so a
+        # resumed run keeps the same groups; the last group of an epoch can be
+        # shorter.
+        epoch_batches = batch_in_epoch + len(dataloader)
+        first_batch = batch_in_epoch
+        accumulated = 0
+        profiler.start("data_wait")
         for batch in progress_bar:
-            optimizer.zero_grad()
+            profiler.stop("data_wait")
+            if accumulated == 0:
+                optimizer.zero_grad()
+                group_size = max(1, min(accumulation_steps, epoch_batches - batch_in_epoch))
             
                 # logging.info(str(progress_bar))
             # cnt +=1
             # if cnt > 10:
                 # break
             
-            input_ids = batch['input_ids'].to(device)
-            image_tensor = batch['image_tensor'].to(device)
-            mask_tensor = batch['mask_tensor'].to(device)
-            image_sam_tensor = batch['image_sam'].to(device)
-            attention_mask = batch['attention_masks'].to(device)
-            answers_ids = batch['answers_ids'].to(device)
-            labels = batch['label'].to(device)
-            torch.autograd.set_detect_anomaly(True)
+            with profiler.stage("host_to_device"):
+                input_ids = batch['input_ids'].to(device)
+                image_tensor = batch['image_tensor'].to(device)
+                mask_tensor = batch['mask_tensor'].to(device, non_blocking=True)
+                image_sam_tensor = batch['image_sam'].to(device, non_blocking=True)
+                image_sam_tensor, mask_tensor = preprocess(image_sam_tensor, mask_tensor)
+                attention_mask = batch['attention_masks'].to(device)
+                answers_ids = batch['answers_ids'].to(device)
+                labels = batch['label'].to(device)
             
             with autocast(dtype=torch.float16, device_type=device):
                 outputs_mask, output_cls, logit_loss = model(
@@ -105,99 +167,173 @@ def train(
                     image_tensor_for_vlm = image_tensor, 
                     image_tensor_for_image_enc = image_sam_tensor, 
                     attention_mask = attention_mask,
-                    answers = answers_ids)
+                    answers = answers_ids,
+                    mask_size = mask_tensor.shape[-1],
+                    image_keys = batch.get('image_keys'))
             # print("============/=========")
             # print("outputs:", outputs)
-            outputs_mask = F.interpolate(outputs_mask, size=(1024, 1024), mode='bilinear', align_corners=False)
-            cls_loss = nn.CrossEntropyLoss()(output_cls, labels)
-            # print("cls_loss:", cls_loss.item())
-            segment_loss = structure_loss(outputs_mask, mask_tensor)
-            
-            # if epoch < 2:
-            # print(segment_loss, logit_loss)
-            loss = segment_loss + logit_loss + cls_loss
-
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=2.0)
-            optimizer.step()  
-
-            ep_loss += loss.item()
-            avg_loss = ep_loss / (progress_bar.n + 1)
-            total_llm_loss += logit_loss.item()
-            total_segment_loss += segment_loss.item()
-            total_cls_loss += cls_loss.item()
-            avg_llm_loss = total_llm_loss / (progress_bar.n + 1)
-            avg_segment_loss = total_segment_loss / (progress_bar.n + 1)
-            avg_cls_loss = total_cls_loss / (progress_bar.n + 1)
-            if progress_bar.n % 1000 == 0:
-                logging.info(f"Epoch [{epoch+1}/{num_epochs}], Step [{progress_bar.n}], Loss: {avg_loss}, LLM Loss: {avg_llm_loss}, Segment Loss: {avg_segment_loss}, Cls Loss: {avg_cls_loss}")
-            progress_bar.set_postfix(loss=avg_loss, llm_loss=avg_llm_loss, segment_loss=avg_segment_loss, cls_loss=avg_cls_loss)
+            # The decoder already predicts at the resolution of the target masks,
+            # 1024 or the low resolution supervision size of create_dataloader
+            with profiler.stage("loss"):
+                cls_loss = nn.CrossEntropyLoss()(output_cls, labels)
+                # print("cls_loss:", cls_loss.item())
+                segment_loss = structure_loss(outputs_mask, mask_tensor)
+                
+                # if epoch < 2:
+                # print(segment_loss, logit_loss)
+                loss = segment_loss + logit_loss + cls_loss
+
+            with profiler.stage("backward"):
+                # Each micro-batch loss is a mean over its samples, scaling by
+                # the group size gives the mean over the accumulated batch
+                (loss / group_size).backward()
+            accumulated += 1
+            batch_in_epoch += 1
+            metrics.update(loss=loss, llm_loss=logit_loss, segment_loss=segment_loss, cls_loss=cls_loss)
+            # Every 1000 batches and after the first batch of the epoch (or of
+            # the resumed run). progress_bar.n is only updated on refresh.
+            if main_process and (batch_in_epoch == first_batch + 1 or batch_in_epoch % 1000 == 0):
+                # Losses of rank 0, the epoch loss is averaged over all ranks
+                averages = metrics.flush()
+                logging.info(f"Epoch [{epoch+1}/{num_epochs}], Step [{batch_in_epoch}], Loss: {averages['loss']}, LLM Loss: {averages['llm_loss']}, Segment Loss: {averages['segment_loss']}, Cls Loss: {averages['cls_loss']}")
+                progress_bar.set_postfix(**averages)
+            if accumulated < group_size:
+                profiler.start("data_wait")
+                continue
+
+            with profiler.stage("optimizer_step"):
+                all_reduce_gradients(model)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=max_grad_norm)
+                optimizer.step()  
+            accumulated = 0
+            global_step += 1
+            if main_process and checkpoint_every and global_step % checkpoint_every == 0:
+                checkpoint_writer.save(
+                    f"{save_dir}/last",
+                    model,
+                    training_state(optimizer, scheduler, epoch, batch_in_epoch, global_step, batch_sampler if resumable else None)
+                )
             # print(f"Epoch [{epoch+1}/{num_epochs}], Loss: {loss.item()}")
             # break
+            profiler.step()
+            profiler.start("data_wait")
+        profiler.stop("data_wait")
+        if accumulated > 0:
+            # Fewer batches than len(dataloader) announced (streaming loaders)
+            all_reduce_gradients(model)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=max_grad_norm)
+            optimizer.step()
+            global_step += 1
         scheduler.step()
+        if hasattr(optimizer, "synchronize"):
+            # MixedPrecisionAdamW(offload=True) may still be updating the weights
+            optimizer.synchronize()
         model.eval()
-        ep_loss /= len(dataloader)
-        print(f"Epoch [{epoch+1}/{num_epochs}], Loss: {ep_loss}")
+        metrics.all_reduce()
+        ep_loss = metrics.flush()["loss"]
+        if main_process:
+            print(f"Epoch [{epoch+1}/{num_epochs}], Loss: {ep_loss}")
         logging.info(f"Epoch [{epoch+1}/{num_epochs}], Loss: {ep_loss}")
+        feature_cache = getattr(model, "vision_feature_cache", None)
+        if feature_cache is not None:
+            logging.info(f"Epoch [{epoch+1}/{num_epochs}], Vision feature cache hit rate: {feature_cache.hit_rate:.3f} ({feature_cache.hits} hits, {feature_cache.misses} misses)")
+            feature_cache.reset_counters()
+        if getattr(batch_sampler, "padding_efficiency", None) is not None:
+            logging.info(f"Epoch [{epoch+1}/{num_epochs}], Padding efficiency: {batch_sampler.padding_efficiency:.3f}")
         model.eval()
         mean_dice = evaluate(model, val_dataloader, device=device)
-        print(f"Epoch [{epoch+1}/{num_epochs}], Val mean Dice Score: {mean_dice}")
+        if main_process:
+            print(f"Epoch [{epoch+1}/{num_epochs}], Val mean Dice Score: {mean_dice}")
         logging.info(f"Epoch [{epoch+1}/{num_epochs}], Val mean Dice Score: {mean_dice}")
-        model.save_model(f"/home/mamba/ML_project/Testing/Huy/llm_seg/training_results/weights3_full/llm_seg_{epoch+1}")
+        # Saved after scheduler.step(), so a run resumed from here starts the next epoch
+        if main_process:
+            checkpoint_writer.save(
+                f"{save_dir}/llm_seg_{epoch+1}",
+                model,
+                training_state(optimizer, scheduler, epoch + 1, 0, global_step)
+            )
         # break
+    checkpoint_writer.close()
+
+if __name__ == "__main__":
+    # Set up here, not on import, so the tests importing train() do not write
+    # to logs/training.log
+    logging.basicConfig(
+        filename='logs/training.log',
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    # torch.set_default_device("cuda")
+    # cuda:0 for python train.py, one rank per GPU under torchrun
+    rank, world_size, device = init_distributed()
+    model, tokenizer, image_processor, config = build_llm_seg(
+        model_path="/home/mamba/ML_project/Testing/Huy/llm_seg/weight/llava-med-v1.5-mistral-7b",
+        model_base=None,
+        load_8bit=False,
+        load_4bit=False,
+        device=device
+    )
+
+    dataloader = create_dataloader(
+        data_path="/home/mamba/ML_project/Testing/Huy/llm_seg/dataset/data",
+        annotation_path="/home/mamba/ML_project/Testing/Huy/llm_seg/dataset/annotation_v2",
+        data_config=config,
+        image_processor=image_processor,
+        tokenizer=tokenizer,
+        batch_size=8,
+        mode="train",
+        bucket_by_length=True,
+        uint8_output=True,
+        # e.g. 256 to supervise the decoder at low resolution, validation stays at 1024
+        mask_size=1024,
+        # Written by python -m data_utils.loader_tuning, defaults when missing
+        loader_config="loader_config.json" if os.path.exists("loader_config.json") else None,
+        rank=rank,
+        world_size=world_size
+    )
+
+    model.to(device)
+    # e.g. encoder_layers=[False, True, True, False] to fit larger batches,
+    # see benchmarks/activation_checkpointing.py
+    model.enable_activation_checkpointing(encoder_layers=False, decoder=False)
+    # CLIP features written by python -m data_utils.feature_cache, skipped when missing
+    model.enable_vision_feature_cache("/home/mamba/ML_project/Testing/Huy/llm_seg/dataset/clip_features")
+
+    optimizer = torch.optim.AdamW(
+        model.parameters(),
+        lr = 1e-4,
+        weight_decay=1e-5,
+        eps = 1e-6
+    )
+
+    # optimizer = torch.optim.Adam(
+    #     model.parameters(),
+    #     lr=1e-4,
+    #     betas=(0.9, 0.999),
+    #     eps=1e-8,
+    #     weight_decay=1e-5
+    # )
+    # float32 master weights for the bfloat16 LoRA parameters, quantize_state
+    # keeps the moments in 8 bits
+    # optimizer = MixedPrecisionAdamW(
+    #     [p for p in model.parameters() if p.requires_grad],
+    #     lr=1e-4,
+    #     eps=1e-6,
+    #     weight_decay=1e-5,
+    #     quantize_state=False
+    # )
+
+    train_params = count_train_parameters(model)
+    print("Trainable parameters:", train_params)
+    train(
+        model=model,
+        full_loader=dataloader,
+        optimizer=optimizer,
+        num_epochs=15,
+        device=device,
+        # Effective batch size is batch_size * accumulation_steps
+        accumulation_steps=1
+    )
+    cleanup_distributed()
 
-# torch.set_default_device("cuda")
-device = "cuda:0"
-model, tokenizer, image_processor, config = build_llm_seg(
-    model_path="/home/mamba/ML_project/Testing/Huy/llm_seg/weight/llava-med-v1.5-mistral-7b",
-    model_base=None,
-    load_8bit=False,
-    load_4bit=False,
-    device=device
-)
-
-dataloader = create_dataloader(
-    data_path="/home/mamba/ML_project/Testing/Huy/llm_seg/dataset/data",
-    annotation_path="/home/mamba/ML_project/Testing/Huy/llm_seg/dataset/annotation_v2",
-    data_config=config,
-    image_processor=image_processor,
-    tokenizer=tokenizer,
-    batch_size=8,
-    mode="train"
-)
-
-model.to(device)
-
-optimizer = torch.optim.AdamW(
-    model.parameters(),
-    lr = 1e-4,
-    weight_decay=1e-5,
-    eps = 1e-6
-)
-
-# optimizer = torch.optim.Adam(
-#     model.parameters(),
-#     lr=1e-4,
-#     betas=(0.9, 0.999),
-#     eps=1e-8,
-#     weight_decay=1e-5
-# )
-# optimizer = Adam16(
-#     model.parameters(),
-#     lr=1e-4,
-#     betas=(0.9, 0.999),
-#     eps=1e-8,
-#     weight_decay=1e-5
-# )
-
-train_params = count_train_parameters(model)
-print("Trainable parameters:", train_params)
-train(
-    model=model,
-    full_loader=dataloader,
-    optimizer=optimizer,
-    num_epochs=15,
-    device=device
-)
-
-model.load_model("/home/mamba/ML_project/Testing/Huy/llm_seg/training_results/weights3_full/llm_seg_10")
+    model.load_model("/home/mamba/ML_project/Testing/Huy/llm_seg/training_results/weights3_full/llm_seg_10")